@@ -0,0 +1,136 @@
+"""
+Files the app reads at runtime, loaded once and reloaded when they change.
+
+Instead of opening a file on every request, a `WatchedFile` keeps the parsed
+value in memory and only re-checks the file's modification time every few
+seconds, re-reading it when it changed.
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Generic, Optional, TypeVar
+
+try:
+    import brotli
+except ImportError:
+    # Brotli is optional, gzip is used when it isn't installed
+    brotli = None
+
+T = TypeVar('T')
+
+# Seconds between two modification time checks of a watched file
+CHECK_INTERVAL = 2.0
+
+# Bodies smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 512
+
+
+def make_etag(body: bytes) -> str:
+    """Strong ETag for a response body."""
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match request header matches the current ETag."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(
+        tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(',')
+    )
+
+
+@dataclass(frozen=True)
+class JsonAsset:
+    """A JSON response body serialized once, with its ETag."""
+
+    body: bytes
+    etag: str
+
+    @classmethod
+    def from_value(cls, value: Any) -> 'JsonAsset':
+        body = json.dumps(value).encode('utf-8')
+        return cls(body, make_etag(body))
+
+
+@dataclass(frozen=True)
+class StaticAsset:
+    """A file served from memory, with precompressed variants and a strong ETag."""
+
+    body: bytes
+    media_type: str
+    etag: str
+    gzip_body: Optional[bytes] = None
+    brotli_body: Optional[bytes] = None
+
+    @classmethod
+    def from_bytes(cls, body: bytes, media_type: str) -> 'StaticAsset':
+        gzip_body = brotli_body = None
+        if len(body) >= MIN_COMPRESS_SIZE:
+            gzip_body = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                brotli_body = brotli.compress(body, quality=11)
+        return cls(body, media_type, make_etag(body), gzip_body, brotli_body)
+
+    @property
+    def version(self) -> str:
+        """Short content hash, used as `?v=` to make URLs of the asset immutable."""
+        return self.etag.strip('"')[:12]
+
+    def encode(self, accept_encoding: Optional[str]) -> tuple[bytes, Optional[str]]:
+        """Pick the smallest variant the client accepts, returning it and its Content-Encoding."""
+        accepted = {
+            coding.split(';')[0].strip() for coding in (accept_encoding or '').split(',')
+        }
+        if self.brotli_body is not None and 'br' in accepted:
+            return self.brotli_body, 'br'
+        if self.gzip_body is not None and 'gzip' in accepted:
+            return self.gzip_body, 'gzip'
+        return self.body, None
+
+
+class WatchedFile(Generic[T]):
+    """A file parsed once and reloaded when its modification time changes.
+
+    `load` receives the file's bytes, or None if the file doesn't exist.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        load: Callable[[Optional[bytes]], T],
+        check_interval: float = CHECK_INTERVAL,
+    ):
+        self.path = path
+        self._load = load
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._value: Optional[T] = None
+        self._loaded = False
+
+    def get(self) -> T:
+        """Get the parsed file, reloading it first if it changed on disk."""
+        now = time.monotonic()
+        if self._loaded and now - self._checked_at < self._check_interval:
+            return self._value  # type: ignore[return-value]
+        with self._lock:
+            if not self._loaded or now - self._checked_at >= self._check_interval:
+                self._checked_at = now
+                try:
+                    mtime = self.path.stat().st_mtime
+                except FileNotFoundError:
+                    mtime = None
+                if not self._loaded or mtime != self._mtime:
+                    data = self.path.read_bytes() if mtime is not None else None
+                    self._value = self._load(data)
+                    self._mtime = mtime
+                    self._loaded = True
+        return self._value  # type: ignore[return-value]
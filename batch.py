@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Run a JSONL file of prompts through Together from the command line, for
+evaluation sets that would otherwise be clicked through the UI.
+
+Each input line is a JSON object with a `prompt` and optionally an `id`, a
+`model` and a `history` of earlier `{"role": "user" | "model", "content": ...}`
+messages. A `messages` list in the Together chat format works too: its last
+message is the prompt and the ones before it the history. `system` messages
+replace the app's system prompt, and "assistant" is the same as "model".
+Lines without an id are numbered from 1.
+
+    python batch.py evals.jsonl results.jsonl --concurrency 8
+
+Prompts run through `together_model.chat_completion`, with its retries and
+fallbacks, `--concurrency` at a time. Each result is appended to the output as
+soon as it's done, as a JSON line with the `id` and either the `response` or
+an `error`. The output file is also the checkpoint: running the same command
+again after a crash or Ctrl-C skips the ids already in it, and
+`--retry-failed` runs the failed ones again.
+
+`--together-batch` submits the prompts as one Together batch job instead,
+which costs less and completes within a day. The job id is kept next to the
+output file while it runs, so an interrupted run picks the same job up again.
+Without batch API access the prompts run directly.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, TextIO
+
+try:
+    from together import APIStatusError
+    from chat_message import Message
+    from together_model import (
+        SAMPLING_PARAMS,
+        CompletionInfo,
+        build_messages,
+        chat_completion,
+        get_client,
+    )
+except ImportError as e:
+    print(f"Error importing together_model: {e}")
+    print("Please install the required packages using:")
+    print("pip install together")
+    sys.exit(1)
+
+DEFAULT_MODEL = "microsoft/WizardLM-2-8x22B"
+
+# Roles of the input messages, as the roles of the stored `Message`s
+HISTORY_ROLES = {'user': 'user', 'model': 'model', 'assistant': 'model'}
+
+# Batch job states after which the job won't change anymore
+FINAL_BATCH_STATES = {'COMPLETED', 'FAILED', 'EXPIRED', 'CANCELLED'}
+
+
+def read_records(path: Path, id_field: str, prompt_field: str) -> Iterator[Dict[str, Any]]:
+    """Parse the input file into records with an `id`, `prompt`, `model`, `history` and `system` prompt.
+
+    `system` is None unless the messages have some, to use the app's system prompt.
+    """
+    with path.open(encoding='utf-8') as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            history = data.get('history') or []
+            prompt = data.get(prompt_field)
+            if prompt is None and data.get('messages'):
+                *history, last = data['messages']
+                prompt = last['content']
+            if prompt is None:
+                raise ValueError(f"{path}:{number} has no {prompt_field!r} or 'messages'")
+            system = []
+            messages = []
+            for m in history:
+                if 'role' not in m or 'content' not in m:
+                    continue
+                if m['role'] == 'system':
+                    system.append(m['content'])
+                elif m['role'] in HISTORY_ROLES:
+                    messages.append(Message(HISTORY_ROLES[m['role']], m['content']))
+                else:
+                    raise ValueError(f"{path}:{number} has a message with the unknown role {m['role']!r}")
+            yield {
+                'id': str(data.get(id_field, number)),
+                'prompt': prompt,
+                'model': data.get('model'),
+                'history': messages,
+                'system': '\n\n'.join(system) if system else None,
+            }
+
+
+def read_checkpoint(path: Path, retry_failed: bool) -> Set[str]:
+    """Ids already in the output file, which are skipped.
+
+    A line cut short by a crash is removed, and with `retry_failed` so are the
+    errors, so that they are run again.
+    """
+    if not path.exists():
+        return set()
+    data = path.read_bytes()
+    complete = data[:data.rfind(b'\n') + 1]
+    results = [json.loads(line) for line in complete.splitlines() if line.strip()]
+    if retry_failed:
+        results = [result for result in results if 'error' not in result]
+    if len(complete) != len(data) or retry_failed:
+        tmp_file = path.with_name(f'.{path.name}.{os.getpid()}')
+        tmp_file.write_bytes(b''.join(json.dumps(result).encode('utf-8') + b'\n' for result in results))
+        os.replace(tmp_file, path)
+    return {result['id'] for result in results}
+
+
+def write_result(output: TextIO, result: Dict[str, Any]):
+    """Append a result line, flushed so that it survives a crash of this process."""
+    output.write(json.dumps(result) + '\n')
+    output.flush()
+
+
+def run_one(record: Dict[str, Any], default_model: str) -> Dict[str, Any]:
+    """Answer one record with `chat_completion`, in a worker thread."""
+    model = record['model'] or default_model
+    info = CompletionInfo()
+    start = time.perf_counter()
+    result: Dict[str, Any] = {'id': record['id'], 'model': model}
+    try:
+        result['response'] = chat_completion(record['prompt'], record['history'], model, info, record['system'])
+    except Exception as e:
+        result['error'] = str(e)
+    result.update({
+        'answered_by': info.model,
+        'attempts': info.attempts,
+        'cached': info.cached,
+        'prompt_tokens': info.prompt_tokens,
+        'completion_tokens': info.completion_tokens,
+        'seconds': round(time.perf_counter() - start, 3),
+    })
+    return result
+
+
+async def run_direct(records: List[Dict[str, Any]], output: TextIO, args: argparse.Namespace) -> int:
+    """Run the records `args.concurrency` at a time, returning the number of failures."""
+    loop = asyncio.get_running_loop()
+    pending = iter(records)
+    failures = done = 0
+
+    async def worker():
+        nonlocal failures, done
+        for record in pending:
+            result = await loop.run_in_executor(executor, run_one, record, args.model)
+            # Results are only written from the event loop, one line at a time
+            write_result(output, result)
+            done += 1
+            failures += 'error' in result
+            if done % 10 == 0 or done == len(records):
+                print(f"{done}/{len(records)} done, {failures} failed")
+
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    try:
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return failures
+
+
+def batch_line(record: Dict[str, Any], default_model: str) -> Dict[str, Any]:
+    """A record as a line of a Together batch input file."""
+    model = record['model'] or default_model
+    return {
+        'custom_id': record['id'],
+        'body': {
+            'model': model,
+            'messages': build_messages(record['prompt'], record['history'], model, record['system']),
+            **SAMPLING_PARAMS,
+        },
+    }
+
+
+def batch_results(file_id: Optional[str]) -> Iterator[Dict[str, Any]]:
+    if not file_id:
+        return
+    for line in get_client().files.content(file_id).read().splitlines():
+        if line.strip():
+            yield json.loads(line)
+
+
+def run_together_batch(records: List[Dict[str, Any]], output: TextIO, args: argparse.Namespace) -> Optional[int]:
+    """Run the records as a Together batch job, returning the number of failures.
+
+    Returns None, having written nothing, if the account can't use the batch API.
+    """
+    state_file = Path(f'{args.output}.batch')
+    if state_file.exists():
+        job_id = json.loads(state_file.read_text())['job_id']
+        print(f"Resuming batch job {job_id}")
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            input_file = Path(tmp) / 'batch_input.jsonl'
+            input_file.write_text(''.join(json.dumps(batch_line(r, args.model)) + '\n' for r in records))
+            try:
+                uploaded = get_client().files.upload(input_file, purpose='batch-api')
+                job = get_client().batches.create(endpoint='/v1/chat/completions', input_file_id=uploaded.id).job
+            except APIStatusError as e:
+                if e.status_code in (401, 403, 404):
+                    print(f"Together batch API not available ({e.status_code}), running the prompts directly")
+                    return None
+                raise
+        assert job is not None and job.id is not None
+        job_id = job.id
+        state_file.write_text(json.dumps({'job_id': job_id}))
+        print(f"Submitted batch job {job_id} with {len(records)} prompts")
+
+    while True:
+        job = get_client().batches.retrieve(job_id)
+        if job.status in FINAL_BATCH_STATES:
+            break
+        print(f"Batch job {job_id}: {job.status}, {job.progress or 0:.0f}%")
+        time.sleep(args.poll_interval)
+    if job.status != 'COMPLETED':
+        # Start over with a new job on the next run
+        state_file.unlink()
+        raise RuntimeError(f"Batch job {job_id} ended {job.status}: {job.error}")
+
+    models = {r['id']: r['model'] or args.model for r in records}
+    failures = 0
+    for line in batch_results(job.output_file_id):
+        if line['custom_id'] not in models:
+            # Written by an earlier run that stopped while saving the results
+            continue
+        body = line['response']['body']
+        if line['response'].get('status_code', 200) != 200 or not body.get('choices'):
+            write_result(output, {
+                'id': line['custom_id'],
+                'model': models.get(line['custom_id']),
+                'error': (body.get('error') or {}).get('message', json.dumps(body)),
+            })
+            failures += 1
+            continue
+        usage = body.get('usage') or {}
+        write_result(output, {
+            'id': line['custom_id'],
+            'model': models.get(line['custom_id']),
+            'response': body['choices'][0]['message']['content'],
+            'answered_by': body.get('model'),
+            'prompt_tokens': usage.get('prompt_tokens', 0),
+            'completion_tokens': usage.get('completion_tokens', 0),
+        })
+    for line in batch_results(job.error_file_id):
+        if line['custom_id'] not in models:
+            continue
+        error = line.get('error') or line.get('response', {}).get('body', {}).get('error') or {}
+        write_result(output, {
+            'id': line['custom_id'],
+            'model': models.get(line['custom_id']),
+            'error': error.get('message', str(error)),
+        })
+        failures += 1
+    state_file.unlink()
+    return failures
+
+
+def main(args: argparse.Namespace) -> int:
+    done = read_checkpoint(args.output, args.retry_failed)
+    records = [r for r in read_records(args.input, args.id_field, args.prompt_field) if r['id'] not in done]
+    if done:
+        print(f"Skipping {len(done)} prompts already in {args.output}")
+    if not records:
+        print("Nothing to do")
+        return 0
+
+    with args.output.open('a', encoding='utf-8') as output:
+        failures = None
+        if args.together_batch:
+            failures = run_together_batch(records, output, args)
+        if failures is None:
+            try:
+                failures = asyncio.run(run_direct(records, output, args))
+            except KeyboardInterrupt:
+                print("Interrupted, run the same command again to continue")
+                return 130
+    print(f"Wrote {len(records) - failures} responses and {failures} errors to {args.output}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('input', type=Path, help='JSONL file of prompts')
+    parser.add_argument('output', type=Path, help='JSONL file results are appended to')
+    parser.add_argument('--model', default=DEFAULT_MODEL, help='model for lines that don\'t name one')
+    parser.add_argument('--concurrency', type=int, default=8, help='prompts running at once')
+    parser.add_argument('--retry-failed', action='store_true', help='run prompts that failed before again')
+    parser.add_argument('--id-field', default='id', help='field holding the id of a line')
+    parser.add_argument('--prompt-field', default='prompt', help='field holding the prompt of a line')
+    parser.add_argument('--together-batch', action='store_true', help='submit a Together batch job')
+    parser.add_argument('--poll-interval', type=float, default=30, help='seconds between batch job checks')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Benchmark of archiving idle threads, and a check that they come back intact.
+
+Fills a fresh SQLite file with stored turns, leaves `--hot` of the threads
+recently active and runs the retention policy of storage_archive.py on the
+rest: they are moved to zstd segment files and the freed pages are given back
+by incremental vacuum. Reports the time it took, the size of the database
+before and after and the size of the archive, then times opening archived
+threads, which restores them, against reading threads that stayed in the
+database. The exit status is 1 when a restored thread differs from what was
+stored.
+
+    python benchmarks/bench_archive.py --turns 100000
+"""
+
+import argparse
+import asyncio
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from bench_database import collect, populate  # noqa: E402
+from storage_archive import RetentionPolicy  # noqa: E402
+from storage_sqlite import SQLiteDatabase  # noqa: E402
+
+
+def prepare(file: Path, args: argparse.Namespace) -> int:
+    """Store the turns, index them for search and make the last `--hot` threads recently active.
+
+    Returns the number of threads.
+    """
+    populate(file, args.turns, args.turns_per_thread)
+    threads = args.turns // args.turns_per_thread
+    con = sqlite3.connect(str(file))
+    with con:
+        SQLiteDatabase._backfill_search(con)
+        con.execute(
+            'UPDATE thread_summaries SET last_activity = ? WHERE thread_id > ?;',
+            (datetime.now(tz=timezone.utc).isoformat(), threads - int(threads * args.hot)),
+        )
+    con.close()
+    return threads
+
+
+def megabytes(*paths: Path) -> float:
+    return sum(f.stat().st_size for path in paths for f in ([path] if path.is_file() else path.glob('*'))) / 2**20
+
+
+async def read_ms(db: SQLiteDatabase, thread_ids: List[int]) -> float:
+    """Median time to read the latest page of each thread, in milliseconds."""
+    samples = []
+    for thread_id in thread_ids:
+        start = time.perf_counter()
+        await collect(db.get_messages(thread_id))
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+async def main(args: argparse.Namespace) -> int:
+    policy = RetentionPolicy(archive_after_days=1, level=args.level)
+    with tempfile.TemporaryDirectory() as tmp:
+        file = Path(tmp) / 'bench.sqlite'
+        async with SQLiteDatabase.connect(file):
+            pass
+        threads = prepare(file, args)
+        cold = list(range(1, threads - int(threads * args.hot) + 1))
+        hot = list(range(cold[-1] + 1, threads + 1)) or cold
+        sample = cold[::max(1, len(cold) // args.samples)][:args.samples]
+        size_before = megabytes(file)
+
+        async with SQLiteDatabase.connect(file) as db:
+            expected = {thread_id: await collect(db.get_messages(thread_id)) for thread_id in sample}
+            start = time.perf_counter()
+            result = await db.run_retention(policy)
+            elapsed = time.perf_counter() - start
+
+        archive = policy.directory or file.with_suffix('.archive')
+        print(f"{threads} threads of {args.turns_per_thread} turns, {len(cold)} idle")
+        print(f"Archived {result['archived']} threads in {elapsed:.2f}s, freed {result['pages_freed']} pages")
+        print(f"Database {size_before:.1f} MiB before, {megabytes(file):.1f} MiB after,"
+              f" archive {megabytes(archive):.1f} MiB")
+
+        async with SQLiteDatabase.connect(file) as db:
+            hot_ms = await read_ms(db, hot[:args.samples])
+            restore_ms = await read_ms(db, sample)
+            restored = {thread_id: await collect(db.get_messages(thread_id)) for thread_id in sample}
+            again_ms = await read_ms(db, sample)
+        print(f"Latest page of a thread: {hot_ms:.2f} ms never archived, {restore_ms:.2f} ms archived"
+              f" (restoring it), {again_ms:.2f} ms once restored")
+
+    if restored != expected:
+        print("Restored threads differ from the stored ones")
+        return 1
+    print(f"{len(sample)} restored threads match the stored ones")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--turns', type=int, default=20000)
+    parser.add_argument('--turns-per-thread', type=int, default=10)
+    parser.add_argument('--hot', type=float, default=0.1, help='fraction of the threads recently active')
+    parser.add_argument('--samples', type=int, default=50, help='threads read back')
+    parser.add_argument('--level', type=int, default=RetentionPolicy.level, help='zstd compression level')
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the app's cold start: import time, time to ready and first answer.
+
+Imports main.py in fresh interpreters with `python -X importtime` and reports
+the best total and the slowest modules it imports, and checks that the
+modules the app only needs once it serves, like the Together SDK, aren't
+among them. Then starts the app against the fake Together server and times
+how long until GET /ready answers 200, and the first POST /chat/ after it.
+The exit status is 1 when the import took longer than `--budget-ms` or
+imported one of those modules.
+
+    python benchmarks/bench_cold_start.py --budget-ms 600
+
+Pydantic plugins of other installed packages are imported along with
+fastapi, set PYDANTIC_DISABLE_PLUGINS=__all__ to leave them out.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import httpx
+
+THIS_DIR = Path(__file__).parent
+sys.path.insert(0, str(THIS_DIR))
+
+import fake_together  # noqa: E402
+from bench_llm_concurrency import start_fake_server  # noqa: E402
+
+# Imported by the lifespan or on first use, importing main.py must not import them
+LAZY_MODULES = ('together', 'httpx', 'asyncpg')
+
+# "import time:       self [us] |  cumulative | imported package"
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+
+# (cumulative microseconds, depth, module) of each module main.py imported
+Imports = List[Tuple[int, int, str]]
+
+
+def import_main() -> Imports:
+    """The modules importing main.py in a fresh interpreter imported, and their import time."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=THIS_DIR.parent, capture_output=True, text=True, check=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            imports.append((int(match[2]), len(match[3]) // 2, match[4]))
+    # Modules are listed after the ones they import, main.py is the last one
+    main_index = max(i for i, (_, depth, module) in enumerate(imports) if module == 'main' and depth == 0)
+    start = main_index
+    while start > 0 and imports[start - 1][1] > 0:
+        start -= 1
+    return imports[start:main_index + 1]
+
+
+def time_to_ready(args: argparse.Namespace, database: Path) -> Tuple[float, float]:
+    """Seconds from starting the app until GET /ready is 200, and of the first POST /chat/ after it."""
+    env = {
+        **os.environ,
+        'TOGETHER_API_KEY': os.getenv('TOGETHER_API_KEY', 'fake'),
+        'TOGETHER_BASE_URL': f'http://127.0.0.1:{args.port}/v1',
+        'CHAT_DATABASE_URL': f'sqlite:///{database}',
+    }
+    url = f'http://127.0.0.1:{args.app_port}'
+    start = time.perf_counter()
+    app = subprocess.Popen(
+        [sys.executable, 'main.py', '--port', str(args.app_port)],
+        cwd=THIS_DIR.parent, env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            try:
+                if httpx.get(f'{url}/ready', timeout=1).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if app.poll() is not None or time.perf_counter() - start > 30:
+                raise RuntimeError('app did not get ready')
+            time.sleep(0.01)
+        ready = time.perf_counter() - start
+        start = time.perf_counter()
+        httpx.post(f'{url}/chat/', data={'prompt': 'hello', 'model': args.model}, timeout=30).raise_for_status()
+        return ready, time.perf_counter() - start
+    finally:
+        app.terminate()
+        app.wait()
+
+
+def main(args: argparse.Namespace) -> int:
+    # Best of several runs, the first ones also pay for reading the files from disk
+    imports = min((import_main() for _ in range(args.repeat)), key=lambda imports: imports[-1][0])
+    total_ms = imports[-1][0] / 1000
+    print(f"import main: {total_ms:.0f} ms, {len(imports)} modules")
+    print("Slowest modules imported by main.py:")
+    direct = sorted((item for item in imports if item[1] == 1), reverse=True)
+    for cumulative, _, module in direct[:args.top]:
+        print(f"  {module:<30} {cumulative / 1000:>7.1f} ms")
+
+    failed = False
+    lazy = sorted({module for _, _, module in imports if module.split('.')[0] in LAZY_MODULES})
+    if lazy:
+        print(f"Imported modules that should be lazy: {', '.join(lazy)}")
+        failed = True
+    if args.budget_ms and total_ms > args.budget_ms:
+        print(f"Import time is over the budget of {args.budget_ms:.0f} ms")
+        failed = True
+
+    if not args.skip_ready:
+        fake_server = start_fake_server(args)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                ready, first_chat = time_to_ready(args, Path(tmp) / 'bench_cold_start.sqlite')
+        finally:
+            fake_server.terminate()
+        print(f"Process start to ready: {ready * 1000:.0f} ms, first POST /chat/: {first_chat * 1000:.0f} ms")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--budget-ms', type=float, default=0, help='maximum import time of main.py, 0 for none')
+    parser.add_argument('--repeat', type=int, default=5, help='imports timed, the best is shown')
+    parser.add_argument('--top', type=int, default=10, help='slowest modules shown')
+    parser.add_argument('--skip-ready', action='store_true', help='only time the import')
+    parser.add_argument('--model', default='microsoft/WizardLM-2-8x22B')
+    parser.add_argument('--port', type=int, default=9007, help='port of the fake Together server')
+    parser.add_argument('--app-port', type=int, default=8007)
+    fake_together.add_arguments(parser)
+    parser.set_defaults(first_token_latency=0.01, tokens=5, token_interval=0)
+    sys.exit(main(parser.parse_args()))
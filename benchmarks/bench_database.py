@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the `SQLiteDatabase` read and write paths as the store grows.
+
+Fills fresh SQLite files with increasing numbers of stored turns (a user
+message plus a model answer) and times the queries behind GET /chat/,
+GET /threads/, POST /chat/ history loading and the write at the end of a
+POST, as well as the history and write of an edit, which starts a new branch.
+With the indexed threads/messages schema, per-thread operations should
+stay flat as the total size grows.
+
+    python benchmarks/bench_database.py --sizes 1000 10000 100000
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from chat_message import Message  # noqa: E402
+from storage_sqlite import SQLiteDatabase  # noqa: E402
+
+
+def populate(file: Path, turns: int, turns_per_thread: int):
+    """Write `turns` user/model pairs directly with SQL, grouped into threads."""
+    import sqlite3
+
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    con = sqlite3.connect(str(file))
+    with con:
+        threads = []
+        messages = []
+        for thread_id in range(1, turns // turns_per_thread + 1):
+            created = start + timedelta(minutes=thread_id)
+            threads.append((thread_id, created.isoformat()))
+            for turn in range(turns_per_thread):
+                ts = created + timedelta(seconds=turn * 2)
+                messages.append((thread_id, turn * 2, 'user', ts.isoformat(), f'question {turn} in thread {thread_id}'))
+                messages.append((thread_id, turn * 2 + 1, 'model', (ts + timedelta(seconds=1)).isoformat(), 'an answer ' * 20))
+        con.executemany('INSERT INTO threads (id, created_at) VALUES (?, ?);', threads)
+        con.executemany(
+            'INSERT INTO messages (thread_id, seq, role, timestamp, content) VALUES (?, ?, ?, ?, ?);',
+            messages,
+        )
+        SQLiteDatabase._link_parents(con)
+        SQLiteDatabase._backfill_thread_summaries(con)
+    con.close()
+
+
+def last_prompt_id(file: Path, thread_id: int) -> int:
+    """Id of the last user message of a thread, the one edited by the benchmark."""
+    import sqlite3
+
+    con = sqlite3.connect(str(file))
+    try:
+        return con.execute(
+            "SELECT MAX(id) FROM messages WHERE thread_id = ? AND role = 'user';", (thread_id,)
+        ).fetchone()[0]
+    finally:
+        con.close()
+
+
+async def collect(rows) -> list:
+    """Consume one of the paginated readers, like the streaming endpoints do."""
+    return [row async for row in rows]
+
+
+async def timed(func, repeat: int) -> float:
+    """Median wall time of `repeat` calls to the coroutine function, in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+async def bench_size(turns: int, args: argparse.Namespace) -> dict[str, float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        file = Path(tmp) / 'bench.sqlite'
+        async with SQLiteDatabase.connect(file):
+            pass
+        populate(file, turns, args.turns_per_thread)
+        thread_id = max(1, turns // args.turns_per_thread // 2)
+        edit_id = last_prompt_id(file, thread_id)
+        now = datetime.now(tz=timezone.utc).isoformat()
+        new_turn = [Message('user', 'hello', now), Message('model', 'hi', now)]
+        async with SQLiteDatabase.connect(file) as db:
+            return {
+                'thread messages': await timed(lambda: collect(db.get_messages(thread_id)), args.repeat),
+                'latest messages': await timed(lambda: collect(db.get_messages()), args.repeat),
+                'threads page': await timed(lambda: collect(db.get_threads()), args.repeat),
+                'chat history': await timed(lambda: db.get_chat_history(thread_id), args.repeat),
+                'add turn': await timed(lambda: db.add_messages(new_turn, thread_id), args.repeat),
+                'edit history': await timed(lambda: db.get_chat_history(thread_id, edit_id), args.repeat),
+                'edit turn': await timed(lambda: db.add_messages(new_turn, thread_id, edit_id=edit_id), args.repeat),
+            }
+
+
+async def main(args: argparse.Namespace):
+    results = {turns: await bench_size(turns, args) for turns in args.sizes}
+    names = list(next(iter(results.values())))
+    print(f"{'stored turns':>14}" + ''.join(f'{name:>18}' for name in names))
+    for turns, timings in results.items():
+        print(f'{turns:>14}' + ''.join(f'{timings[name]:>15.2f} ms' for name in names))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--turns-per-thread', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
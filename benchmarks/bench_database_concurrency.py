@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmark of concurrent reads and writes against `SQLiteDatabase`.
+
+Reader tasks run the queries behind GET /chat/, GET /threads/ and POST /chat/
+history loading in a loop while writer tasks append turns to random threads.
+The same read load is measured without writers and then with them, so the
+report shows how much writes slow reads down. With WAL and the reader pool
+read latency should barely move, and group commit keeps write throughput up
+as writers are added.
+
+    python benchmarks/bench_database_concurrency.py --readers 16 --writers 8
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from chat_message import Message  # noqa: E402
+from storage_sqlite import SQLiteDatabase  # noqa: E402
+from bench_database import collect, populate  # noqa: E402
+
+
+def percentiles(samples: list[float]) -> tuple[float, float, float]:
+    """p50, p95 and p99 of latencies in seconds, in milliseconds."""
+    if len(samples) < 2:
+        return (samples[0] * 1000,) * 3 if samples else (0.0, 0.0, 0.0)
+    cuts = statistics.quantiles(samples, n=100)
+    return cuts[49] * 1000, cuts[94] * 1000, cuts[98] * 1000
+
+
+async def reader(db: SQLiteDatabase, threads: int, deadline: float, latencies: list[float]):
+    while time.perf_counter() < deadline:
+        thread_id = random.randint(1, threads)
+        query = random.choice((
+            lambda: collect(db.get_messages(thread_id)),
+            lambda: collect(db.get_threads()),
+            lambda: db.get_chat_history(thread_id),
+        ))
+        start = time.perf_counter()
+        await query()
+        latencies.append(time.perf_counter() - start)
+
+
+async def writer(db: SQLiteDatabase, threads: int, deadline: float, latencies: list[float]):
+    while time.perf_counter() < deadline:
+        now = datetime.now(tz=timezone.utc).isoformat()
+        turn = [Message('user', 'a new question', now), Message('model', 'an answer ' * 20, now)]
+        start = time.perf_counter()
+        await db.add_messages(turn, random.randint(1, threads), 'bench-model')
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_phase(db: SQLiteDatabase, threads: int, readers: int, writers: int, duration: float) -> dict[str, float]:
+    read_latencies: list[float] = []
+    write_latencies: list[float] = []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(
+        *(reader(db, threads, deadline, read_latencies) for _ in range(readers)),
+        *(writer(db, threads, deadline, write_latencies) for _ in range(writers)),
+    )
+    read_p50, read_p95, read_p99 = percentiles(read_latencies)
+    write_p50, _, write_p99 = percentiles(write_latencies)
+    return {
+        'reads/s': len(read_latencies) / duration,
+        'read p50': read_p50,
+        'read p95': read_p95,
+        'read p99': read_p99,
+        'writes/s': len(write_latencies) / duration,
+        'write p50': write_p50,
+        'write p99': write_p99,
+    }
+
+
+async def main(args: argparse.Namespace):
+    threads = args.turns // args.turns_per_thread
+    with tempfile.TemporaryDirectory() as tmp:
+        file = Path(tmp) / 'bench.sqlite'
+        async with SQLiteDatabase.connect(file):
+            pass
+        populate(file, args.turns, args.turns_per_thread)
+        async with SQLiteDatabase.connect(file, readers=args.pool) as db:
+            results = {
+                'reads only': await run_phase(db, threads, args.readers, 0, args.duration),
+                'reads + writes': await run_phase(db, threads, args.readers, args.writers, args.duration),
+            }
+
+    print(f'{args.readers} readers, {args.writers} writers, {args.pool} read connections, {args.turns} stored turns')
+    names = list(next(iter(results.values())))
+    print(f"{'':>16}" + ''.join(f'{name:>12}' for name in names))
+    for phase, values in results.items():
+        cells = ''.join(
+            f'{values[name]:>12.0f}' if name.endswith('/s') else f'{values[name]:>9.2f} ms'
+            for name in names
+        )
+        print(f'{phase:>16}{cells}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--turns', type=int, default=100000)
+    parser.add_argument('--turns-per-thread', type=int, default=10)
+    parser.add_argument('--readers', type=int, default=16, help='concurrent reading tasks')
+    parser.add_argument('--writers', type=int, default=8, help='concurrent writing tasks')
+    parser.add_argument('--pool', type=int, default=4, help='read-only connections in the pool')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per phase')
+    asyncio.run(main(parser.parse_args()))
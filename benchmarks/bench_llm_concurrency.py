@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Load benchmark for the async Together client against the local fake server.
+
+Runs many streamed generations at once through a single `create_async_client()`
+client, the way one uvicorn worker does, and reports wall time, time to first
+token and how many OS threads the process needed.
+
+    python benchmarks/bench_llm_concurrency.py --concurrency 300
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+THIS_DIR = Path(__file__).parent
+sys.path.insert(0, str(THIS_DIR.parent))
+sys.path.insert(0, str(THIS_DIR))
+
+import fake_together  # noqa: E402
+
+
+def start_fake_server(args: argparse.Namespace) -> subprocess.Popen:
+    """Run the fake Together server in its own process and wait until it accepts connections."""
+    proc = subprocess.Popen([
+        sys.executable, str(THIS_DIR / 'fake_together.py'),
+        '--port', str(args.port),
+        *fake_together.arguments(args),
+    ])
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', args.port), timeout=0.1).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.terminate()
+    raise RuntimeError('fake Together server did not start')
+
+
+async def run_generation(llm, results: list):
+    import together_model
+
+    start = time.perf_counter()
+    first_token = None
+    async for _ in together_model.chat_completion_stream(llm, 'Hello', None, 'fake-model'):
+        if first_token is None:
+            first_token = time.perf_counter() - start
+    results.append((first_token, time.perf_counter() - start))
+
+
+async def main(args: argparse.Namespace):
+    os.environ['TOGETHER_BASE_URL'] = f'http://127.0.0.1:{args.port}/v1'
+    import together_model
+
+    results: list = []
+    peak_threads = threading.active_count()
+    async with together_model.create_async_client() as llm:
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(run_generation(llm, results)) for _ in range(args.concurrency)]
+        while not all(t.done() for t in tasks):
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - start
+
+    first_tokens = sorted(r[0] for r in results)
+    totals = sorted(r[1] for r in results)
+    print(f'generations:        {len(results)}')
+    print(f'wall time:          {wall:.2f}s')
+    print(f'ttft p50 / p95:     {statistics.median(first_tokens):.3f}s / {first_tokens[int(len(first_tokens) * 0.95) - 1]:.3f}s')
+    print(f'total p50 / p95:    {statistics.median(totals):.3f}s / {totals[int(len(totals) * 0.95) - 1]:.3f}s')
+    print(f'peak OS threads:    {peak_threads}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--concurrency', type=int, default=300)
+    parser.add_argument('--port', type=int, default=9002)
+    fake_together.add_arguments(parser)
+    args = parser.parse_args()
+    fake_server = start_fake_server(args)
+    try:
+        asyncio.run(main(args))
+    finally:
+        fake_server.terminate()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the conversions a stored message goes through, and a check that
+a thread's history reaches the Together request.
+
+Times turning a page of database rows into what storage returns, then into
+lines of the GET /chat/ response and into messages of the Together request,
+and the memory the results hold, with the `Message` type of chat_message.py
+and with the dicts and `json` the app used before it. Then starts the app and
+the fake Together server, sends two prompts in one thread and checks that the
+second request to the fake server carried the first exchange. The exit status
+is 1 when it didn't.
+
+    python benchmarks/bench_messages.py --messages 1000
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import httpx
+
+THIS_DIR = Path(__file__).parent
+sys.path.insert(0, str(THIS_DIR.parent))
+sys.path.insert(0, str(THIS_DIR))
+
+import fake_together  # noqa: E402
+from bench_llm_concurrency import start_fake_server  # noqa: E402
+from chat_message import Message  # noqa: E402
+from load_test import start_app  # noqa: E402
+
+Row = Tuple[int, str, str, str, int]
+
+
+def rows(count: int) -> List[Row]:
+    """Rows as read from the messages table: id, role, timestamp, content and token count."""
+    return [
+        (i, 'user' if i % 2 else 'model', f'2025-01-01T00:00:{i % 60:02d}+00:00', f'message {i} ' * 20, 50)
+        for i in range(count)
+    ]
+
+
+def load_dict(row: Row) -> dict:
+    message_id, role, timestamp, content, tokens = row
+    return {'role': role, 'timestamp': timestamp, 'content': content, 'id': message_id, 'tokens': tokens}
+
+
+def load_message(row: Row) -> Message:
+    message_id, role, timestamp, content, tokens = row
+    return Message(role, content, timestamp, message_id, tokens)  # type: ignore[arg-type]
+
+
+def line_of_dict(message: dict) -> bytes:
+    return json.dumps({k: message[k] for k in ('role', 'timestamp', 'content', 'id')}).encode('utf-8') + b'\n'
+
+
+def together_of_dict(message: dict) -> dict:
+    return {'role': 'user' if message['role'] == 'user' else 'assistant', 'content': message['content']}
+
+
+# Per representation: what storage makes of a row, and the conversions to a
+# GET /chat/ line and to a message of the Together request
+PATHS = {
+    'dicts + json': (load_dict, line_of_dict, together_of_dict),
+    'Message + orjson': (load_message, Message.to_line, Message.to_together),
+}
+
+
+def timed(convert: Callable, items: list) -> Tuple[list, float]:
+    """The converted items, and the microseconds per item it took."""
+    start = time.perf_counter()
+    converted = [convert(item) for item in items]
+    return converted, (time.perf_counter() - start) / len(items) * 1e6
+
+
+def measure(load: Callable, to_line: Callable, to_together: Callable, data: List[Row]) -> Dict[str, float]:
+    """Microseconds per message of each step, and the bytes per message that storage and the lines hold.
+
+    Strings are shared with the rows, so only the containers count. Sizes come from
+    `sys.getsizeof` because tracemalloc also counts orjson's scratch buffer, which it shrinks.
+    """
+    messages, load_us = timed(load, data)
+    lines, line_us = timed(to_line, messages)
+    _, together_us = timed(to_together, messages)
+    return {
+        'load_us': load_us,
+        'line_us': line_us,
+        'together_us': together_us,
+        'message_bytes': sum(map(sys.getsizeof, messages)) / len(data),
+        'line_bytes': sum(map(sys.getsizeof, lines)) / len(data),
+    }
+
+
+def check_history(args: argparse.Namespace) -> bool:
+    """Send two prompts in one thread through the app, True if the second request carried the first exchange."""
+    fake_server = start_fake_server(args)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            app = start_app(args.app_port, args.port, Path(tmp) / 'bench_messages.sqlite')
+            try:
+                url = f'http://127.0.0.1:{args.app_port}'
+                first = httpx.post(f'{url}/chat/', data={'prompt': 'first prompt', 'model': args.model}, timeout=30)
+                final = json.loads(first.text.splitlines()[-1])
+                httpx.post(
+                    f'{url}/chat/',
+                    data={'prompt': 'second prompt', 'model': args.model, 'thread_id': final['thread_id']},
+                    timeout=30,
+                )
+                sent = httpx.get(f'http://127.0.0.1:{args.port}/stats').json()['last_messages']
+            finally:
+                app.terminate()
+                app.wait()
+    finally:
+        fake_server.terminate()
+
+    expected = [('user', 'first prompt'), ('assistant', final['content']), ('user', 'second prompt')]
+    received = [(m['role'], m['content']) for m in sent if m['role'] != 'system']
+    print(f"Upstream request of the second prompt: {[role for role, _ in received]}")
+    return received == expected
+
+
+def main(args: argparse.Namespace) -> int:
+    data = rows(args.messages)
+    print(f"{'representation':<18} {'row us':>8} {'line us':>8} {'together us':>12} {'bytes held':>11} {'line bytes':>11}")
+    for name, steps in PATHS.items():
+        # Best of many runs, the first ones warm up the allocator
+        best = min((measure(*steps, data) for _ in range(args.repeat)), key=lambda r: r['load_us'] + r['line_us'])
+        print(f"{name:<18} {best['load_us']:>8.2f} {best['line_us']:>8.2f} {best['together_us']:>12.2f} "
+              f"{best['message_bytes']:>11.0f} {best['line_bytes']:>11.0f}")
+
+    if args.skip_history:
+        return 0
+    if not check_history(args):
+        print("History did not reach the upstream request")
+        return 1
+    print("History reached the upstream request")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=1000, help='messages converted per run, a page by default')
+    parser.add_argument('--repeat', type=int, default=200, help='runs of the conversion benchmark, the best is shown')
+    parser.add_argument('--skip-history', action='store_true', help='only run the conversion benchmark')
+    parser.add_argument('--model', default='microsoft/WizardLM-2-8x22B')
+    parser.add_argument('--port', type=int, default=9006, help='port of the fake Together server')
+    parser.add_argument('--app-port', type=int, default=8006)
+    fake_together.add_arguments(parser)
+    parser.set_defaults(first_token_latency=0.01, tokens=5, token_interval=0)
+    sys.exit(main(parser.parse_args()))
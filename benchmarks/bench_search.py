@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Latency of GET /search/ queries as the number of stored messages grows.
+
+Fills fresh SQLite files with generated messages whose words follow a Zipf
+distribution like natural text, builds the full-text index the way the
+one-time backfill does, and times `SQLiteDatabase.search_messages` for a rare
+word, a common word, two words and a prefix, fetching the first page.
+
+    python benchmarks/bench_search.py --sizes 100000 1000000
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from bench_database import collect, timed  # noqa: E402
+from storage_sqlite import SQLiteDatabase  # noqa: E402
+
+# Size of the generated vocabulary, word i is about i times less frequent than word 1
+VOCABULARY = 50000
+
+
+def word(rank: int) -> str:
+    return f'w{rank}x'
+
+
+def populate(file: Path, messages: int, per_thread: int, words: int, seed: int = 0):
+    """Write `messages` generated messages directly with SQL, then index them."""
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, VOCABULARY + 1)))
+    ranks = range(1, VOCABULARY + 1)
+    con = sqlite3.connect(str(file))
+    with con:
+        threads = messages // per_thread
+        con.executemany(
+            'INSERT INTO threads (id, created_at) VALUES (?, ?);',
+            ((thread_id, '2025-01-01T00:00:00+00:00') for thread_id in range(1, threads + 1)),
+        )
+        rows = []
+        for i in range(threads * per_thread):
+            thread_id, seq = divmod(i, per_thread)
+            content = ' '.join(map(word, rng.choices(ranks, cum_weights=cum_weights, k=words)))
+            rows.append((thread_id + 1, seq, 'user' if seq % 2 == 0 else 'model', '2025-01-01T00:00:00+00:00', content))
+            if len(rows) == 10000:
+                con.executemany(
+                    'INSERT INTO messages (thread_id, seq, role, timestamp, content) VALUES (?, ?, ?, ?, ?);', rows
+                )
+                rows = []
+        con.executemany('INSERT INTO messages (thread_id, seq, role, timestamp, content) VALUES (?, ?, ?, ?, ?);', rows)
+        SQLiteDatabase._link_parents(con)
+        SQLiteDatabase._backfill_thread_summaries(con)
+        SQLiteDatabase._backfill_search(con)
+    con.close()
+
+
+async def bench_size(messages: int, args: argparse.Namespace) -> dict[str, float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        file = Path(tmp) / 'bench.sqlite'
+        async with SQLiteDatabase.connect(file):
+            pass
+        populate(file, messages, args.messages_per_thread, args.words)
+        queries = {
+            # About one message in a thousand has it
+            'rare word': word(VOCABULARY // 4),
+            # In most messages
+            'common word': word(2),
+            'two words': f'{word(10)} {word(100)}',
+            'prefix': 'w123*',
+        }
+        async with SQLiteDatabase.connect(file) as db:
+            return {
+                name: await timed(lambda: collect(db.search_messages(query)), args.repeat)
+                for name, query in queries.items()
+            }
+
+
+async def main(args: argparse.Namespace):
+    results = {messages: await bench_size(messages, args) for messages in args.sizes}
+    names = list(next(iter(results.values())))
+    print(f"{'messages':>10}" + ''.join(f'{name:>16}' for name in names))
+    for messages, timings in results.items():
+        print(f'{messages:>10}' + ''.join(f'{timings[name]:>13.2f} ms' for name in names))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--messages-per-thread', type=int, default=20)
+    parser.add_argument('--words', type=int, default=40, help='words per message')
+    parser.add_argument('--repeat', type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
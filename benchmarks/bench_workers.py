@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Throughput of the app with one worker process against several.
+
+Starts the fake Together server, then runs `python main.py --workers N` on a
+fresh SQLite file for each worker count given, and drives it with concurrent
+sessions that each post a chat message, reload the thread list and read the
+thread back, see load_test.py. Reports answered messages per second, memory
+and request latencies.
+
+    python benchmarks/bench_workers.py --workers 1 4 --sessions 64
+"""
+
+import argparse
+import asyncio
+import sys
+import tempfile
+from pathlib import Path
+
+THIS_DIR = Path(__file__).parent
+sys.path.insert(0, str(THIS_DIR))
+
+import fake_together  # noqa: E402
+from bench_llm_concurrency import start_fake_server  # noqa: E402
+from load_test import run_users, start_app  # noqa: E402
+
+
+def main(args: argparse.Namespace):
+    fake_server = start_fake_server(args)
+    try:
+        rows = []
+        for workers in args.workers:
+            with tempfile.TemporaryDirectory() as tmp:
+                app = start_app(args.app_port, args.port, Path(tmp) / 'bench.sqlite', workers)
+                try:
+                    url = f'http://127.0.0.1:{args.app_port}'
+                    rows.append((workers, asyncio.run(run_users(url, args.sessions, args.duration, app_pid=app.pid))))
+                finally:
+                    app.terminate()
+                    app.wait()
+    finally:
+        fake_server.terminate()
+
+    print(f'{args.sessions} sessions for {args.duration:.0f}s, fake first token {args.first_token_latency}s, '
+          f'{args.tokens} tokens every {args.token_interval}s')
+    names = list(rows[0][1]['endpoints'])
+    print(f"{'workers':>8}{'sessions/s':>12}{'memory':>10}" + ''.join(f'{name + " p50/p95":>28}' for name in names))
+    for workers, results in rows:
+        endpoints = results['endpoints']
+        cells = ''.join(f"{endpoints[name]['p50 ms']:>17.1f} / {endpoints[name]['p95 ms']:>6.1f} ms" for name in names)
+        memory = f"{results['peak rss mb']:.0f} MiB" if results['peak rss mb'] is not None else 'n/a'
+        print(f"{workers:>8}{endpoints['POST /chat/']['rps']:>12.1f}{memory:>10}{cells}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4], help='worker counts to compare')
+    parser.add_argument('--sessions', type=int, default=64, help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds of load per worker count')
+    parser.add_argument('--port', type=int, default=9003, help='port of the fake Together server')
+    parser.add_argument('--app-port', type=int, default=8003)
+    fake_together.add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Together chat completions API.
+
+Serves `POST /v1/chat/completions` in the same shape as Together (and OpenAI),
+both streaming and non-streaming, and the file and batch job endpoints used by
+`batch.py --together-batch`, so the app, batch.py and the benchmarks can run
+without spending API credits. Point them at it with:
+
+    python benchmarks/fake_together.py --port 9001
+    export TOGETHER_BASE_URL=http://127.0.0.1:9001/v1
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+import fastapi
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+
+@dataclass
+class FakeSettings:
+    """How the fake server behaves, adjustable from the command line."""
+
+    first_token_latency: float = 0.2
+    # Each request's first token latency is drawn uniformly within +/- this fraction of it
+    jitter: float = 0
+    token_interval: float = 0.02
+    tokens: int = 50
+    # Requests per second allowed before answering 429, 0 for no limit
+    rate_limit: float = 0
+    # Fraction of requests answered with a 500 error
+    error_rate: float = 0
+
+
+settings = FakeSettings()
+app = fastapi.FastAPI()
+
+# Token bucket enforcing `settings.rate_limit`, holding up to one second of requests
+_bucket = {'tokens': float('inf'), 'updated': time.monotonic()}
+# `disconnects` counts streams the client closed before they were complete, and
+# `last_messages` are the messages of the latest chat completion request
+stats = {'requests': 0, 'rate_limited': 0, 'errors': 0, 'disconnects': 0, 'last_messages': []}
+
+
+def _rate_limited() -> bool:
+    if not settings.rate_limit:
+        return False
+    now = time.monotonic()
+    capacity = max(1.0, settings.rate_limit)
+    _bucket['tokens'] = min(capacity, _bucket['tokens'] + (now - _bucket['updated']) * settings.rate_limit)
+    _bucket['updated'] = now
+    if _bucket['tokens'] < 1:
+        return True
+    _bucket['tokens'] -= 1
+    return False
+
+
+def _usage(body: dict) -> dict:
+    # Four bytes per token, roughly
+    prompt_tokens = sum(len(m.get('content') or '') for m in body.get('messages', [])) // 4
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': settings.tokens,
+            'total_tokens': prompt_tokens + settings.tokens}
+
+
+def _chunk(model: str, content: str | None, finish_reason: str | None = None, usage: dict | None = None) -> bytes:
+    delta = {'role': 'assistant', 'content': content} if content is not None else {}
+    chunk = {
+        'id': 'fake',
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+    }
+    if usage is not None:
+        # Like Together, the usage comes with the last chunk
+        chunk['usage'] = usage
+    return f'data: {json.dumps(chunk)}\n\n'.encode('utf-8')
+
+
+@app.post('/v1/chat/completions')
+async def chat_completions(request: fastapi.Request):
+    body = await request.json()
+    model = body.get('model', 'fake-model')
+    stats['requests'] += 1
+    stats['last_messages'] = body.get('messages', [])
+    if _rate_limited():
+        stats['rate_limited'] += 1
+        return JSONResponse(
+            {'error': {'message': 'Rate limit exceeded', 'type': 'rate_limit'}},
+            status_code=429,
+            headers={'Retry-After': '1'},
+        )
+    if random.random() < settings.error_rate:
+        stats['errors'] += 1
+        return JSONResponse(
+            {'error': {'message': 'Injected failure', 'type': 'server_error'}},
+            status_code=500,
+        )
+    words = [f'token{i} ' for i in range(settings.tokens)]
+    first_token_latency = settings.first_token_latency * random.uniform(1 - settings.jitter, 1 + settings.jitter)
+
+    if body.get('stream'):
+        async def stream():
+            try:
+                await asyncio.sleep(first_token_latency)
+                for word in words:
+                    yield _chunk(model, word)
+                    await asyncio.sleep(settings.token_interval)
+                yield _chunk(model, None, 'stop', _usage(body))
+                yield b'data: [DONE]\n\n'
+            except (asyncio.CancelledError, GeneratorExit):
+                stats['disconnects'] += 1
+                raise
+
+        return StreamingResponse(stream(), media_type='text/event-stream')
+
+    await asyncio.sleep(first_token_latency + settings.token_interval * settings.tokens)
+    return JSONResponse({
+        'id': 'fake',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': ''.join(words)},
+            'finish_reason': 'stop',
+        }],
+        'usage': _usage(body),
+    })
+
+
+# Uploaded files and batch jobs, by id
+files: dict[str, bytes] = {}
+batches: dict[str, dict] = {}
+_batch_tasks: set[asyncio.Task] = set()
+
+
+@app.post('/v1/files')
+async def create_file(request: fastapi.Request):
+    """First step of an upload, like Together: redirect to where the content goes."""
+    file_id = f'file-{uuid.uuid4().hex}'
+    return Response(status_code=302, headers={
+        'Location': str(request.url_for('put_file', file_id=file_id)),
+        'X-Together-File-Id': file_id,
+    })
+
+
+@app.put('/fake-uploads/{file_id}')
+async def put_file(file_id: str, request: fastapi.Request):
+    files[file_id] = await request.body()
+    return Response(status_code=200)
+
+
+@app.post('/v1/files/{file_id}/preprocess')
+async def preprocess_file(file_id: str):
+    return {
+        'id': file_id, 'object': 'file', 'bytes': len(files[file_id]), 'created_at': int(time.time()),
+        'filename': f'{file_id}.jsonl', 'FileType': 'jsonl', 'Processed': True, 'purpose': 'batch-api',
+    }
+
+
+@app.get('/v1/files/{file_id}/content')
+async def file_content(file_id: str):
+    if file_id not in files:
+        return JSONResponse({'error': {'message': 'File not found'}}, status_code=404)
+    return Response(files[file_id], media_type='application/octet-stream')
+
+
+async def _run_batch(job: dict):
+    """Answer every request of a batch job, `settings.error_rate` of them with an error."""
+    job['status'] = 'IN_PROGRESS'
+    lines = [json.loads(line) for line in files[job['input_file_id']].splitlines() if line.strip()]
+    outputs, errors = [], []
+    for i, line in enumerate(lines):
+        await asyncio.sleep(settings.first_token_latency)
+        if random.random() < settings.error_rate:
+            errors.append({'custom_id': line['custom_id'], 'error': {'message': 'Injected failure'}})
+        else:
+            outputs.append({'custom_id': line['custom_id'], 'response': {'status_code': 200, 'body': {
+                'id': 'fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': line['body']['model'],
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {
+                    'role': 'assistant', 'content': ''.join(f'token{i} ' for i in range(settings.tokens)),
+                }}],
+                'usage': _usage(line['body']),
+            }}})
+        job['progress'] = 100 * (i + 1) / len(lines)
+    for key, results in (('output_file_id', outputs), ('error_file_id', errors)):
+        if results:
+            file_id = f'file-{uuid.uuid4().hex}'
+            files[file_id] = b''.join(json.dumps(result).encode('utf-8') + b'\n' for result in results)
+            job[key] = file_id
+    job['status'] = 'COMPLETED'
+    job['completed_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+
+@app.post('/v1/batches')
+async def create_batch(request: fastapi.Request):
+    body = await request.json()
+    if body.get('input_file_id') not in files:
+        return JSONResponse({'error': {'message': 'Input file not found'}}, status_code=404)
+    job = {
+        'id': f'batch-{uuid.uuid4().hex}', 'status': 'VALIDATING', 'endpoint': body['endpoint'],
+        'input_file_id': body['input_file_id'], 'progress': 0,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+    batches[job['id']] = job
+    task = asyncio.create_task(_run_batch(job))
+    _batch_tasks.add(task)
+    task.add_done_callback(_batch_tasks.discard)
+    return {'job': job}
+
+
+@app.get('/v1/batches/{batch_id}')
+async def get_batch(batch_id: str):
+    if batch_id not in batches:
+        return JSONResponse({'error': {'message': 'Batch not found'}}, status_code=404)
+    return batches[batch_id]
+
+
+@app.get('/stats')
+async def get_stats():
+    """Counters of the requests the fake server received."""
+    return stats
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the fake server's behaviour options to an argument parser."""
+    parser.add_argument('--first-token-latency', type=float, default=settings.first_token_latency)
+    parser.add_argument('--jitter', type=float, default=settings.jitter,
+                        help='spread of the first token latency, as a fraction of it')
+    parser.add_argument('--token-interval', type=float, default=settings.token_interval)
+    parser.add_argument('--tokens', type=int, default=settings.tokens)
+    parser.add_argument('--rate-limit', type=float, default=settings.rate_limit,
+                        help='requests per second before answering 429, 0 for no limit')
+    parser.add_argument('--error-rate', type=float, default=settings.error_rate,
+                        help='fraction of requests answered with a 500 error')
+
+
+def configure(args: argparse.Namespace):
+    """Apply parsed command line options to the fake server."""
+    settings.first_token_latency = args.first_token_latency
+    settings.jitter = args.jitter
+    settings.token_interval = args.token_interval
+    settings.tokens = args.tokens
+    settings.rate_limit = args.rate_limit
+    settings.error_rate = args.error_rate
+
+
+def arguments(args: argparse.Namespace) -> list[str]:
+    """Command line flags reproducing parsed options, to start the fake server in another process."""
+    return [
+        '--first-token-latency', str(args.first_token_latency),
+        '--jitter', str(args.jitter),
+        '--token-interval', str(args.token_interval),
+        '--tokens', str(args.tokens),
+        '--rate-limit', str(args.rate_limit),
+        '--error-rate', str(args.error_rate),
+    ]
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9001)
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure(args)
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
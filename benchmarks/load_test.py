@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Load test of the app's endpoints against the fake Together server.
+
+Simulated users each open the page, then send a few messages to a new thread
+with some think time in between, refreshing the thread list and reading their
+thread back after each answer like chat_app.ts does. Reports per endpoint
+requests per second, p50/p95/p99 latency, time to first byte and errors, the
+time to first token of POST /chat/, and the app's peak memory.
+
+    python benchmarks/load_test.py --users 50 --duration 30 --save baseline.json
+    python benchmarks/load_test.py --users 50 --duration 30 --compare baseline.json
+
+With `--compare` the exit status is 1 when a latency grew, or a request rate
+dropped, by more than `--tolerance` against the saved run. The app and the fake
+server are started with a fresh SQLite file; `--url` targets an app that is
+already running instead, without memory figures.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+THIS_DIR = Path(__file__).parent
+sys.path.insert(0, str(THIS_DIR))
+
+import fake_together  # noqa: E402
+from bench_llm_concurrency import start_fake_server  # noqa: E402
+
+# Endpoints in the order they're reported
+ENDPOINTS = ('POST /chat/', 'GET /threads/', 'GET /chat/')
+
+
+@dataclass
+class EndpointStats:
+    """Timings of the requests to one endpoint, in seconds."""
+
+    latencies: List[float] = field(default_factory=list)
+    first_bytes: List[float] = field(default_factory=list)
+    # Only for POST /chat/: until the first line of the model's answer
+    first_tokens: List[float] = field(default_factory=list)
+    errors: int = 0
+
+
+def percentiles(samples: List[float]) -> tuple[float, float, float]:
+    """p50, p95 and p99 of latencies in seconds, in milliseconds."""
+    if len(samples) < 2:
+        return (samples[0] * 1000,) * 3 if samples else (0.0, 0.0, 0.0)
+    cuts = statistics.quantiles(samples, n=100)
+    return cuts[49] * 1000, cuts[94] * 1000, cuts[98] * 1000
+
+
+def start_app(port: int, fake_port: int, database: Path, workers: int = 1) -> subprocess.Popen:
+    """Run `python main.py` against the fake server and wait until it answers."""
+    env = {
+        **os.environ,
+        'TOGETHER_API_KEY': os.getenv('TOGETHER_API_KEY', 'fake'),
+        'TOGETHER_BASE_URL': f'http://127.0.0.1:{fake_port}/v1',
+        'CHAT_DATABASE_URL': f'sqlite:///{database}',
+        # The fake server has no limits, keep the scheduler from being the bottleneck
+        'TOGETHER_MAX_IN_FLIGHT': '10000',
+        'TOGETHER_RATE_LIMIT_RPM': '0',
+        'TOGETHER_MAX_QUEUE': '10000',
+    }
+    proc = subprocess.Popen(
+        [sys.executable, 'main.py', '--workers', str(workers), '--port', str(port)],
+        cwd=THIS_DIR.parent, env=env, stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f'http://127.0.0.1:{port}/models/', timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError('app did not start')
+
+
+def process_tree_rss(pid: int) -> Optional[int]:
+    """Resident memory in bytes of a process and its descendants, None where /proc isn't available."""
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        proc_dir = Path('/proc') / str(current)
+        try:
+            status = (proc_dir / 'status').read_text()
+            for task in (proc_dir / 'task').iterdir():
+                pids.extend(int(child) for child in (task / 'children').read_text().split())
+        except OSError:
+            if current == pid:
+                return None
+            continue
+        for line in status.splitlines():
+            if line.startswith('VmRSS:'):
+                total += int(line.split()[1]) * 1024
+    return total
+
+
+async def request(
+    client: httpx.AsyncClient, stats: EndpointStats, method: str, url: str, **kwargs: Any
+) -> Optional[bytes]:
+    """Send a request, recording its timings, and return the body or None on errors."""
+    start = time.perf_counter()
+    first_byte = first_token = None
+    body = b''
+    try:
+        async with client.stream(method, url, **kwargs) as response:
+            async for chunk in response.aiter_raw():
+                now = time.perf_counter()
+                if first_byte is None:
+                    first_byte = now - start
+                if first_token is None and b'"role":"model"' in chunk:
+                    first_token = now - start
+                body += chunk
+    except httpx.HTTPError:
+        stats.errors += 1
+        return None
+    if response.status_code >= 400:
+        stats.errors += 1
+        return None
+    stats.latencies.append(time.perf_counter() - start)
+    stats.first_bytes.append(first_byte if first_byte is not None else stats.latencies[-1])
+    if first_token is not None:
+        stats.first_tokens.append(first_token)
+    return body
+
+
+async def user(
+    client: httpx.AsyncClient,
+    model: str,
+    deadline: float,
+    stats: Dict[str, EndpointStats],
+    turns: int,
+    think_time: float,
+):
+    """A user opening the page and chatting in new threads until `deadline`."""
+    await request(client, stats['GET /threads/'], 'GET', '/threads/')
+    while time.perf_counter() < deadline:
+        thread_id = None
+        for _ in range(turns):
+            if time.perf_counter() >= deadline:
+                return
+            data = {'prompt': 'How fast can you answer this question?', 'model': model}
+            if thread_id is not None:
+                data['thread_id'] = str(thread_id)
+            body = await request(client, stats['POST /chat/'], 'POST', '/chat/', data=data)
+            final = json.loads(body.splitlines()[-1]) if body else {}
+            if body is not None and 'thread_id' not in final:
+                # The app reports upstream failures as the answer's text
+                stats['POST /chat/'].errors += 1
+            thread_id = final.get('thread_id', thread_id)
+            await request(client, stats['GET /threads/'], 'GET', '/threads/')
+            if thread_id is not None:
+                await request(client, stats['GET /chat/'], 'GET', '/chat/', params={'thread_id': thread_id})
+            if think_time:
+                await asyncio.sleep(random.expovariate(1 / think_time))
+
+
+async def run_users(
+    url: str, users: int, duration: float, ramp_up: float = 0, turns: int = 5, think_time: float = 0,
+    app_pid: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Drive the app at `url` with `users` concurrent users and summarize the timings."""
+    stats = {name: EndpointStats() for name in ENDPOINTS}
+    peak_rss = process_tree_rss(app_pid) if app_pid else None
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        model = (await client.get('/models/')).json()['models'][0]
+        start = time.perf_counter()
+        deadline = start + duration
+
+        async def delayed_user(delay: float):
+            await asyncio.sleep(delay)
+            await user(client, model, deadline, stats, turns, think_time)
+
+        tasks = [asyncio.create_task(delayed_user(ramp_up * i / users)) for i in range(users)]
+        while not all(task.done() for task in tasks):
+            if peak_rss is not None:
+                peak_rss = max(peak_rss, process_tree_rss(app_pid) or 0)
+            await asyncio.wait(tasks, timeout=0.25)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    endpoints = {}
+    for name, endpoint in stats.items():
+        p50, p95, p99 = percentiles(endpoint.latencies)
+        ttfb_p50, ttfb_p95, _ = percentiles(endpoint.first_bytes)
+        endpoints[name] = {
+            'requests': len(endpoint.latencies),
+            'errors': endpoint.errors,
+            'rps': len(endpoint.latencies) / elapsed,
+            'p50 ms': p50,
+            'p95 ms': p95,
+            'p99 ms': p99,
+            'ttfb p50 ms': ttfb_p50,
+            'ttfb p95 ms': ttfb_p95,
+        }
+        if endpoint.first_tokens:
+            ttft_p50, ttft_p95, _ = percentiles(endpoint.first_tokens)
+            endpoints[name].update({'first token p50 ms': ttft_p50, 'first token p95 ms': ttft_p95})
+    return {
+        'users': users,
+        'duration': elapsed,
+        'rps': sum(e['requests'] for e in endpoints.values()) / elapsed,
+        'peak rss mb': peak_rss / 2**20 if peak_rss is not None else None,
+        'endpoints': endpoints,
+    }
+
+
+def report(results: Dict[str, Any]):
+    columns = ('rps', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'ttfb p50 ms', 'ttfb p95 ms')
+    print(f"{results['users']} users for {results['duration']:.1f}s, {results['rps']:.1f} requests/s", end='')
+    if results['peak rss mb'] is not None:
+        print(f", app peak memory {results['peak rss mb']:.0f} MiB", end='')
+    print()
+    print(f"{'':>14}" + ''.join(f'{name:>13}' for name in columns))
+    for name, values in results['endpoints'].items():
+        print(f'{name:>14}' + ''.join(
+            f'{values[column]:>13}' if isinstance(values[column], int) else f'{values[column]:>13.1f}'
+            for column in columns
+        ))
+    chat = results['endpoints']['POST /chat/']
+    if 'first token p50 ms' in chat:
+        print(f"POST /chat/ first token p50 / p95: {chat['first token p50 ms']:.1f} / {chat['first token p95 ms']:.1f} ms")
+
+
+def regressions(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Metrics that got worse than `baseline` by more than `tolerance`, as a fraction."""
+    found = []
+    for name, values in results['endpoints'].items():
+        before = baseline['endpoints'].get(name)
+        if before is None:
+            continue
+        for metric, value in values.items():
+            if metric.endswith(' ms') and before.get(metric) and value > before[metric] * (1 + tolerance):
+                found.append(f'{name} {metric}: {before[metric]:.1f} -> {value:.1f}')
+        if before['rps'] and values['rps'] < before['rps'] * (1 - tolerance):
+            found.append(f"{name} rps: {before['rps']:.1f} -> {values['rps']:.1f}")
+    if baseline.get('peak rss mb') and results['peak rss mb'] and \
+            results['peak rss mb'] > baseline['peak rss mb'] * (1 + tolerance):
+        found.append(f"peak rss mb: {baseline['peak rss mb']:.0f} -> {results['peak rss mb']:.0f}")
+    return found
+
+
+def main(args: argparse.Namespace) -> int:
+    load = dict(users=args.users, duration=args.duration, ramp_up=args.ramp_up, turns=args.turns,
+                think_time=args.think_time)
+    if args.url:
+        results = asyncio.run(run_users(args.url, **load))
+    else:
+        fake_server = start_fake_server(args)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                app = start_app(args.app_port, args.port, Path(tmp) / 'load_test.sqlite', args.workers)
+                try:
+                    results = asyncio.run(run_users(f'http://127.0.0.1:{args.app_port}', app_pid=app.pid, **load))
+                finally:
+                    app.terminate()
+                    app.wait()
+        finally:
+            fake_server.terminate()
+
+    report(results)
+    if args.save:
+        Path(args.save).write_text(json.dumps(results, indent=2))
+    if args.compare:
+        found = regressions(results, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for line in found:
+            print(f'Regression: {line}')
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=50, help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of load')
+    parser.add_argument('--ramp-up', type=float, default=2.0, help='seconds over which users arrive')
+    parser.add_argument('--turns', type=int, default=5, help='messages a user sends per thread')
+    parser.add_argument('--think-time', type=float, default=1.0, help='mean seconds between messages')
+    parser.add_argument('--url', help='load an already running app instead of starting one')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the started app')
+    parser.add_argument('--port', type=int, default=9004, help='port of the fake Together server')
+    parser.add_argument('--app-port', type=int, default=8004)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, as a fraction')
+    fake_together.add_arguments(parser)
+    sys.exit(main(parser.parse_args()))
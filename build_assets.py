@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Build script for the Together AI Chatbot frontend.
+This script compiles chat_app.ts to chat_app.js ahead of time, so browsers
+no longer download and run the TypeScript compiler on every page load.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from typing import List, Optional
+
+THIS_DIR = Path(__file__).parent
+TS_FILE = THIS_DIR / 'chat_app.ts'
+JS_FILE = THIS_DIR / 'chat_app.js'
+
+# First line of the compiled file, records which chat_app.ts it was built from
+STAMP_PREFIX = '// built from chat_app.ts sha256:'
+
+
+def source_hash(ts_source: bytes) -> str:
+    return hashlib.sha256(ts_source).hexdigest()
+
+
+def read_compiled_js() -> Optional[bytes]:
+    """Get chat_app.js if it was built from the current chat_app.ts, otherwise None."""
+    try:
+        js_source = JS_FILE.read_bytes()
+    except FileNotFoundError:
+        return None
+    stamp = f'{STAMP_PREFIX}{source_hash(TS_FILE.read_bytes())}\n'.encode('utf-8')
+    if not js_source.startswith(stamp):
+        return None
+    return js_source
+
+
+def find_compiler(allow_download: bool = False) -> Optional[List[str]]:
+    """Find an esbuild command, only using npx (which may download it) if allowed."""
+    local = THIS_DIR / 'node_modules' / '.bin' / 'esbuild'
+    if local.exists():
+        return [str(local)]
+    if shutil.which('esbuild'):
+        return ['esbuild']
+    if allow_download and shutil.which('npx'):
+        return ['npx', '--yes', 'esbuild']
+    return None
+
+
+def compile_typescript(allow_download: bool = False) -> bool:
+    """Compile chat_app.ts into a stamped chat_app.js, returning whether it succeeded."""
+    compiler = find_compiler(allow_download)
+    if compiler is None:
+        print("No TypeScript compiler found, install esbuild (npm install esbuild) to build chat_app.js")
+        return False
+
+    ts_source = TS_FILE.read_bytes()
+    try:
+        result = subprocess.run(
+            [*compiler, '--loader=ts', '--format=esm', '--target=es2017', '--minify'],
+            input=ts_source,
+            capture_output=True,
+            check=True,
+            timeout=120,
+        )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+        print(f"Error compiling chat_app.ts: {e}")
+        if isinstance(e, subprocess.CalledProcessError) and e.stderr:
+            print(e.stderr.decode('utf-8', errors='replace'))
+        return False
+
+    stamp = f'{STAMP_PREFIX}{source_hash(ts_source)}\n'.encode('utf-8')
+    # Written next to the target and renamed over it, so server workers compiling at
+    # the same time never read a half-written file
+    tmp_file = JS_FILE.with_name(f'.{JS_FILE.name}.{os.getpid()}')
+    tmp_file.write_bytes(stamp + result.stdout)
+    os.replace(tmp_file, JS_FILE)
+    print(f"Compiled {TS_FILE.name} to {JS_FILE.name} ({len(result.stdout)} bytes)")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if compile_typescript(allow_download=True) else 1)
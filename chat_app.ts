@@ -12,9 +12,13 @@ const spinner = document.getElementById('spinner')
 const resetButton = document.getElementById('reset-button')
 const modelSelector = document.getElementById('model-selector') as HTMLSelectElement
 const threadList = document.getElementById('thread-list')
+const searchInput = document.getElementById('search-input') as HTMLInputElement
 
 let selectedModel: string = ''
 let currentThreadId: number | null = null
+// aborted when another conversation is shown, so that answers still streaming stay out of it:
+// the loads of the conversation are aborted, while answers are read on without being rendered
+let viewController = new AbortController()
 
 // Load available models when the page loads
 async function loadModels() {
@@ -150,51 +154,57 @@ function cancelEditing() {
 }
 
 // Function to submit edited message
+// the edit starts a new branch of the thread from the messages before the edited one,
+// so it and the messages after it are replaced by the new prompt and answer
 async function submitEdit(msgDiv: HTMLElement, newContent: string) {
+  const editId = msgDiv.dataset.messageId
+  if (!editId) {
+    onError(new Error('This message can be edited once its answer is complete'))
+    return
+  }
   if (spinner) spinner.classList.add('active')
+  const view = viewController.signal
+  // without a thread shown, the server finds the edited message's thread
+  const allThreads = currentThreadId === null
   
   try {
-    // Remove subsequent messages from the UI
-    let nextElement = msgDiv.nextElementSibling
-    while (nextElement) {
-      const temp = nextElement.nextElementSibling
-      nextElement.remove()
-      nextElement = temp
-    }
-    
     // Create form data for the edit
     const formData = new FormData()
     formData.append('prompt', newContent)
-    formData.append('edit_timestamp', msgDiv.id.replace('msg-', ''))
+    formData.append('edit_id', editId)
     formData.append('model', selectedModel) // Add selected model to form data
+    if (!allThreads) formData.append('thread_id', String(currentThreadId))
     
-    // Send the edited message
+    // Send the edited message, the answer is read to the end even if another conversation
+    // is shown meanwhile, so that it's stored
     const response = await fetch('/chat/', {
       method: 'POST',
       body: formData
     })
+    if (!response.ok) throw await responseError(response)
     
-    await onFetchResponse(response)
-    
-    // Clean up editing state
-    msgDiv.classList.remove('editing')
-    const editForm = msgDiv.querySelector('.edit-form')
-    if (editForm) {
-      editForm.remove()
+    // Remove the edited message and subsequent messages from the UI, once the edit is accepted
+    let nextElement: Element | null = msgDiv
+    while (nextElement) {
+      const temp = nextElement.nextElementSibling
+      nextElement.remove()
+      nextElement = temp
     }
+    currentEditId = null
     
-    // Update the message content
-    const contentDiv = msgDiv.querySelector('.message-content')
-    if (contentDiv) {
-      contentDiv.innerHTML = DOMPurify.sanitize(marked.parse(newContent))
+    await onFetchResponse(response, null, null, view)
+    if (allThreads && currentThreadId !== null && !view.aborted) {
+      // the answer set the edited thread as the current one, show it with its new branch
+      await loadThread(currentThreadId)
+    } else {
+      // editing the first message renames the thread
+      loadThreads()
     }
-    
-    currentEditId = null
   } catch (error) {
     console.error('Error submitting edit:', error)
-    onError(error)
+    if (!view.aborted) onError(error)
   } finally {
-    if (spinner) spinner.classList.remove('active')
+    if (spinner && !view.aborted) spinner.classList.remove('active')
   }
 }
 
@@ -271,66 +281,171 @@ function enhanceAIResponse(content: string): string {
   return DOMPurify.sanitize(processedContent)
 }
 
+// the answer being generated in a response, and how many of its lines were received,
+// to read on from there with GET /chat/ if the connection drops before it's complete
+interface GenerationProgress {
+  id: string | null
+  offset: number
+}
+
+// attempts to read on after a dropped connection, waiting 1s, 2s, 4s... before each
+const RESUME_ATTEMPTS = 5
+
 // stream the response and render messages as each chunk is received
-// data is sent as newline-delimited JSON
-async function onFetchResponse(response: Response): Promise<void> {
-  let text = ''
-  let decoder = new TextDecoder()
-  if (response.ok && response.body) {
-    const reader = response.body.getReader()
-    while (true) {
-      const {done, value} = await reader.read()
-      if (done) {
-        break
+// data is sent as newline-delimited JSON, only complete lines are rendered
+// when `insertBefore` is given, messages are inserted before that element, see `addMessages`
+// if the connection drops while an answer is being generated, the rest of it is fetched,
+// unless `signal` was aborted
+// once `view` is aborted the lines are still read but no longer rendered
+// returns the number of stored messages received
+async function onFetchResponse(
+  response: Response,
+  insertBefore: Element | null = null,
+  signal: AbortSignal | null = null,
+  view: AbortSignal | null = signal,
+): Promise<number> {
+  const generation: GenerationProgress = {id: null, offset: 0}
+  let stored = 0
+  let attempts = 0
+  while (true) {
+    if (!response.ok || !response.body) throw await responseError(response)
+    try {
+      stored += await readMessages(response.body, insertBefore, generation, view)
+      break
+    } catch (error) {
+      if (signal?.aborted) return stored
+      if (generation.id === null || attempts === RESUME_ATTEMPTS) throw error
+    }
+    // the answer is still being generated, read on from the last complete line
+    let resumed: Response | null = null
+    while (resumed === null) {
+      await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** attempts++))
+      try {
+        resumed = await fetch(`/chat/?generation_id=${generation.id}&offset=${generation.offset}`, {signal})
+      } catch (error) {
+        if (signal?.aborted) return stored
+        if (attempts === RESUME_ATTEMPTS) throw error
       }
-      text += decoder.decode(value)
-      addMessages(text)
-      if (spinner) spinner.classList.remove('active')
     }
-    addMessages(text)
-    promptInput.disabled = false
-    promptInput.focus()
-  } else {
-    const text = await response.text()
-    console.error(`Unexpected response: ${response.status}`, {response, text})
-    throw new Error(`Unexpected response: ${response.status}`)
+    if (resumed.status === 404 || resumed.status === 410) {
+      throw new Error('The connection was lost and the answer is no longer available, please send the message again')
+    }
+    response = resumed
+  }
+  promptInput.disabled = false
+  promptInput.focus()
+  return stored
+}
+
+// render the lines of a response body as they arrive, see `onFetchResponse`
+async function readMessages(
+  body: ReadableStream<Uint8Array>,
+  insertBefore: Element | null,
+  generation: GenerationProgress,
+  view: AbortSignal | null,
+): Promise<number> {
+  let buffer = ''
+  let decoder = new TextDecoder()
+  let stored = 0
+  const reader = body.getReader()
+  while (true) {
+    const {done, value} = await reader.read()
+    if (done) {
+      break
+    }
+    buffer += decoder.decode(value, {stream: true})
+    const lastNewline = buffer.lastIndexOf('\n')
+    if (lastNewline !== -1) {
+      stored += addMessages(buffer.slice(0, lastNewline), insertBefore, generation, view)
+      buffer = buffer.slice(lastNewline + 1)
+    }
+    if (spinner && !view?.aborted) spinner.classList.remove('active')
   }
+  stored += addMessages(buffer + decoder.decode(), insertBefore, generation, view)
+  return stored
 }
 
-// The format of messages, this matches pydantic-ai both for brevity and understanding
-// in production, you might not want to keep this format all the way to the frontend
+async function responseError(response: Response): Promise<Error> {
+  const text = await response.text()
+  console.error(`Unexpected response: ${response.status}`, {response, text})
+  if (response.status === 503) {
+    const retryAfter = response.headers.get('Retry-After') || 'a few'
+    return new Error(`The model is busy, please try again in ${retryAfter} seconds`)
+  }
+  return new Error(`Unexpected response: ${response.status}`)
+}
+
+// The format of messages, as encoded by `Message.to_line` in chat_message.py
+// while a model response is being generated the server sends `delta` lines carrying
+// only the new text, followed by a final line with the complete `content` and the
+// `thread_id` the exchange was stored in
+// stored messages carry their `id`, the cursor for loading earlier pages and what an edit refers to,
+// the prompt is sent again with its `id` once stored, just before the final line
+// the first line of an answer, the prompt, carries the `generation_id` to read on from after a
+// dropped connection; the latest page of a thread goes on with the answer it's still generating
 interface Message {
+  id?: number
   role: string
-  content: string
+  content?: string
+  delta?: string
   timestamp: string
+  thread_id?: number
+  generation_id?: string
 }
 
+// accumulated text of model messages that are still streaming, keyed by element id
+const streamingContent = new Map<string, string>()
+
 // take raw response text and render messages into the `#conversation` element
 // Message timestamp is assumed to be a unique identifier of a message, and is used to deduplicate
 // hence you can send data about the same message multiple times, and it will be updated
 // instead of creating a new message elements
-function addMessages(responseText: string) {
-  if (!convElement || !responseText) return;
+// new elements are appended, or inserted before `insertBefore` when showing an earlier page
+// the lines of an answer being generated are counted in `generation`, and only counted once
+// `view` is aborted, as they belong to a conversation that isn't shown anymore
+// returns the number of stored messages (those with an `id`) in the text, before any answer
+function addMessages(
+  responseText: string,
+  insertBefore: Element | null = null,
+  generation: GenerationProgress | null = null,
+  view: AbortSignal | null = null,
+): number {
+  if (!convElement || !responseText) return 0;
+  let stored = 0
   
-  const lines = responseText.split('\n')
-  const messages: Message[] = lines
-    .filter(line => line.length > 1)
-    .map(j => {
-      try {
-        return JSON.parse(j)
-      } catch (e) {
-        console.error('Error parsing message:', e)
-        return null
-      }
-    })
-    .filter((m): m is Message => m !== null)
+  for (const line of responseText.split('\n')) {
+    if (line.length <= 1) continue
+    let message: Message
+    try {
+      message = JSON.parse(line)
+    } catch (e) {
+      console.error('Error parsing message:', e)
+      message = {role: '', timestamp: ''}
+    }
+    if (generation) {
+      if (message.generation_id !== undefined) generation.id = message.generation_id
+      if (generation.id !== null) generation.offset++
+    }
+    if (view?.aborted) continue
 
-  for (const message of messages) {
     // we use the timestamp as a crude element id
-    const {timestamp, role, content} = message
-    if (!timestamp || !role || !content) continue
+    const {timestamp, role, delta, thread_id, id: messageId} = message
+    if (!timestamp || !role) continue
+    if (thread_id !== undefined) currentThreadId = thread_id
+    if (messageId !== undefined) {
+      if (!generation?.id) stored++
+      if (earliestMessageId === null || messageId < earliestMessageId) earliestMessageId = messageId
+    }
 
     const id = `msg-${timestamp}`
+    let content = message.content
+    if (delta !== undefined) {
+      content = (streamingContent.get(id) || '') + delta
+      streamingContent.set(id, content)
+    } else {
+      streamingContent.delete(id)
+    }
+    if (!content) continue
     let msgDiv = document.getElementById(id)
     if (!msgDiv) {
       msgDiv = document.createElement('div')
@@ -352,8 +467,9 @@ function addMessages(responseText: string) {
       contentDiv.className = 'message-content'
       msgDiv.appendChild(contentDiv)
       
-      convElement.appendChild(msgDiv)
+      convElement.insertBefore(msgDiv, insertBefore)
     }
+    if (messageId !== undefined) msgDiv.dataset.messageId = String(messageId)
     
     // Update content
     const contentDiv = msgDiv.querySelector('.message-content')
@@ -365,7 +481,58 @@ function addMessages(responseText: string) {
       }
     }
   }
-  scrollToBottom()
+  if (!insertBefore && !view?.aborted) scrollToBottom()
+  return stored
+}
+
+// messages are fetched a page at a time, scrolling to the top of the conversation loads the previous page
+const PAGE_SIZE = 100
+// id of the oldest stored message shown, the cursor for the previous page
+let earliestMessageId: number | null = null
+let hasEarlierMessages = false
+let loadingEarlier = false
+
+function messagesQuery(): string {
+  return currentThreadId === null ? `limit=${PAGE_SIZE}` : `limit=${PAGE_SIZE}&thread_id=${currentThreadId}`
+}
+
+// load the most recent page of the current thread, or of all messages when no thread is selected
+async function loadLatestMessages() {
+  earliestMessageId = null
+  const signal = viewController.signal
+  const response = await fetch(`/chat/?${messagesQuery()}`, {signal})
+  hasEarlierMessages = (await onFetchResponse(response, null, signal)) === PAGE_SIZE
+}
+
+async function loadEarlierMessages() {
+  if (!convElement || !hasEarlierMessages || loadingEarlier || earliestMessageId === null) return
+  loadingEarlier = true
+  try {
+    const signal = viewController.signal
+    const response = await fetch(`/chat/?${messagesQuery()}&before=${earliestMessageId}`, {signal})
+    // keep the visible messages in place while the earlier ones are inserted above them
+    const previousHeight = convElement.scrollHeight
+    hasEarlierMessages = (await onFetchResponse(response, convElement.firstElementChild, signal)) === PAGE_SIZE
+    convElement.scrollTop += convElement.scrollHeight - previousHeight
+  } finally {
+    loadingEarlier = false
+  }
+}
+
+if (convElement) {
+  convElement.addEventListener('scroll', () => {
+    if (convElement.scrollTop === 0) loadEarlierMessages().catch(onError)
+  })
+}
+
+// start showing another conversation, the answers streaming into the current one
+// go on being read in the background until they're stored, see `onSubmit`, and
+// are shown again when their thread is opened
+function clearView() {
+  viewController.abort()
+  viewController = new AbortController()
+  streamingContent.clear()
+  if (convElement) convElement.innerHTML = ''
 }
 
 function scrollToBottom() {
@@ -375,6 +542,8 @@ function scrollToBottom() {
 }
 
 function onError(error: any) {
+  // the conversation the request was for isn't shown anymore
+  if (error?.name === 'AbortError') return
   console.error('Error:', error)
   const msgDiv = document.createElement('div')
   msgDiv.className = 'message model'
@@ -392,42 +561,60 @@ async function onSubmit(e: SubmitEvent): Promise<void> {
   const formData = new FormData()
   formData.append('prompt', promptInput.value)
   formData.append('model', selectedModel) // Add selected model to form data
+  if (currentThreadId !== null) formData.append('thread_id', String(currentThreadId))
   
   if (spinner) spinner.classList.add('active')
   promptInput.value = ''
   autoResizeTextarea(promptInput)
   
+  // the POST isn't aborted when another conversation is shown: the server stops answers
+  // nobody reads, and a new conversation only gets its thread id once the answer is stored
+  const view = viewController.signal
   try {
     const response = await fetch('/chat/', {
       method: 'POST',
       body: formData
     })
-    await onFetchResponse(response)
+    const threadIdBefore = currentThreadId
+    await onFetchResponse(response, null, null, view)
+    // a new conversation was started, show it in the sidebar
+    if (view.aborted || currentThreadId !== threadIdBefore) loadThreads()
   } catch (error) {
-    onError(error)
+    // errors of a conversation that isn't shown anymore are left out of the one that is
+    if (!view.aborted) onError(error)
   } finally {
-    if (spinner) spinner.classList.remove('active')
+    if (spinner && !view.aborted) spinner.classList.remove('active')
   }
 }
 
-// Load conversation threads
-async function loadThreads() {
+// cursor of the next page of threads, null once the sidebar shows all of them
+let nextThreadsBefore: number | null = null
+
+// Load conversation threads, the first page or the one starting before thread id `before`
+// while a search is shown the sidebar keeps its results instead
+async function loadThreads(before: number | null = null) {
+  if (searchInput?.value.trim()) return
   try {
-    const response = await fetch('/threads/')
+    const response = await fetch(before === null ? '/threads/' : `/threads/?before=${before}`)
     const data = await response.json()
     if (data.threads && Array.isArray(data.threads)) {
-      renderThreads(data.threads)
+      nextThreadsBefore = data.next_before ?? null
+      renderThreads(data.threads, before !== null)
     }
   } catch (error) {
     console.error('Error loading threads:', error)
   }
 }
 
-// Render threads in the sidebar
-function renderThreads(threads: Array<{id: number, title: string, timestamp: string}>) {
+// Render threads in the sidebar, replacing the ones shown unless `append` is set
+function renderThreads(threads: Array<{id: number, title: string, timestamp: string}>, append: boolean = false) {
   if (!threadList) return
   
-  threadList.innerHTML = ''
+  if (append) {
+    threadList.querySelector('.thread-more')?.remove()
+  } else {
+    threadList.innerHTML = ''
+  }
   for (const thread of threads) {
     const threadDiv = document.createElement('div')
     threadDiv.className = 'thread-item'
@@ -449,6 +636,86 @@ function renderThreads(threads: Array<{id: number, title: string, timestamp: str
     threadDiv.addEventListener('click', () => loadThread(thread.id))
     threadList.appendChild(threadDiv)
   }
+  
+  if (nextThreadsBefore !== null) {
+    const before = nextThreadsBefore
+    const moreDiv = document.createElement('div')
+    moreDiv.className = 'thread-item thread-more'
+    moreDiv.textContent = 'Load older conversations'
+    moreDiv.addEventListener('click', () => loadThreads(before))
+    threadList.appendChild(moreDiv)
+  }
+}
+
+interface SearchResult {
+  id: number
+  thread_id: number
+  title: string | null
+  role: string
+  timestamp: string
+  snippet: string
+}
+
+// Search messages of all threads and show the results in the sidebar, the first page or
+// the one starting at `offset`; clicking a result opens its thread
+async function searchThreads(query: string, offset: number = 0) {
+  if (!threadList) return
+  const response = await fetch(`/search/?q=${encodeURIComponent(query)}&offset=${offset}`)
+  const data = await response.json()
+  // a newer search was started while this one was loading
+  if (query !== searchInput.value.trim() || !Array.isArray(data.results)) return
+  if (offset) {
+    threadList.querySelector('.thread-more')?.remove()
+  } else {
+    threadList.innerHTML = data.results.length ? '' : '<div class="thread-more">No matching messages</div>'
+  }
+  for (const result of data.results as SearchResult[]) {
+    const resultDiv = document.createElement('div')
+    resultDiv.className = 'thread-item'
+    
+    const title = document.createElement('div')
+    title.className = 'thread-title'
+    title.textContent = result.title || `Thread ${result.thread_id}`
+    
+    // only the <mark> tags around matched words are kept from the snippet
+    const snippet = document.createElement('div')
+    snippet.className = 'thread-snippet'
+    snippet.innerHTML = DOMPurify.sanitize(result.snippet, {ALLOWED_TAGS: ['mark']})
+    
+    const timestamp = document.createElement('div')
+    timestamp.className = 'thread-timestamp'
+    timestamp.textContent = new Date(result.timestamp).toLocaleString()
+    
+    resultDiv.appendChild(title)
+    resultDiv.appendChild(snippet)
+    resultDiv.appendChild(timestamp)
+    resultDiv.addEventListener('click', () => loadThread(result.thread_id))
+    threadList.appendChild(resultDiv)
+  }
+  if (data.next_offset !== null && data.next_offset !== undefined) {
+    const nextOffset = data.next_offset
+    const moreDiv = document.createElement('div')
+    moreDiv.className = 'thread-item thread-more'
+    moreDiv.textContent = 'More results'
+    moreDiv.addEventListener('click', () => searchThreads(query, nextOffset).catch(onError))
+    threadList.appendChild(moreDiv)
+  }
+}
+
+// search as the user types, once they pause; clearing the box shows the threads again
+let searchTimer: number | undefined
+if (searchInput) {
+  searchInput.addEventListener('input', () => {
+    clearTimeout(searchTimer)
+    searchTimer = window.setTimeout(() => {
+      const query = searchInput.value.trim()
+      if (query) {
+        searchThreads(query).catch(onError)
+      } else {
+        loadThreads()
+      }
+    }, 300)
+  })
 }
 
 // Load a specific thread
@@ -457,10 +724,10 @@ async function loadThread(threadId: number) {
   currentThreadId = threadId
   
   try {
-    if (convElement) convElement.innerHTML = ''
-    const response = await fetch(`/chat/?thread_id=${threadId}`)
-    await onFetchResponse(response)
+    clearView()
     loadThreads() // Refresh thread list to update active state
+    // follows the answer the thread is still generating, if any
+    await loadLatestMessages()
   } catch (error) {
     console.error('Error loading thread:', error)
     onError(error)
@@ -475,7 +742,7 @@ async function resetChat() {
     if (spinner) spinner.classList.add('active')
     
     try {
-      if (convElement) convElement.innerHTML = ''
+      clearView()
       
       const response = await fetch('/reset-chat/', {method: 'POST'})
       
@@ -519,7 +786,7 @@ if (resetButton) {
 }
 
 // load messages on page load
-fetch('/chat/').then(onFetchResponse).catch(onError)
+loadLatestMessages().catch(onError)
 
 // Load threads when the page loads
 loadThreads()
\ No newline at end of file
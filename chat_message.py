@@ -0,0 +1,66 @@
+"""
+The chat message type shared by storage, the HTTP API and the Together client.
+
+A `Message` is made once, from a database row or when a prompt arrives, and the
+same object is encoded for the browser and turned into the Together request,
+without intermediate dicts. Response lines are encoded with orjson.
+"""
+
+import sys
+from typing import Any, Dict, Literal, NamedTuple, Optional
+
+try:
+    import orjson
+except ImportError as e:
+    print(f"Error importing orjson: {e}")
+    print("Please install it using:")
+    print("pip install orjson")
+    sys.exit(1)
+
+
+class Message(NamedTuple):
+    """A chat message, `model` messages are the answers.
+
+    A named tuple rather than a frozen dataclass: it's as compact as a slotted
+    class and several times faster to create, which counts for pages of messages.
+    """
+
+    role: Literal['user', 'model']
+    content: str
+    timestamp: str = ''
+    # Only set on stored messages, used as the pagination cursor and to edit the message
+    id: Optional[int] = None
+    # Estimated token count cached by the store, for context window budgeting
+    tokens: Optional[int] = None
+
+    def to_line(self, **extra: Any) -> bytes:
+        """The message as a line of the newline delimited JSON responses, see chat_app.ts.
+
+        `extra` adds fields to the line, like the `thread_id` of the final line of an answer.
+        """
+        data: Dict[str, Any] = {'role': self.role, 'timestamp': self.timestamp, 'content': self.content}
+        if self.id is not None:
+            data['id'] = self.id
+        if extra:
+            data.update(extra)
+        return encode_line(data)
+
+    def to_together(self) -> Dict[str, str]:
+        """The message in the Together chat format."""
+        return {'role': 'user' if self.role == 'user' else 'assistant', 'content': self.content}
+
+
+def encode_line(value: Any) -> bytes:
+    """`value` as a line of newline delimited JSON."""
+    return orjson.dumps(value, option=orjson.OPT_APPEND_NEWLINE)
+
+
+def estimate_tokens(text: str) -> int:
+    """How many tokens a message with content `text` takes up, for context window budgeting.
+
+    Counts roughly one token per three bytes of UTF-8 plus a few tokens of chat-template
+    overhead. This errs on the high side for English and stays reasonable for non-Latin
+    scripts, without running a tokenizer per request. Stores keep the estimate in
+    `Message.tokens` so it is only computed once.
+    """
+    return len(text.encode('utf-8')) // 3 + 4
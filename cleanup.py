@@ -33,7 +33,7 @@ def cleanup_unwanted_files():
     # Find and list any other suspicious files
     suspicious_files = []
     for file in current_dir.iterdir():
-        if file.is_file() and not file.name.endswith(('.py', '.md', '.txt', '.html', '.ts', '.sqlite')):
+        if file.is_file() and not file.name.endswith(('.py', '.md', '.txt', '.html', '.ts', '.js', '.ico', '.sqlite', '.sqlite-wal', '.sqlite-shm')):
             if not file.name.startswith('.'):  # Skip hidden files
                 suspicious_files.append(file)
     
@@ -0,0 +1,214 @@
+"""
+Replay buffers of the answers being generated, so that clients can reconnect.
+
+Each POST /chat/ runs its generation as a task writing the response lines to
+a `Generation`, and the response only reads them back. A client whose
+connection dropped reconnects with the generation id and the number of lines
+it received, and reads on from there, while the answer keeps being generated
+and paid for only once. A generation left without readers is stopped after
+`detached_timeout` seconds, and a finished one stays available for
+`keep_seconds` seconds, the least recently read going first beyond
+`max_finished` of them.
+
+Buffers live in the memory of one process: with several workers a reconnect
+only finds its generation on the worker that started it.
+"""
+
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Deque, Dict, Optional
+
+
+@dataclass(frozen=True)
+class ReplayLimits:
+    """How long and how much of the generations is kept."""
+
+    # Lines kept per generation, the oldest are dropped beyond it
+    buffer_lines: int = 4096
+    # Seconds a finished generation can still be read
+    keep_seconds: float = 60.0
+    max_finished: int = 256
+    # Seconds a generation keeps running without readers, 0 stops it when the last one leaves
+    detached_timeout: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> 'ReplayLimits':
+        """Read limits from CHAT_GENERATION_* environment variables."""
+        return cls(
+            buffer_lines=int(os.getenv("CHAT_GENERATION_BUFFER_LINES", str(cls.buffer_lines))),
+            keep_seconds=float(os.getenv("CHAT_GENERATION_KEEP_SECONDS", str(cls.keep_seconds))),
+            max_finished=int(os.getenv("CHAT_GENERATION_MAX_FINISHED", str(cls.max_finished))),
+            detached_timeout=float(os.getenv("CHAT_GENERATION_DETACHED_TIMEOUT", str(cls.detached_timeout))),
+        )
+
+
+# Seconds a new generation waits for its first reader at least, the response of the
+# POST that started it attaches once it starts streaming, even with a timeout of 0
+FIRST_READER_GRACE = 5.0
+
+
+class OffsetGone(Exception):
+    """Raised when reading lines a generation's buffer no longer holds."""
+
+
+class Generation:
+    """The lines of one answer, a ring buffer readers follow until the generation finishes."""
+
+    def __init__(self, generation_id: str, thread_id: Optional[int], limits: ReplayLimits):
+        self.id = generation_id
+        self.thread_id = thread_id
+        self.finished_at: Optional[float] = None
+        self._limits = limits
+        self._lines: Deque[bytes] = deque(maxlen=limits.buffer_lines)
+        # Offset of the first line still in the buffer
+        self._start = 0
+        self._changed = asyncio.Event()
+        self._readers = 0
+        # Runs the generation, see `run`
+        self.task: Optional[asyncio.Task] = None
+        self._stop_timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    @property
+    def end(self) -> int:
+        """Offset after the last line, the number of lines written so far."""
+        return self._start + len(self._lines)
+
+    def holds(self, offset: int) -> bool:
+        """Whether the line at `offset` can be read, it may not have been written yet."""
+        return offset >= self._start
+
+    def _append(self, line: bytes):
+        if len(self._lines) == self._lines.maxlen:
+            self._start += 1
+        self._lines.append(line)
+        # Wakes the readers waiting now, later ones wait for the next line
+        self._changed.set()
+        self._changed.clear()
+
+    def run(self, lines: AsyncIterator[bytes], finished: Callable[[bool], None]):
+        """Write `lines` in a task, `finished(cancelled)` is called once they end.
+
+        The task is stopped like a generation without readers unless one attaches in time.
+        """
+        self.task = asyncio.create_task(self._write(lines, finished))
+        self._stop_later(max(self._limits.detached_timeout, FIRST_READER_GRACE))
+
+    def _stop_later(self, delay: float):
+        """Cancel the task in `delay` seconds, unless a reader attaches meanwhile."""
+        if self.task is not None and not self.done:
+            self._stop_timer = asyncio.get_running_loop().call_later(delay, self.task.cancel)
+
+    async def _write(self, lines: AsyncIterator[bytes], finished: Callable[[bool], None]):
+        cancelled = False
+        try:
+            async for line in lines:
+                self._append(line)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            self.finished_at = time.monotonic()
+            self._changed.set()
+            if self._stop_timer is not None:
+                self._stop_timer.cancel()
+            finished(cancelled)
+
+    async def read(self, offset: int = 0) -> AsyncIterator[bytes]:
+        """Lines from `offset` on, as they are written, until the generation finishes.
+
+        Raises `OffsetGone` if the buffer no longer holds the line at `offset`,
+        including when a slow reader falls behind by more than the buffer.
+        """
+        self._readers += 1
+        if self._stop_timer is not None:
+            self._stop_timer.cancel()
+            self._stop_timer = None
+        try:
+            while True:
+                while offset < self.end:
+                    if offset < self._start:
+                        raise OffsetGone(f'Line {offset} of generation {self.id} is no longer available')
+                    yield self._lines[offset - self._start]
+                    offset += 1
+                if self.done:
+                    return
+                await self._changed.wait()
+        finally:
+            self._readers -= 1
+            if not self._readers:
+                self._stop_later(self._limits.detached_timeout)
+
+
+class GenerationStore:
+    """The generations of this process, running or recently finished, by id."""
+
+    def __init__(self, limits: ReplayLimits):
+        self.limits = limits
+        # Least recently read first
+        self._generations: OrderedDict[str, Generation] = OrderedDict()
+        # The latest running generation of each thread, for readers of the thread to attach to
+        self._running_by_thread: Dict[int, Generation] = {}
+
+    def start(
+        self, lines: AsyncIterator[bytes], thread_id: Optional[int], finished: Callable[[bool], None]
+    ) -> Generation:
+        """Run a generation writing `lines`, `finished(cancelled)` is called once it ends.
+
+        `lines` is first iterated once this returns, so it can use the generation's id.
+        It's stopped if nobody reads it, see `Generation.run`, including when the request
+        that started it goes away before its response reads the first line.
+        """
+        self._evict()
+        generation = Generation(uuid.uuid4().hex, thread_id, self.limits)
+        self._generations[generation.id] = generation
+        if thread_id is not None:
+            self._running_by_thread[thread_id] = generation
+
+        def done(cancelled: bool):
+            if thread_id is not None and self._running_by_thread.get(thread_id) is generation:
+                del self._running_by_thread[thread_id]
+            finished(cancelled)
+
+        generation.run(lines, done)
+        return generation
+
+    def get(self, generation_id: str) -> Optional[Generation]:
+        """The generation with this id, None once it has been evicted."""
+        self._evict()
+        generation = self._generations.get(generation_id)
+        if generation is not None:
+            self._generations.move_to_end(generation_id)
+        return generation
+
+    def running(self, thread_id: int) -> Optional[Generation]:
+        """The generation still answering in this thread, if any."""
+        return self._running_by_thread.get(thread_id)
+
+    def stats(self) -> Dict[str, int]:
+        running = sum(1 for generation in self._generations.values() if not generation.done)
+        return {'running': running, 'finished': len(self._generations) - running}
+
+    def _evict(self):
+        expired = time.monotonic() - self.limits.keep_seconds
+        excess = self.stats()['finished'] - self.limits.max_finished
+        for generation in list(self._generations.values()):
+            if generation.finished_at is None:
+                continue
+            if excess > 0 or generation.finished_at < expired:
+                del self._generations[generation.id]
+                excess -= 1
+
+    async def close(self):
+        """Stop the running generations, on shutdown."""
+        tasks = [g.task for g in self._generations.values() if g.task is not None and not g.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
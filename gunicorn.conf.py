@@ -0,0 +1,24 @@
+"""
+Gunicorn settings for running the app under a process manager:
+
+    pip install gunicorn uvicorn-worker
+    gunicorn main:app -c gunicorn.conf.py
+
+The same CHAT_* environment variables as `python main.py` configure it, see
+server_options.py. Gunicorn restarts workers that crash or hang, which plain
+`uvicorn --workers` doesn't.
+"""
+
+from server_options import ServerOptions
+
+options = ServerOptions.from_env()
+options.export()
+
+bind = f'{options.host}:{options.port}'
+workers = options.workers
+worker_class = 'uvicorn_worker.UvicornWorker'
+keepalive = options.keep_alive
+backlog = options.backlog
+# Streamed answers can take a while, don't kill workers in the middle of one
+timeout = 120
+graceful_timeout = 30
@@ -40,12 +40,15 @@ def install_dependencies():
     
     # Install base packages
     packages = [
-        "together>=0.2.11",
+        "together>=2.0.0",
+        "httpx>=0.27.0",
         "fastapi>=0.110.0",
         "uvicorn>=0.27.1",
         "python-multipart>=0.0.9",
         "typing-extensions>=4.10.0",
         "pydantic>=2.10.0",
+        "orjson>=3.9.0",
+        "zstandard>=0.22.0",
     ]
     
     for package in packages:
@@ -53,11 +56,6 @@ def install_dependencies():
             print(f"Failed to install {package}")
             return False
     
-    # Install pydantic-ai last to avoid dependency conflicts
-    if not run_command(f"{sys.executable} -m pip install pydantic-ai>=0.0.5"):
-        print("Failed to install pydantic-ai")
-        return False
-    
     # Clean up any unwanted files
     clean_unwanted_files()
     
@@ -2,23 +2,21 @@ from __future__ import annotations as _annotations
 
 import asyncio
 import json
-import sqlite3
+import os
 import sys
-from collections.abc import AsyncIterator
-from concurrent.futures.thread import ThreadPoolExecutor
-from contextlib import asynccontextmanager
-from dataclasses import dataclass
+import time
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime, timezone
 from functools import partial
 from pathlib import Path
-from typing import Annotated, Any, Callable, Dict, Literal, TypeVar, List, Optional
+from typing import TYPE_CHECKING, Annotated, Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 # Check for required packages and provide helpful error messages
 try:
+    import anyio
     import fastapi
     from fastapi import Depends, Request
-    from fastapi.responses import FileResponse, Response, StreamingResponse
-    from typing_extensions import LiteralString, ParamSpec, TypedDict
+    from fastapi.responses import Response, StreamingResponse
 except ImportError as e:
     print(f"Error importing required packages: {e}")
     print("Please install the required packages using:")
@@ -26,70 +24,244 @@ except ImportError as e:
     sys.exit(1)
 
 try:
-    from pydantic_ai.messages import (
-        ModelMessage,
-        ModelMessagesTypeAdapter,
-        ModelRequest,
-        ModelResponse,
-        TextPart,
-        UserPromptPart,
+    from together_model import (
+        KEEP_WARM_INTERVAL,
+        WARM_CONNECTIONS,
+        CompletionInfo,
+        chat_completion_stream,
+        create_async_client,
+        create_http_client,
+        load_models,
+        response_cache,
+        warm_connections,
     )
-except ImportError as e:
-    print(f"Error importing pydantic_ai: {e}")
-    print("Please install pydantic-ai using:")
-    print("pip install pydantic-ai")
-    sys.exit(1)
-
-try:
-    from together_model import chat_completion
 except ImportError as e:
     print(f"Error importing together_model: {e}")
     print("Make sure together_model.py is in the same directory as main.py")
     sys.exit(1)
 
+import build_assets
+import metrics
+from assets import JsonAsset, StaticAsset, etag_matches
+from chat_message import Message, encode_line
+from generations import Generation, GenerationStore, ReplayLimits
+from scheduler import ModelLimits, Overloaded, Scheduler
+from server_options import ServerOptions
+from storage import PAGE_SIZE, SEARCH_PAGE_SIZE, Database, connect_database
+
+if TYPE_CHECKING:
+    # The Together SDK is imported by the lifespan, after the app is imported
+    import httpx
+    from together import AsyncTogether
+
 THIS_DIR = Path(__file__).parent
 
+# What happens to an answer when the client disconnects before it's complete:
+# "discard" it, or "save" the prompt and the part of the answer received so far
+PARTIAL_RESPONSES = os.getenv('CHAT_PARTIAL_RESPONSES', 'discard')
+
 
 @asynccontextmanager
 async def lifespan(_app: fastapi.FastAPI):
-    async with Database.connect() as db:
-        yield {'db': db}
+    static_assets = await asyncio.to_thread(load_static_assets)
+    http_client = create_http_client()
+    async with connect_database() as db, create_async_client(http_client) as llm:
+        generations = GenerationStore(ReplayLimits.from_env())
+        ready = asyncio.Event()
+        keep_warm = asyncio.create_task(keep_upstream_warm(llm, http_client, ready))
+        try:
+            yield {
+                'db': db,
+                'llm': llm,
+                # With several worker processes each one enforces its share of the limits
+                'scheduler': Scheduler(ModelLimits.from_env().per_worker(ServerOptions.from_env().workers)),
+                'generations': generations,
+                'static_assets': static_assets,
+                'ready': ready,
+            }
+        finally:
+            keep_warm.cancel()
+            # Before the client closes the connections it's using
+            with suppress(asyncio.CancelledError):
+                await keep_warm
+            # Before the database closes, as stopped generations may save their partial answers
+            await generations.close()
+
+
+async def keep_upstream_warm(llm: AsyncTogether, http_client: httpx.AsyncClient, ready: asyncio.Event):
+    """Load the SDK and open connections to Together, then set `ready` and keep them from expiring while idle.
+
+    The app is ready even when Together can't be reached or warming up fails, the chats
+    will report the errors.
+    """
+    try:
+        # The SDK imports its API resources on first use, which takes half a second
+        await asyncio.to_thread(lambda: llm.chat.completions)
+        if not WARM_CONNECTIONS:
+            return
+        url = str(llm.base_url)
+        start = time.perf_counter()
+        opened = await warm_connections(http_client, url)
+        print(f"Opened {opened} connections to {url} in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        print(f"Error warming up the Together client: {e!r}")
+        return
+    finally:
+        ready.set()
+    while True:
+        await asyncio.sleep(KEEP_WARM_INTERVAL)
+        await warm_connections(http_client, url)
 
 
 app = fastapi.FastAPI(lifespan=lifespan)
 
 
+# Comments around the in-browser TypeScript loader in chat_app.html
+LOADER_START = '<!-- chat_app loader start'
+LOADER_END = '<!-- chat_app loader end -->'
+
+
+def load_static_assets() -> Dict[str, StaticAsset]:
+    """Read, compile and compress the frontend files once, keyed by URL path.
+
+    chat_app.js is used when it was built from the current chat_app.ts (see
+    build_assets.py), or compiled now if esbuild is installed locally. Otherwise
+    the page falls back to compiling chat_app.ts in the browser.
+    URLs in the page carry a `?v=` content hash so they can be cached forever.
+    """
+    assets = {
+        '/chat_app.ts': StaticAsset.from_bytes((THIS_DIR / 'chat_app.ts').read_bytes(), 'text/plain'),
+        '/favicon.ico': StaticAsset.from_bytes((THIS_DIR / 'favicon.ico').read_bytes(), 'image/x-icon'),
+    }
+    js_source = build_assets.read_compiled_js()
+    if js_source is None and build_assets.find_compiler() is not None:
+        if build_assets.compile_typescript():
+            js_source = build_assets.read_compiled_js()
+
+    html = (THIS_DIR / 'chat_app.html').read_text(encoding='utf-8')
+    if js_source is not None:
+        script = assets['/chat_app.js'] = StaticAsset.from_bytes(js_source, 'text/javascript')
+        start = html.index(LOADER_START)
+        end = html.index(LOADER_END) + len(LOADER_END)
+        html = html[:start] + f'<script type="module" src="/chat_app.js?v={script.version}"></script>' + html[end:]
+    else:
+        print("chat_app.js is missing or out of date, browsers will compile chat_app.ts.")
+        print("Run `python build_assets.py` to compile it ahead of time.")
+        html = html.replace(
+            "fetch('/chat_app.ts')", f"fetch('/chat_app.ts?v={assets['/chat_app.ts'].version}')"
+        )
+    favicon_version = assets['/favicon.ico'].version
+    html = html.replace('href="/favicon.ico"', f'href="/favicon.ico?v={favicon_version}"')
+    assets['/'] = StaticAsset.from_bytes(html.encode('utf-8'), 'text/html')
+    return assets
+
+
+def serve_static(request: Request, path: str) -> Response:
+    """Serve a file from memory, honouring If-None-Match and Accept-Encoding."""
+    asset: Optional[StaticAsset] = request.state.static_assets.get(path)
+    if asset is None:
+        raise fastapi.HTTPException(status_code=404)
+    if request.query_params.get('v') == asset.version:
+        # The URL changes with the content, so it never needs revalidating
+        cache_control = 'public, max-age=31536000, immutable'
+    else:
+        cache_control = 'no-cache'
+    headers = {'ETag': asset.etag, 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if etag_matches(request.headers.get('if-none-match'), asset.etag):
+        return Response(status_code=304, headers=headers)
+    body, encoding = asset.encode(request.headers.get('accept-encoding'))
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return Response(body, media_type=asset.media_type, headers=headers)
+
+
 @app.get('/')
-async def index() -> FileResponse:
-    return FileResponse((THIS_DIR / 'chat_app.html'), media_type='text/html')
+async def index(request: Request) -> Response:
+    return serve_static(request, '/')
 
 
 @app.get('/favicon.ico')
-async def favicon() -> FileResponse:
-    return FileResponse((THIS_DIR / 'favicon.ico'), media_type='image/x-icon')
+async def favicon(request: Request) -> Response:
+    return serve_static(request, '/favicon.ico')
+
+
+@app.get('/chat_app.js')
+async def main_js(request: Request) -> Response:
+    """Get the compiled frontend code, 404 unless build_assets.py has been run."""
+    return serve_static(request, '/chat_app.js')
 
 
 @app.get('/chat_app.ts')
-async def main_ts() -> FileResponse:
-    """Get the raw typescript code, it's compiled in the browser, forgive me."""
-    return FileResponse((THIS_DIR / 'chat_app.ts'), media_type='text/plain')
+async def main_ts(request: Request) -> Response:
+    """Get the raw typescript code, the fallback when chat_app.js hasn't been built."""
+    return serve_static(request, '/chat_app.ts')
 
 
 async def get_db(request: Request) -> Database:
     return request.state.db
 
 
+async def get_llm(request: Request) -> AsyncTogether:
+    return request.state.llm
+
+
+async def get_scheduler(request: Request) -> Scheduler:
+    return request.state.scheduler
+
+
+async def get_generations(request: Request) -> GenerationStore:
+    return request.state.generations
+
+
+async def get_ready(request: Request) -> asyncio.Event:
+    return request.state.ready
+
+
+# Maximum number of messages or threads in one page of GET /chat/ and GET /threads/
+MAX_PAGE_SIZE = 1000
+
+
 @app.get('/chat/')
 async def get_chat(
     thread_id: Optional[int] = None,
-    database: Database = Depends(get_db)
-) -> Response:
-    """Get chat messages, optionally filtered by thread_id."""
-    msgs = await database.get_messages(thread_id)
-    return Response(
-        b'\n'.join(json.dumps(to_chat_message(m)).encode('utf-8') for m in msgs),
-        media_type='text/plain',
-    )
+    before: Optional[int] = None,
+    limit: Annotated[int, fastapi.Query(ge=1, le=MAX_PAGE_SIZE)] = PAGE_SIZE,
+    generation_id: Optional[str] = None,
+    offset: Annotated[int, fastapi.Query(ge=0)] = 0,
+    database: Database = Depends(get_db),
+    generations: GenerationStore = Depends(get_generations),
+) -> StreamingResponse:
+    """Get a page of chat messages on active branches, optionally filtered by thread_id.
+
+    The page holds the `limit` most recent messages older than message id `before`, oldest
+    first. Pass the `id` of its first message as `before` to get the previous page, a page
+    shorter than `limit` is the last one. The latest page of a thread whose answer is still
+    being generated goes on with the lines of POST /chat/, from the first one, until it's done.
+
+    With `generation_id` the response continues the POST /chat/ response of that generation
+    instead, from its line number `offset`, for clients whose connection dropped. It's 404
+    once the generation is no longer kept and 410 when the line at `offset` is no longer.
+    """
+    if generation_id is not None:
+        generation = generations.get(generation_id)
+        if generation is None:
+            raise fastapi.HTTPException(status_code=404, detail=f'Generation {generation_id} not found')
+        if not generation.holds(offset):
+            raise fastapi.HTTPException(status_code=410, detail=f'Line {offset} of generation {generation_id} is gone')
+        return CancellableStreamingResponse(generation.read(offset), media_type='text/plain')
+
+    running: Optional[Generation] = None
+    if thread_id is not None and before is None:
+        running = generations.running(thread_id)
+
+    async def stream_rows():
+        async for message in database.get_messages(thread_id, before, limit):
+            yield message.to_line()
+        if running is not None and running.holds(0):
+            async for line in running.read():
+                yield line
+
+    return CancellableStreamingResponse(stream_rows(), media_type='text/plain')
 
 
 @app.post('/reset-chat/')
@@ -101,309 +273,321 @@ async def reset_chat(database: Database = Depends(get_db)) -> Response:
     )
 
 
-class ChatMessage(TypedDict):
-    """Format of messages sent to the browser."""
-
-    role: Literal['user', 'model']
-    timestamp: str
-    content: str
-
-
-def to_chat_message(m: ModelMessage) -> ChatMessage:
-    first_part = m.parts[0]
-    if isinstance(m, ModelRequest):
-        if isinstance(first_part, UserPromptPart):
-            assert isinstance(first_part.content, str)
-            return {
-                'role': 'user',
-                'timestamp': first_part.timestamp.isoformat(),
-                'content': first_part.content,
-            }
-    elif isinstance(m, ModelResponse):
-        if isinstance(first_part, TextPart):
-            return {
-                'role': 'model',
-                'timestamp': m.timestamp.isoformat(),
-                'content': first_part.content,
-            }
-    raise ValueError(f'Unexpected message type for chat app: {m}')
-
-
 @app.post('/chat/')
 async def post_chat(
+    request: Request,
     prompt: Annotated[str, fastapi.Form()],
     model: Annotated[str, fastapi.Form()],
-    edit_timestamp: Annotated[Optional[str], fastapi.Form()] = None,
-    database: Database = Depends(get_db)
-) -> StreamingResponse:
+    thread_id: Annotated[Optional[int], fastapi.Form()] = None,
+    edit_id: Annotated[Optional[int], fastapi.Form()] = None,
+    database: Database = Depends(get_db),
+    llm: AsyncTogether = Depends(get_llm),
+    scheduler: Scheduler = Depends(get_scheduler),
+    generations: GenerationStore = Depends(get_generations),
+) -> Response:
+    """Send a prompt, continuing `thread_id` or starting a new thread when it's omitted.
+
+    With `edit_id` the prompt replaces that user message, of `thread_id` if given, starting
+    a new branch from the messages before it, which becomes the thread's active branch.
+
+    Waits for a free slot for `model` first, answering 503 with Retry-After when overloaded.
+    A client that disconnects gives up its place in the queue if it was still waiting.
+    The answer is generated apart from the response, which reads its lines from a
+    `Generation`: the first line carries the `generation_id` to read on from with
+    GET /chat/ after a dropped connection. Without readers the generation is stopped
+    after `ReplayLimits.detached_timeout` seconds.
+    """
+    if thread_id is not None and not await database.thread_exists(thread_id):
+        raise fastapi.HTTPException(status_code=404, detail=f'Thread {thread_id} not found')
+    if edit_id is not None:
+        found = await database.find_message(edit_id)
+        if found is None or thread_id not in (None, found[0]):
+            raise fastapi.HTTPException(status_code=404, detail=f'Message {edit_id} not found')
+        thread_id, role = found
+        if role != 'user':
+            raise fastapi.HTTPException(status_code=422, detail=f'Message {edit_id} is not a user message')
+    model_label = metrics.model_label(model, load_models())
+    queued_at = time.perf_counter()
+    try:
+        if not await first_of(scheduler.acquire(model), wait_for_disconnect(request.receive)):
+            metrics.chat_requests.inc(model_label, 'cancelled')
+            # Nobody reads this, 499 is what proxies log for a client that closed the request
+            return Response(status_code=499)
+    except Overloaded as e:
+        metrics.chat_requests.inc(model_label, 'rejected')
+        return Response(
+            json.dumps({"status": "error", "message": str(e)}).encode('utf-8'),
+            status_code=503,
+            headers={'Retry-After': str(e.retry_after)},
+            media_type='application/json',
+        )
+    metrics.chat_stage_seconds.observe(time.perf_counter() - queued_at, 'queue_wait', model_label)
+
     async def stream_messages():
-        """Streams new line delimited JSON `Message`s to the client."""
+        """Streams new line delimited JSON `Message`s to the generation's readers."""
         timestamp = datetime.now(tz=timezone.utc)
+        user_message = Message('user', prompt, timestamp.isoformat())
+        yield user_message.to_line(generation_id=generation.id)
         
-        # Only stream the user prompt if this is not an edit
-        if not edit_timestamp:
-            user_message = {
-                'role': 'user',
-                'timestamp': timestamp.isoformat(),
-                'content': prompt,
-            }
-            yield json.dumps(user_message).encode('utf-8') + b'\n'
-        
-        # Get the chat history up to the edited message if edit_timestamp is provided
-        messages = await database.get_chat_history(edit_timestamp)
-        
-        # If this is an edit, update the last message's content
-        if edit_timestamp and messages:
-            for i, msg in enumerate(messages):
-                if msg.get('timestamp') == edit_timestamp:
-                    messages[i]['content'] = prompt
-                    break
+        # Get this thread's recent history, the branch leading to the edited message
+        # if edit_id is provided; the edited text itself is sent as the prompt
+        if thread_id is not None:
+            start = time.perf_counter()
+            messages = await database.get_chat_history(thread_id, edit_id)
+            metrics.chat_stage_seconds.observe(time.perf_counter() - start, 'history_load', model_label)
+        else:
+            messages = []
         
+        response_timestamp = datetime.now(tz=timezone.utc).isoformat()
+        info = CompletionInfo()
+        chunks = chat_completion_stream(llm, prompt, messages, model, info, scheduler)
+        generation_start = time.perf_counter()
         try:
-            # Get response from Together AI model
-            loop = asyncio.get_event_loop()
-            with ThreadPoolExecutor() as executor:
-                response_text = await loop.run_in_executor(
-                    executor, 
-                    partial(chat_completion, prompt, messages, model)
-                )
-            
-            # Create a text part with the response
-            response_timestamp = datetime.now(tz=timezone.utc)
-            text_part = TextPart(content=str(response_text))
+            # Forward each delta to the client as soon as it arrives
+            response_parts = []
+            async for delta in chunks:
+                if not response_parts:
+                    metrics.chat_stage_seconds.observe(
+                        time.perf_counter() - generation_start, 'first_token', model_label
+                    )
+                response_parts.append(delta)
+                yield encode_line({'role': 'model', 'timestamp': response_timestamp, 'delta': delta})
+            response_text = ''.join(response_parts)
+            metrics.chat_stage_seconds.observe(time.perf_counter() - generation_start, 'generation', model_label)
             
-            # Create a ModelResponse for the AI response
-            model_response = ModelResponse(parts=[text_part])
-            
-            # Stream the model response to the client
-            model_message = {
-                'role': 'model',
-                'timestamp': response_timestamp.isoformat(),
-                'content': response_text,
-            }
-            yield json.dumps(model_message).encode('utf-8') + b'\n'
+            # Store the messages.
+            # This only happens once the whole completion has arrived, in a single
+            # transaction, so a client that disconnects mid-stream leaves no partial rows.
+            response_message = Message('model', response_text, response_timestamp)
             
-            # Store the messages in a simple format that can be easily retrieved
-            user_dict = {
-                "role": "user",
-                "timestamp": timestamp.isoformat(),
-                "content": prompt
-            }
-            
-            response_dict = {
-                "role": "model",
-                "timestamp": response_timestamp.isoformat(),
-                "content": str(response_text)
-            }
+            # Add new messages to the thread, creating it for a new conversation
+            start = time.perf_counter()
+            saved_thread_id, (user_id, response_id) = await database.add_messages(
+                [user_message, response_message], thread_id, info.model, edit_id
+            )
+            metrics.chat_stage_seconds.observe(time.perf_counter() - start, 'db_write', model_label)
+            metrics.chat_requests.inc(model_label, 'cached' if info.cached else 'answered')
             
-            # Add new messages to the database
-            messages_json = json.dumps([user_dict, response_dict]).encode('utf-8')
-            await database.add_messages(messages_json)
+            # Send the assembled message so the client ends up with the stored text,
+            # along with the thread to continue on the next prompt, and the ids of
+            # both messages to edit them later
+            yield user_message._replace(id=user_id).to_line()
+            extra: Dict[str, Any] = {'thread_id': saved_thread_id}
+            if info.model != model:
+                # Answered by a fallback model
+                extra['model'] = info.model
+            yield response_message._replace(id=response_id).to_line(**extra)
+        except asyncio.CancelledError:
+            # Left without readers for too long, or the app is shutting down
+            metrics.chat_requests.inc(model_label, 'cancelled')
+            if PARTIAL_RESPONSES == 'save' and response_parts:
+                partial_messages = [user_message, Message('model', ''.join(response_parts), response_timestamp)]
+                # Cancellation would otherwise interrupt every await from here on
+                with anyio.CancelScope(shield=True):
+                    await database.add_messages(partial_messages, thread_id, info.model, edit_id)
+            raise
         except Exception as e:
             # Handle any errors that occur during the API call
-            error_timestamp = datetime.now(tz=timezone.utc)
-            error_message = {
-                'role': 'model',
-                'timestamp': error_timestamp.isoformat(),
-                'content': f"An error occurred: {str(e)}\n\nPlease check your API key and connection.",
-            }
-            yield json.dumps(error_message).encode('utf-8') + b'\n'
+            metrics.chat_requests.inc(model_label, 'failed')
+            error_message = Message(
+                'model',
+                f"An error occurred: {str(e)}\n\nPlease check your API key and connection.",
+                datetime.now(tz=timezone.utc).isoformat(),
+            )
+            yield error_message.to_line()
+        finally:
+            # Closes the upstream HTTP stream, so Together stops generating if the
+            # client went away mid-generation. Shielded as it may run while cancelled.
+            with anyio.CancelScope(shield=True):
+                await chunks.aclose()
+
+    generation = generations.start(stream_messages(), thread_id, partial(scheduler.release, model))
+    return CancellableStreamingResponse(generation.read(), media_type='text/plain')
+
+
+async def wait_for_disconnect(receive: Callable[[], Awaitable[Dict[str, Any]]]):
+    """Return once the client has closed the connection, the request body must have been read."""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def first_of(work: Awaitable[Any], disconnect: Awaitable[None]) -> bool:
+    """Run `work` until it completes, or cancel it if `disconnect` completes first.
 
-    return StreamingResponse(stream_messages(), media_type='text/plain')
+    Returns whether `work` completed, raising its exception if it failed.
+    """
+    work_task = asyncio.ensure_future(work)
+    disconnect_task = asyncio.ensure_future(disconnect)
+    try:
+        await asyncio.wait({work_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect_task.cancel()
+        if not work_task.done():
+            work_task.cancel()
+            await asyncio.wait({work_task})
+    if work_task.cancelled():
+        return False
+    work_task.result()
+    return True
+
+
+async def _never_receive() -> Dict[str, Any]:
+    await asyncio.get_running_loop().create_future()
+    raise AssertionError('unreachable')
+
+
+class CancellableStreamingResponse(StreamingResponse):
+    """Streaming response whose body generator is cancelled as soon as the client disconnects.
+
+    Whichever ASGI version the server speaks and even while nothing is being sent,
+    so that a reader waiting for the next line of a generation leaves it right away.
+    """
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        # This class listens for the disconnect instead of the base class
+        await first_of(super().__call__(scope, _never_receive, send), wait_for_disconnect(receive))
+
+
+# The /models/ response for the list `load_models` returned, which is a new list only
+# when models.txt changed
+_models_json: Tuple[Optional[List[str]], Optional[JsonAsset]] = (None, None)
+
+
+def models_json() -> JsonAsset:
+    """The /models/ response, serialized again only when models.txt changes."""
+    global _models_json
+    models = load_models()
+    loaded, asset = _models_json
+    if asset is None or models is not loaded:
+        asset = JsonAsset.from_value({"models": models})
+        _models_json = (models, asset)
+    return asset
 
 
 @app.get('/models/')
-async def get_models() -> Response:
+async def get_models(request: Request) -> Response:
     """Get the list of available models from models.txt."""
     try:
-        models_file = THIS_DIR / 'models.txt'
-        with open(models_file, 'r') as f:
-            models = [line.strip() for line in f if line.strip()]
-        return Response(
-            json.dumps({"models": models}).encode('utf-8'),
-            media_type='application/json',
-        )
+        models = models_json()
     except Exception as e:
         return Response(
             json.dumps({"status": "error", "message": str(e)}).encode('utf-8'),
             status_code=500,
             media_type='application/json',
         )
+    headers = {'ETag': models.etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(request.headers.get('if-none-match'), models.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(models.body, media_type='application/json', headers=headers)
 
 
 @app.get('/threads/')
-async def get_threads(database: Database = Depends(get_db)) -> Response:
-    """Get list of conversation threads."""
-    threads = await database.get_threads()
-    return Response(
-        json.dumps({"threads": threads}).encode('utf-8'),
-        media_type='application/json',
-    )
+async def get_threads(
+    request: Request,
+    before: Optional[int] = None,
+    limit: Annotated[int, fastapi.Query(ge=1, le=MAX_PAGE_SIZE)] = PAGE_SIZE,
+    database: Database = Depends(get_db)
+) -> Response:
+    """Get a page of conversation threads, newest first.
 
+    `next_before` is the `before` to pass for the next page, null on the last page.
+    The ETag changes with any thread, so polling an unchanged sidebar gets a 304.
+    """
+    etag = f'"threads-{await database.get_threads_version()}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+
+    async def stream_threads():
+        yield b'{"threads": ['
+        count = 0
+        last_id = None
+        async for thread in database.get_threads(before, limit):
+            yield (b', ' if count else b'') + json.dumps(thread).encode('utf-8')
+            count += 1
+            last_id = thread['id']
+        next_before = last_id if count == limit else None
+        yield b'], "next_before": ' + json.dumps(next_before).encode('utf-8') + b'}'
+
+    return StreamingResponse(stream_threads(), media_type='application/json', headers=headers)
+
+
+@app.get('/search/')
+async def search(
+    q: Annotated[str, fastapi.Query(min_length=1)],
+    offset: Annotated[int, fastapi.Query(ge=0)] = 0,
+    limit: Annotated[int, fastapi.Query(ge=1, le=MAX_PAGE_SIZE)] = SEARCH_PAGE_SIZE,
+    database: Database = Depends(get_db)
+) -> StreamingResponse:
+    """Search the messages of all threads for the words of `q`, best matches first.
 
-P = ParamSpec('P')
-R = TypeVar('R')
+    Each result has the message `id`, `thread_id`, thread `title`, `role`, `timestamp` and
+    a `snippet` with the matched words in <mark> tags. `next_offset` is the `offset` to
+    pass for the next page, null on the last page.
+    """
+    async def stream_results():
+        yield b'{"results": ['
+        count = 0
+        async for result in database.search_messages(q, offset, limit):
+            yield (b', ' if count else b'') + json.dumps(result).encode('utf-8')
+            count += 1
+        next_offset = offset + count if count == limit else None
+        yield b'], "next_offset": ' + json.dumps(next_offset).encode('utf-8') + b'}'
 
+    return StreamingResponse(stream_results(), media_type='application/json')
 
-@dataclass
-class Database:
-    """Rudimentary database to store chat messages in SQLite.
 
-    The SQLite standard library package is synchronous, so we
-    use a thread pool executor to run queries asynchronously.
-    """
+@app.get('/ready')
+async def get_readiness(ready: asyncio.Event = Depends(get_ready)) -> Response:
+    """503 until the connections to Together are open, for load balancers to send traffic once it's 200."""
+    if not ready.is_set():
+        return Response(b'{"status": "starting"}', status_code=503, media_type='application/json')
+    return Response(b'{"status": "ready"}', media_type='application/json')
 
-    con: sqlite3.Connection
-    _loop: asyncio.AbstractEventLoop
-    _executor: ThreadPoolExecutor
-
-    @classmethod
-    @asynccontextmanager
-    async def connect(
-        cls, file: Path = THIS_DIR / '.chat_app_messages.sqlite'
-    ) -> AsyncIterator[Database]:
-        loop = asyncio.get_event_loop()
-        executor = ThreadPoolExecutor(max_workers=1)
-        con = await loop.run_in_executor(executor, cls._connect, file)
-        slf = cls(con, loop, executor)
-        try:
-            yield slf
-        finally:
-            await slf._asyncify(con.close)
-
-    @staticmethod
-    def _connect(file: Path) -> sqlite3.Connection:
-        con = sqlite3.connect(str(file))
-        cur = con.cursor()
-        cur.execute(
-            'CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, message_list TEXT);'
-        )
-        con.commit()
-        return con
-
-    async def add_messages(self, messages: bytes):
-        await self._asyncify(
-            self._execute,
-            'INSERT INTO messages (message_list) VALUES (?);',
-            messages,
-            commit=True,
-        )
-        await self._asyncify(self.con.commit)
 
-    async def get_chat_history(self, edit_timestamp: Optional[str] = None) -> List[Dict[str, Any]]:
-        """Get chat history in a format suitable for the Together API."""
-        c = await self._asyncify(
-            self._execute, 'SELECT message_list FROM messages ORDER BY id'
-        )
-        rows = await self._asyncify(c.fetchall)
-        
-        messages = []
-        for row in rows:
-            try:
-                msg_list = json.loads(row[0])
-                for msg in msg_list:
-                    if isinstance(msg, dict) and 'role' in msg and 'content' in msg:
-                        messages.append(msg)
-                        # If we reach the edited message, stop including further messages
-                        if edit_timestamp and msg.get('timestamp') == edit_timestamp:
-                            break
-            except (json.JSONDecodeError, IndexError, KeyError) as e:
-                print(f"Error parsing message: {e}")
-        
-        return messages
+@app.get('/stats/')
+async def get_stats(scheduler: Scheduler = Depends(get_scheduler)) -> Response:
+    """Get counters of the Together response cache and the per-model upstream queues."""
+    return Response(
+        json.dumps({
+            "response_cache": response_cache.stats(),
+            "upstream": scheduler.stats(),
+        }).encode('utf-8'),
+        media_type='application/json',
+    )
 
-    async def get_messages(self, thread_id: Optional[int] = None) -> list[ModelMessage]:
-        """Get messages in a format suitable for the frontend."""
-        if thread_id is not None:
-            c = await self._asyncify(
-                self._execute, 'SELECT message_list FROM messages WHERE id = ?', thread_id
-            )
-        else:
-            c = await self._asyncify(
-                self._execute, 'SELECT message_list FROM messages ORDER BY id'
-            )
-        rows = await self._asyncify(c.fetchall)
-        
-        all_messages = []
-        for row in rows:
-            try:
-                msg_list = json.loads(row[0])
-                for msg in msg_list:
-                    if isinstance(msg, dict) and 'role' in msg and 'content' in msg:
-                        all_messages.append(msg)
-            except (json.JSONDecodeError, IndexError, KeyError) as e:
-                print(f"Error parsing message: {e}")
-        
-        # Convert to ModelMessage objects
-        result = []
-        for msg in all_messages:
-            try:
-                if msg['role'] == 'user':
-                    timestamp = datetime.fromisoformat(msg['timestamp']) if 'timestamp' in msg else datetime.now(tz=timezone.utc)
-                    user_prompt = UserPromptPart(content=msg['content'], timestamp=timestamp)
-                    result.append(ModelRequest(parts=[user_prompt]))
-                elif msg['role'] == 'model':
-                    timestamp = datetime.fromisoformat(msg['timestamp']) if 'timestamp' in msg else datetime.now(tz=timezone.utc)
-                    text_part = TextPart(content=msg['content'])
-                    result.append(ModelResponse(parts=[text_part], timestamp=timestamp))
-            except (KeyError, ValueError) as e:
-                print(f"Error converting message: {e}")
-        
-        return result
-
-    async def clear_messages(self):
-        """Clear all messages from the database."""
-        await self._asyncify(
-            self._execute,
-            'DELETE FROM messages;',
-            commit=True,
-        )
-        await self._asyncify(self.con.commit)
-
-    def _execute(
-        self, sql: LiteralString, *args: Any, commit: bool = False
-    ) -> sqlite3.Cursor:
-        cur = self.con.cursor()
-        cur.execute(sql, args)
-        if commit:
-            self.con.commit()
-        return cur
-
-    async def _asyncify(
-        self, func: Callable[P, R], *args: P.args, **kwargs: P.kwargs
-    ) -> R:
-        return await self._loop.run_in_executor(  # type: ignore
-            self._executor,
-            partial(func, **kwargs),
-            *args,  # type: ignore
-        )
 
-    async def get_threads(self) -> List[Dict[str, Any]]:
-        """Get list of conversation threads with their first messages."""
-        c = await self._asyncify(
-            self._execute, 'SELECT id, message_list FROM messages ORDER BY id DESC'
-        )
-        rows = await self._asyncify(c.fetchall)
-        
-        threads = []
-        for row in rows:
-            try:
-                thread_id = row[0]
-                msg_list = json.loads(row[1])  # Use row[1] for message_list column
-                if isinstance(msg_list, list) and len(msg_list) > 0:
-                    first_msg = msg_list[0]
-                    if isinstance(first_msg, dict) and 'content' in first_msg:
-                        # Use first few words of first message as thread title
-                        title = ' '.join(first_msg['content'].split()[:5]) + '...'
-                        threads.append({
-                            "id": thread_id,
-                            "title": title,
-                            "timestamp": first_msg.get('timestamp', '')
-                        })
-            except (json.JSONDecodeError, IndexError, KeyError) as e:
-                print(f"Error parsing thread: {e}")
-        
-        return threads
+@app.get('/metrics')
+async def get_metrics(
+    scheduler: Scheduler = Depends(get_scheduler), generations: GenerationStore = Depends(get_generations)
+) -> Response:
+    """Get the app's counters and latency histograms in the Prometheus text format."""
+    upstream = scheduler.stats()
+    cache = response_cache.stats()
+    replay = generations.stats()
+    gauges = [
+        metrics.Gauge(
+            'together_queue_in_flight', 'Generations running per model.', ('model',),
+            lambda: (((model,), stats['in_flight']) for model, stats in upstream.items()),
+        ),
+        metrics.Gauge(
+            'together_queue_waiting', 'Requests waiting for a slot per model.', ('model',),
+            lambda: (((model,), stats['queued']) for model, stats in upstream.items()),
+        ),
+        metrics.Gauge(
+            'together_response_cache_hits_total', 'Completions answered from the response cache.', (),
+            lambda: [((), cache['hits'])], kind='counter',
+        ),
+        metrics.Gauge(
+            'together_response_cache_misses_total', 'Completions not found in the response cache.', (),
+            lambda: [((), cache['misses'])], kind='counter',
+        ),
+        metrics.Gauge(
+            'chat_generations', 'Generations kept for reconnecting clients, running or finished.', ('state',),
+            lambda: (((state,), count) for state, count in replay.items()),
+        ),
+    ]
+    return Response(metrics.render([*metrics.REGISTRY, *gauges]), media_type='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
@@ -420,6 +604,14 @@ if __name__ == '__main__':
     print("export TOGETHER_API_KEY='your_together_api_key'")
     print("Or update the together_model.py file with your API key.")
     
-    uvicorn.run(
-        'main:app', host="0.0.0.0", port=8000
-    )
\ No newline at end of file
+    options = ServerOptions.parse_args()
+    missing = options.missing_packages()
+    if missing:
+        print(f"Error: {', '.join(missing)} is not installed.")
+        print("Please install it using:")
+        print(f"pip install {' '.join(missing)}")
+        sys.exit(1)
+    if options.workers > 1:
+        print(f"Running {options.workers} worker processes, each with 1/{options.workers} of the upstream limits.")
+    options.export()
+    uvicorn.run('main:app', **options.uvicorn_kwargs())
\ No newline at end of file
@@ -0,0 +1,152 @@
+"""
+Counters and latency histograms served at /metrics in the Prometheus text format.
+
+Recording a value is a dictionary lookup and a couple of additions, without
+locks (everything records from the event loop thread), so the metrics are
+always on. Each worker process keeps its own values, see README.md.
+"""
+
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """A total that only goes up, per combination of label values."""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        for label_values, value in self._values.items():
+            yield f'{self.name}{_labels(self.labels, label_values)} {_number(value)}'
+
+
+class Histogram:
+    """Distribution of observed values, per combination of label values."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # Per label values: a count per bucket (the last one is +Inf), and the sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *label_values: str):
+        series = self._values.get(label_values)
+        if series is None:
+            series = self._values[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for label_values, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*map(_number, self.buckets), '+Inf'), counts):
+                cumulative += count
+                le = 'le="' + bound + '"'
+                yield f'{self.name}_bucket{_labels(self.labels, label_values, le)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labels, label_values)} {_number(total[0])}'
+            yield f'{self.name}_count{_labels(self.labels, label_values)} {cumulative}'
+
+
+class Gauge:
+    """Values read from elsewhere when the metrics are scraped.
+
+    `kind` is "counter" for totals kept by other parts of the app.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Tuple[str, ...],
+        collect: Callable[[], Iterable[Tuple[Tuple[str, ...], float]]],
+        kind: str = 'gauge',
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.collect = collect
+        self.kind = kind
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for label_values, value in self.collect():
+            yield f'{self.name}{_labels(self.labels, label_values)} {_number(value)}'
+
+
+def model_label(model: str, known_models: Iterable[str]) -> str:
+    """`model` if it's a known model, so that arbitrary model names sent by clients can't add series."""
+    return model if model in known_models else 'other'
+
+
+def render(metrics: Iterable) -> bytes:
+    """The Prometheus text format of `metrics`."""
+    return ('\n'.join(line for metric in metrics for line in metric.render()) + '\n').encode('utf-8')
+
+
+# Stages of POST /chat/: history_load, prompt_assembly, queue_wait, first_token, generation, db_write
+chat_stage_seconds = Histogram(
+    'chat_stage_seconds', 'Time spent in each stage of answering POST /chat/.', ('stage', 'model')
+)
+db_query_seconds = Histogram(
+    'chat_db_query_seconds', 'Latency of database reads, of committed write batches and of vacuum steps.',
+    ('operation',)
+)
+upstream_tokens = Counter(
+    'together_tokens_total', 'Tokens reported by Together, by model and kind (prompt or completion).',
+    ('model', 'kind'),
+)
+upstream_errors = Counter(
+    'together_errors_total', 'Failed Together requests, including retried ones, by model and error.',
+    ('model', 'error'),
+)
+# Outcomes: answered, cached, failed (after retries and fallbacks), rejected (queue full)
+# and cancelled (client disconnected and nobody read on, see generations.py)
+chat_requests = Counter(
+    'chat_requests_total', 'POST /chat/ requests by requested model and outcome.', ('model', 'outcome')
+)
+
+# Operations: archived (moved to the segment files) and restored (opened again), see storage_archive.py
+archived_threads = Counter(
+    'chat_archived_threads_total', 'Threads moved to the cold archive and restored from it.', ('operation',)
+)
+
+# Always served, the app adds gauges of its scheduler and cache
+REGISTRY = [chat_requests, chat_stage_seconds, db_query_seconds, upstream_tokens, upstream_errors, archived_threads]
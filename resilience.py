@@ -0,0 +1,113 @@
+"""
+Building blocks for calling Together reliably.
+
+`RetryPolicy` decides which errors are worth retrying and how long to back
+off, and `LatencyTracker` keeps recent time-to-first-token samples per model
+so slow requests can be hedged with a second one once they pass the p95.
+
+The error classes of httpx and together are imported when an error is first
+looked at, by then the client that raised it has imported them anyway.
+"""
+
+import os
+import random
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional
+
+# HTTP statuses that are worth retrying, everything else is a problem with the request
+TRANSIENT_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether retrying the same request later might succeed."""
+    import httpx
+    from together import APIConnectionError, APIStatusError
+
+    if isinstance(error, (APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in TRANSIENT_STATUSES or error.status_code >= 500
+    return False
+
+
+def should_fall_back(error: BaseException) -> bool:
+    """Whether another model might succeed where this one failed."""
+    from together import NotFoundError
+
+    return is_transient(error) or isinstance(error, NotFoundError)
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """The delay requested by a Retry-After header on an error response, if any."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after', ''))
+    except ValueError:
+        return None
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """How often to retry a model, and which models to fall back to after that."""
+
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+    # "auto" tries the other models in models.txt in order, "none" disables
+    # fallback, anything else is a comma separated list of models
+    fallback: str = "auto"
+
+    @classmethod
+    def from_env(cls) -> 'RetryPolicy':
+        return cls(
+            max_attempts=int(os.getenv("TOGETHER_MAX_ATTEMPTS", str(cls.max_attempts))),
+            base_delay=float(os.getenv("TOGETHER_RETRY_BASE_DELAY", str(cls.base_delay))),
+            max_delay=float(os.getenv("TOGETHER_RETRY_MAX_DELAY", str(cls.max_delay))),
+            fallback=os.getenv("TOGETHER_FALLBACK_MODELS", cls.fallback),
+        )
+
+    def backoff(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        """Seconds to wait before retry number `attempt` (starting at 1), with full jitter.
+
+        A Retry-After header on the error takes precedence, capped at `max_delay`.
+        """
+        requested = retry_after(error) if error is not None else None
+        if requested is not None:
+            return min(requested, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def models_to_try(self, model: str, available_models: List[str]) -> List[str]:
+        """The requested model followed by its fallbacks."""
+        if self.fallback == "none":
+            fallbacks = []
+        elif self.fallback == "auto":
+            fallbacks = available_models
+        else:
+            fallbacks = [m.strip() for m in self.fallback.split(',') if m.strip()]
+        return [model, *(m for m in fallbacks if m != model)]
+
+
+class LatencyTracker:
+    """Rolling window of time-to-first-token samples per model."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, model: str, seconds: float):
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, model: str, percentile: float = 0.95) -> Optional[float]:
+        """The given percentile of recent samples, None until there are enough of them."""
+        samples = self._samples.get(model)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile))]
@@ -0,0 +1,144 @@
+"""
+Content-addressed cache of Together chat completions.
+
+Identical requests (same model, messages including the system prompt, and
+sampling parameters) map to the same key, so regenerations and repeated
+prompts can be answered without a paid API call. Entries live in an
+in-memory LRU, optionally backed by a SQLite file shared across restarts.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# How many SQLite writes happen between two eviction passes
+EVICTION_INTERVAL = 100
+
+
+def cache_key(model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> str:
+    """Hash everything that determines a completion into a cache key."""
+    payload = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier completion cache with TTL, LRU and size-based eviction.
+
+    Safe to use from several threads. Lookups only touch SQLite when the
+    key is not in memory, and SQLite hits are promoted to memory.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl: float = 24 * 3600,
+        file: Optional[Path] = None,
+        max_file_bytes: int = 100 * 1024 * 1024,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_file_bytes = max_file_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._con: Optional[sqlite3.Connection] = None
+        self._writes = 0
+        if file is not None:
+            self._con = sqlite3.connect(str(file), check_same_thread=False)
+            with self._con:
+                self._con.execute(
+                    'CREATE TABLE IF NOT EXISTS response_cache ('
+                    ' key TEXT PRIMARY KEY,'
+                    ' response TEXT NOT NULL,'
+                    ' created_at REAL NOT NULL,'
+                    ' size INTEGER NOT NULL'
+                    ');'
+                )
+                self._con.execute(
+                    'CREATE INDEX IF NOT EXISTS response_cache_created_at ON response_cache (created_at);'
+                )
+
+    @property
+    def persistent(self) -> bool:
+        """Whether lookups may hit the SQLite file, and so shouldn't run on the event loop."""
+        return self._con is not None
+
+    def get(self, key: str) -> Optional[str]:
+        """Get a cached response, counting the lookup as a hit or a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[0] > now:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._memory[key]
+            if self._con is not None:
+                row = self._con.execute(
+                    'SELECT response, created_at FROM response_cache WHERE key = ?;', (key,)
+                ).fetchone()
+                if row is not None and row[1] + self.ttl > now:
+                    self._remember(key, row[0], row[1] + self.ttl)
+                    self.hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, response: str):
+        """Store a response under `key` in every tier."""
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now + self.ttl)
+            if self._con is not None:
+                with self._con:
+                    self._con.execute(
+                        'INSERT OR REPLACE INTO response_cache (key, response, created_at, size)'
+                        ' VALUES (?, ?, ?, ?);',
+                        (key, response, now, len(response.encode('utf-8'))),
+                    )
+                self._writes += 1
+                if self._writes % EVICTION_INTERVAL == 0:
+                    self._evict_file(now)
+
+    def stats(self) -> Dict[str, int]:
+        """Get hit/miss counters and the number of entries held in memory."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._memory)}
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+
+    def _remember(self, key: str, response: str, expires_at: float):
+        self._memory[key] = (expires_at, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_file(self, now: float):
+        """Drop expired entries, then the oldest ones until the file tier fits its size limit."""
+        assert self._con is not None
+        with self._con:
+            self._con.execute('DELETE FROM response_cache WHERE created_at <= ?;', (now - self.ttl,))
+            total = self._con.execute('SELECT COALESCE(SUM(size), 0) FROM response_cache;').fetchone()[0]
+            if total <= self.max_file_bytes:
+                return
+            rows = self._con.execute('SELECT key, size FROM response_cache ORDER BY created_at;')
+            evict = []
+            for key, size in rows:
+                if total <= self.max_file_bytes:
+                    break
+                evict.append((key,))
+                total -= size
+            self._con.executemany('DELETE FROM response_cache WHERE key = ?;', evict)
@@ -0,0 +1,232 @@
+"""
+Admission control for upstream LLM calls.
+
+Each model gets its own first-come-first-served queue in front of Together,
+limited both by the number of generations in flight and by a token bucket
+matching the plan's request rate. Callers that can't be admitted within the
+maximum wait are rejected with `Overloaded`, which the app turns into a 503
+with a Retry-After header instead of letting the burst hit Together as 429s.
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, replace
+from typing import AsyncIterator, Deque, Dict, Optional
+
+
+@dataclass(frozen=True)
+class ModelLimits:
+    """Limits applied to the calls of a single model."""
+
+    max_in_flight: int = 32
+    requests_per_minute: float = 600
+    burst: int = 20
+    max_queue: int = 200
+    max_wait: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> 'ModelLimits':
+        """Read limits from TOGETHER_* environment variables, 0 requests per minute disables rate limiting."""
+        return cls(
+            max_in_flight=int(os.getenv("TOGETHER_MAX_IN_FLIGHT", str(cls.max_in_flight))),
+            requests_per_minute=float(os.getenv("TOGETHER_RATE_LIMIT_RPM", str(cls.requests_per_minute))),
+            burst=int(os.getenv("TOGETHER_RATE_LIMIT_BURST", str(cls.burst))),
+            max_queue=int(os.getenv("TOGETHER_MAX_QUEUE", str(cls.max_queue))),
+            max_wait=float(os.getenv("TOGETHER_QUEUE_MAX_WAIT", str(cls.max_wait))),
+        )
+
+    def per_worker(self, workers: int) -> 'ModelLimits':
+        """One process's share of the limits when `workers` processes call Together."""
+        if workers <= 1:
+            return self
+        return replace(
+            self,
+            max_in_flight=max(1, self.max_in_flight // workers),
+            requests_per_minute=self.requests_per_minute / workers,
+            burst=max(1, self.burst // workers),
+            max_queue=max(1, self.max_queue // workers),
+        )
+
+
+class Overloaded(Exception):
+    """Raised when a call can't be admitted, `retry_after` is a hint in seconds."""
+
+    def __init__(self, model: str, retry_after: int):
+        super().__init__(f"Too many requests for {model}, retry in {retry_after}s")
+        self.model = model
+        self.retry_after = retry_after
+
+
+class _ModelQueue:
+    def __init__(self, limits: ModelLimits):
+        self.limits = limits
+        self.in_flight = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.tokens = float(limits.burst)
+        self.refilled_at = time.monotonic()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        # Callers that went away while queued, or released their slot early
+        self.cancelled = 0
+        # Upstream requests sent within a slot besides its first, retries and hedges
+        self.extra = 0
+        # Hedges not sent to leave the rate budget to queued callers
+        self.hedges_skipped = 0
+
+    @property
+    def rate(self) -> float:
+        """Tokens added to the bucket per second, 0 when not rate limited."""
+        return self.limits.requests_per_minute / 60
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.limits.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+
+class Scheduler:
+    """Per-model fair queue with bounded concurrency and a token bucket rate limit.
+
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, limits: Optional[ModelLimits] = None, model_limits: Optional[Dict[str, ModelLimits]] = None):
+        self.limits = limits or ModelLimits()
+        self.model_limits = model_limits or {}
+        self._queues: Dict[str, _ModelQueue] = {}
+
+    @asynccontextmanager
+    async def slot(self, model: str) -> AsyncIterator[None]:
+        """Wait for permission to call `model`, holding it for the duration of the block."""
+        await self.acquire(model)
+        try:
+            yield
+        finally:
+            self.release(model)
+
+    async def acquire(self, model: str):
+        """Wait for permission to call `model`, every successful call must be paired with `release`.
+
+        Raises `Overloaded` if the queue is full or the wait exceeds the model's `max_wait`.
+        """
+        queue = self._queue(model)
+        if len(queue.waiters) >= queue.limits.max_queue:
+            queue.rejected += 1
+            raise Overloaded(model, self._retry_after(queue))
+
+        ticket = asyncio.get_running_loop().create_future()
+        queue.waiters.append(ticket)
+        self._dispatch(queue)
+        try:
+            await asyncio.wait_for(ticket, queue.limits.max_wait)
+        except asyncio.TimeoutError:
+            self._forget(queue, ticket)
+            queue.timed_out += 1
+            raise Overloaded(model, self._retry_after(queue)) from None
+        except asyncio.CancelledError:
+            if ticket.done() and not ticket.cancelled():
+                # Admitted just as the caller went away, hand the slot on
+                self.release(model, cancelled=True)
+            else:
+                self._forget(queue, ticket)
+                queue.cancelled += 1
+            raise
+
+    async def charge(self, model: str):
+        """Wait for the rate budget of another request within a slot already held, like a retry."""
+        queue = self._queue(model)
+        queue.refill()
+        while queue.rate and queue.tokens < 1:
+            await asyncio.sleep((1 - queue.tokens) / queue.rate)
+            queue.refill()
+        if queue.rate:
+            queue.tokens -= 1
+        queue.extra += 1
+
+    def try_charge(self, model: str) -> bool:
+        """Take the rate budget of an optional request within a slot already held, like a hedge.
+
+        Returns False without waiting when the bucket is empty or callers are queued for `model`.
+        """
+        queue = self._queue(model)
+        queue.refill()
+        if queue.waiters or (queue.rate and queue.tokens < 1):
+            queue.hedges_skipped += 1
+            return False
+        if queue.rate:
+            queue.tokens -= 1
+        queue.extra += 1
+        return True
+
+    def release(self, model: str, cancelled: bool = False):
+        """Give back a slot obtained with `acquire`, `cancelled` if the call was stopped before the end."""
+        queue = self._queues[model]
+        queue.in_flight -= 1
+        if cancelled:
+            queue.cancelled += 1
+        self._dispatch(queue)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Queue depth, in-flight calls and admission counters per model."""
+        return {
+            model: {
+                "in_flight": queue.in_flight,
+                "queued": len(queue.waiters),
+                "admitted": queue.admitted,
+                "rejected": queue.rejected,
+                "timed_out": queue.timed_out,
+                "cancelled": queue.cancelled,
+                "extra": queue.extra,
+                "hedges_skipped": queue.hedges_skipped,
+            }
+            for model, queue in self._queues.items()
+        }
+
+    def _queue(self, model: str) -> _ModelQueue:
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = self._queues[model] = _ModelQueue(self.model_limits.get(model, self.limits))
+        return queue
+
+    def _forget(self, queue: _ModelQueue, ticket: asyncio.Future):
+        try:
+            queue.waiters.remove(ticket)
+        except ValueError:
+            pass
+
+    def _dispatch(self, queue: _ModelQueue):
+        """Admit waiters from the head of the queue while there is capacity and rate budget."""
+        while queue.waiters and queue.in_flight < queue.limits.max_in_flight:
+            if queue.waiters[0].done():
+                # Timed out or cancelled while waiting
+                queue.waiters.popleft()
+                continue
+            queue.refill()
+            if queue.rate and queue.tokens < 1:
+                if queue.timer is None:
+                    delay = (1 - queue.tokens) / queue.rate
+                    queue.timer = asyncio.get_running_loop().call_later(delay, self._on_refill, queue)
+                return
+            ticket = queue.waiters.popleft()
+            if queue.rate:
+                queue.tokens -= 1
+            queue.in_flight += 1
+            queue.admitted += 1
+            ticket.set_result(None)
+
+    def _on_refill(self, queue: _ModelQueue):
+        queue.timer = None
+        self._dispatch(queue)
+
+    def _retry_after(self, queue: _ModelQueue) -> int:
+        """Rough number of seconds until the queue has drained enough to admit a new call."""
+        if queue.rate:
+            return max(1, math.ceil((len(queue.waiters) + 1) / queue.rate))
+        return max(1, math.ceil(queue.limits.max_wait))
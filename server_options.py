@@ -0,0 +1,79 @@
+"""
+How the server process is launched, shared by `python main.py` and gunicorn.conf.py.
+
+Every option is read from a CHAT_* environment variable, and `python main.py`
+also takes them as command line flags. With more than one worker, each process
+gets its share of the upstream limits (see `scheduler.ModelLimits.per_worker`)
+and they share the chat store: SQLite serializes the writes of processes on
+one host, Postgres those of several hosts.
+"""
+
+import argparse
+import importlib.util
+import os
+from dataclasses import dataclass, fields
+from typing import Any, Dict, List, Optional
+
+
+@dataclass(frozen=True)
+class ServerOptions:
+    host: str = '0.0.0.0'
+    port: int = 8000
+    # Server processes, each running its own event loop
+    workers: int = 1
+    # Event loop: auto picks uvloop when it's installed, asyncio otherwise
+    loop: str = 'auto'
+    # HTTP parser: auto picks httptools when it's installed, h11 otherwise
+    http: str = 'auto'
+    # Seconds an idle keep-alive connection is kept open
+    keep_alive: int = 5
+    # Connections waiting to be accepted
+    backlog: int = 2048
+
+    @classmethod
+    def from_env(cls) -> 'ServerOptions':
+        defaults = cls()
+        return cls(
+            host=os.getenv('CHAT_HOST', defaults.host),
+            port=int(os.getenv('CHAT_PORT', str(defaults.port))),
+            workers=int(os.getenv('CHAT_WORKERS', str(defaults.workers))),
+            loop=os.getenv('CHAT_LOOP', defaults.loop),
+            http=os.getenv('CHAT_HTTP', defaults.http),
+            keep_alive=int(os.getenv('CHAT_KEEP_ALIVE', str(defaults.keep_alive))),
+            backlog=int(os.getenv('CHAT_BACKLOG', str(defaults.backlog))),
+        )
+
+    @classmethod
+    def parse_args(cls, argv: Optional[List[str]] = None) -> 'ServerOptions':
+        """Command line flags, defaulting to the environment variables."""
+        env = cls.from_env()
+        parser = argparse.ArgumentParser(description='Run the chatbot server.')
+        parser.add_argument('--host', default=env.host)
+        parser.add_argument('--port', type=int, default=env.port)
+        parser.add_argument('--workers', type=int, default=env.workers)
+        parser.add_argument('--loop', choices=['auto', 'asyncio', 'uvloop'], default=env.loop)
+        parser.add_argument('--http', choices=['auto', 'h11', 'httptools'], default=env.http)
+        parser.add_argument('--keep-alive', type=int, default=env.keep_alive)
+        parser.add_argument('--backlog', type=int, default=env.backlog)
+        args = parser.parse_args(argv)
+        return cls(**{f.name: getattr(args, f.name) for f in fields(cls)})
+
+    def missing_packages(self) -> List[str]:
+        """Packages explicitly asked for that aren't installed."""
+        wanted = [name for name in (self.loop, self.http) if name in ('uvloop', 'httptools')]
+        return [name for name in wanted if importlib.util.find_spec(name) is None]
+
+    def export(self):
+        """Publish the options to the environment, where the worker processes read them."""
+        os.environ['CHAT_WORKERS'] = str(self.workers)
+
+    def uvicorn_kwargs(self) -> Dict[str, Any]:
+        return {
+            'host': self.host,
+            'port': self.port,
+            'workers': self.workers,
+            'loop': self.loop,
+            'http': self.http,
+            'timeout_keep_alive': self.keep_alive,
+            'backlog': self.backlog,
+        }
@@ -0,0 +1,154 @@
+"""
+Cold archive of idle threads for the SQLite store.
+
+Threads nobody has written to for `archive_after_days` are moved out of the
+database into append-only segment files of zstd frames, one frame per thread,
+so the hot database stays small enough to be served from the page cache.
+The index of where each thread's frame is lives in the database itself, see
+storage_sqlite.py, so moving a thread and recording it commit together.
+Opening an archived thread moves it back first.
+
+The frames are only written by the database's writer connection, while it
+holds SQLite's write lock, which also serializes the worker processes sharing
+the archive. Searches read them from the reader connections too.
+"""
+
+import os
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, List, Optional, Sequence
+
+import orjson
+
+try:
+    import zstandard
+except ImportError as e:
+    print(f"Error importing zstandard: {e}")
+    print("Please install it using:")
+    print("pip install zstandard")
+    sys.exit(1)
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    """When threads are archived, and how the archive and the database are compacted."""
+
+    # Days without a new message before a thread is archived, 0 never archives
+    archive_after_days: float = 30.0
+    # Seconds between passes of archiving, compaction and vacuum
+    interval: float = 3600.0
+    # Threads archived per transaction, so other writes don't wait long
+    batch_threads: int = 50
+    # Database pages freed per incremental vacuum step
+    vacuum_pages: int = 2000
+    # A segment file gets no new frames beyond this size
+    segment_bytes: int = 64 * 1024 * 1024
+    # Full segments whose restored threads leave less than this fraction live are rewritten
+    compact_below: float = 0.5
+    level: int = 9
+    # Where the segment files are, next to the database file by default
+    directory: Optional[Path] = None
+
+    @classmethod
+    def from_env(cls) -> 'RetentionPolicy':
+        """Read the policy from CHAT_ARCHIVE_* and CHAT_RETENTION_* environment variables."""
+        directory = os.getenv("CHAT_ARCHIVE_DIR")
+        return cls(
+            archive_after_days=float(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", str(cls.archive_after_days))),
+            interval=float(os.getenv("CHAT_RETENTION_INTERVAL", str(cls.interval))),
+            batch_threads=int(os.getenv("CHAT_ARCHIVE_BATCH", str(cls.batch_threads))),
+            vacuum_pages=int(os.getenv("CHAT_VACUUM_PAGES", str(cls.vacuum_pages))),
+            segment_bytes=int(os.getenv("CHAT_ARCHIVE_SEGMENT_BYTES", str(cls.segment_bytes))),
+            level=int(os.getenv("CHAT_ARCHIVE_LEVEL", str(cls.level))),
+            directory=Path(directory) if directory else None,
+        )
+
+
+def archive_directory(database_file: Path) -> Path:
+    """Where the segment files of a database go when CHAT_ARCHIVE_DIR isn't set."""
+    return database_file.with_suffix('.archive')
+
+
+class SegmentArchive:
+    """The segment files of a directory, `segment-000001.zst` and so on.
+
+    Writing isn't thread safe, it's done from the database's writer thread only,
+    while `read` and `unpack` are used from any thread.
+    """
+
+    def __init__(self, directory: Path, level: int = RetentionPolicy.level):
+        self.directory = directory
+        # Frames carry a checksum, a damaged segment fails to decompress instead of restoring garbage
+        self._compressor = zstandard.ZstdCompressor(level=level, write_checksum=True)
+
+    def path(self, segment: int) -> Path:
+        return self.directory / f'segment-{segment:06d}.zst'
+
+    def segments(self) -> List[int]:
+        """The segments with a file, including ones the database doesn't know after a crash."""
+        if not self.directory.is_dir():
+            return []
+        return sorted(
+            int(path.stem.removeprefix('segment-')) for path in self.directory.glob('segment-*.zst')
+        )
+
+    def append(self, segment: int, frames: Sequence[bytes]) -> List[int]:
+        """Append frames to a segment and flush them to disk, returns the position of each."""
+        new = not self.directory.is_dir()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(segment)
+        new = new or not path.exists()
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # After a rolled back transaction the file can be longer than the database knows
+            position = os.fstat(fd).st_size
+            positions = []
+            for frame in frames:
+                positions.append(position)
+                os.write(fd, frame)
+                position += len(frame)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if new:
+            _fsync_directory(self.directory)
+        return positions
+
+    def read(self, segment: int, position: int, length: int) -> bytes:
+        with open(self.path(segment), 'rb') as f:
+            f.seek(position)
+            frame = f.read(length)
+        if len(frame) != length:
+            raise ValueError(f'Segment {segment} ends before its frame at {position}')
+        return frame
+
+    def remove(self, segment: int):
+        self.path(segment).unlink(missing_ok=True)
+
+    def pack(self, rows: Sequence[Sequence[Any]]) -> bytes:
+        """A frame of a thread's message rows."""
+        return self._compressor.compress(orjson.dumps(rows))
+
+    def unpack(self, frame: bytes) -> List[List[Any]]:
+        """The message rows of a frame made by `pack`, ValueError if it's damaged."""
+        try:
+            # A decompressor per call, as they can't be shared between threads
+            data = zstandard.ZstdDecompressor().decompress(frame)
+        except zstandard.ZstdError as e:
+            raise ValueError(f'Damaged archive frame: {e}') from e
+        return orjson.loads(data)
+
+
+def _fsync_directory(directory: Path):
+    """Make a new file's directory entry durable, where the platform allows it."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
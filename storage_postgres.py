@@ -0,0 +1,390 @@
+"""
+Postgres implementation of `storage.Database`, through asyncpg.
+
+Chats live in a database shared by every worker process and host running the
+app, so they can be scaled out. Queries use a connection pool sized by
+CHAT_DB_POOL_SIZE, and the schema is created on first connect.
+"""
+
+from __future__ import annotations as _annotations
+
+import os
+import sys
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from typing_extensions import LiteralString
+
+from chat_message import Message, estimate_tokens
+from storage import (
+    HISTORY_LIMIT,
+    PAGE_SIZE,
+    SEARCH_PAGE_SIZE,
+    SNIPPET_END,
+    SNIPPET_START,
+    thread_title,
+)
+
+try:
+    import asyncpg
+except ImportError as e:
+    print(f"Error importing asyncpg: {e}")
+    print("A postgresql:// CHAT_DATABASE_URL needs asyncpg, install it using:")
+    print("pip install asyncpg")
+    sys.exit(1)
+
+# Connections in the pool of each app process
+POOL_SIZE = int(os.getenv('CHAT_DB_POOL_SIZE', '10'))
+
+# Advisory lock held while creating the schema, so workers starting together don't race
+SCHEMA_LOCK = 0x636861745F617070
+
+# Same layout as the SQLite schema, see storage_sqlite.py. Revisions of thread
+# summaries come from a sequence so they keep growing across processes.
+SCHEMA: tuple[LiteralString, ...] = (
+    'CREATE TABLE IF NOT EXISTS threads ('
+    ' id BIGSERIAL PRIMARY KEY,'
+    ' created_at TEXT NOT NULL'
+    ')',
+    'CREATE TABLE IF NOT EXISTS messages ('
+    ' id BIGSERIAL PRIMARY KEY,'
+    ' thread_id BIGINT NOT NULL REFERENCES threads (id) ON DELETE CASCADE,'
+    ' seq INTEGER NOT NULL,'
+    ' role TEXT NOT NULL,'
+    ' timestamp TEXT NOT NULL,'
+    ' content TEXT NOT NULL,'
+    ' tokens INTEGER'
+    ')',
+    # Branches, added to the table of older versions
+    'ALTER TABLE messages ADD COLUMN IF NOT EXISTS parent_id BIGINT REFERENCES messages (id) ON DELETE CASCADE',
+    'ALTER TABLE messages ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT TRUE',
+    'CREATE INDEX IF NOT EXISTS messages_parent_id ON messages (parent_id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS messages_thread_seq ON messages (thread_id, seq)',
+    'CREATE INDEX IF NOT EXISTS messages_thread_id ON messages (thread_id, id)',
+    'CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp)',
+    'CREATE TABLE IF NOT EXISTS thread_summaries ('
+    ' thread_id BIGINT PRIMARY KEY REFERENCES threads (id) ON DELETE CASCADE,'
+    ' title TEXT NOT NULL,'
+    ' first_timestamp TEXT NOT NULL,'
+    ' last_activity TEXT NOT NULL,'
+    ' message_count INTEGER NOT NULL,'
+    ' model TEXT,'
+    ' revision BIGINT NOT NULL'
+    ')',
+    'CREATE INDEX IF NOT EXISTS thread_summaries_revision ON thread_summaries (revision)',
+    'CREATE SEQUENCE IF NOT EXISTS thread_summary_revisions',
+    # Full-text index for `search_messages`, built from the existing messages when first created
+    "CREATE INDEX IF NOT EXISTS messages_search ON messages USING GIN (to_tsvector('english', content))",
+)
+
+# Search results are the best of this many most recent matches, see storage_sqlite.SEARCH_CANDIDATES
+SEARCH_CANDIDATES = 2000
+
+# Whether the messages table predates branches, checked before creating the schema
+HAS_BRANCHES: LiteralString = (
+    "SELECT 1 FROM information_schema.columns WHERE table_name = 'messages' AND column_name = 'parent_id'"
+)
+
+# Chain messages stored before branches existed, each to the previous one of its thread
+LINK_PARENTS: LiteralString = (
+    'UPDATE messages SET parent_id = previous.id FROM messages previous'
+    ' WHERE previous.thread_id = messages.thread_id AND previous.seq = messages.seq - 1'
+)
+
+# The message ids from $1 up to the root of its branch, see storage_sqlite.ANCESTORS
+ANCESTORS: LiteralString = (
+    'WITH RECURSIVE ancestors (id, parent_id) AS ('
+    ' SELECT id, parent_id FROM messages WHERE id = $1'
+    ' UNION ALL'
+    ' SELECT messages.id, messages.parent_id FROM messages JOIN ancestors ON messages.id = ancestors.parent_id'
+    ') SELECT id FROM ancestors'
+)
+
+
+@dataclass
+class PostgresDatabase:
+    """Chat store in Postgres, see `storage.Database`."""
+
+    pool: asyncpg.Pool
+
+    @classmethod
+    @asynccontextmanager
+    async def connect(cls, url: str, pool_size: int = POOL_SIZE) -> AsyncIterator[PostgresDatabase]:
+        pool = await asyncpg.create_pool(url, min_size=1, max_size=pool_size)
+        try:
+            async with pool.acquire() as con, con.transaction():
+                await con.execute('SELECT pg_advisory_xact_lock($1)', SCHEMA_LOCK)
+                link_parents = await con.fetchval(HAS_BRANCHES) is None
+                for statement in SCHEMA:
+                    await con.execute(statement)
+                if link_parents:
+                    await con.execute(LINK_PARENTS)
+            yield cls(pool)
+        finally:
+            await pool.close()
+
+    async def thread_exists(self, thread_id: int) -> bool:
+        return await self.pool.fetchval('SELECT 1 FROM threads WHERE id = $1', thread_id) is not None
+
+    async def find_message(self, message_id: int) -> Optional[Tuple[int, str]]:
+        row = await self.pool.fetchrow('SELECT thread_id, role FROM messages WHERE id = $1', message_id)
+        return row and (row['thread_id'], row['role'])
+
+    async def add_messages(
+        self,
+        messages: List[Message],
+        thread_id: Optional[int] = None,
+        model: Optional[str] = None,
+        edit_id: Optional[int] = None,
+    ) -> Tuple[int, List[int]]:
+        """Append messages to a thread, or to a new thread if `thread_id` is None.
+
+        With `edit_id` the messages replace that message of the thread instead, as a new
+        branch from its parent that becomes the active one.
+        The thread's summary is updated in the same transaction, recording `model`
+        as the last model used if given.
+        Returns the id of the thread the messages were stored in, and the ids of the messages.
+        """
+        async with self.pool.acquire() as con, con.transaction():
+            revision = await con.fetchval("SELECT nextval('thread_summary_revisions')")
+            parent_id = None
+            message_ids: List[int] = []
+            # Change in the length of the active branch, besides the new messages
+            switched = 0
+            if thread_id is None:
+                thread_id = await con.fetchval(
+                    'INSERT INTO threads (created_at) VALUES ($1) RETURNING id',
+                    messages[0].timestamp if messages else '',
+                )
+                next_seq = 0
+            else:
+                # Appends to the same thread from other processes wait for this one,
+                # so each gets the next free seq
+                await con.execute('SELECT 1 FROM threads WHERE id = $1 FOR UPDATE', thread_id)
+                next_seq = await con.fetchval(
+                    'SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE thread_id = $1', thread_id
+                )
+                if edit_id is None:
+                    parent_id = await con.fetchval(
+                        'SELECT id FROM messages WHERE thread_id = $1 AND active ORDER BY seq DESC LIMIT 1',
+                        thread_id,
+                    )
+                else:
+                    row = await con.fetchrow(
+                        'SELECT parent_id FROM messages WHERE id = $1 AND thread_id = $2', edit_id, thread_id
+                    )
+                    if row is None:
+                        raise ValueError(f'Message {edit_id} is not in thread {thread_id}')
+                    parent_id = row['parent_id']
+                    # Only the messages that differ between the old and the new branch change
+                    switched -= await con.fetchval(
+                        'WITH changed AS ('
+                        ' UPDATE messages SET active = FALSE'
+                        f' WHERE thread_id = $2 AND active AND id NOT IN ({ANCESTORS}) RETURNING 1'
+                        ') SELECT COUNT(*) FROM changed',
+                        parent_id,
+                        thread_id,
+                    )
+                    switched += await con.fetchval(
+                        'WITH changed AS ('
+                        f' UPDATE messages SET active = TRUE WHERE id IN ({ANCESTORS}) AND NOT active RETURNING 1'
+                        ') SELECT COUNT(*) FROM changed',
+                        parent_id,
+                    )
+            for i, m in enumerate(messages):
+                parent_id = await con.fetchval(
+                    'INSERT INTO messages (thread_id, seq, role, timestamp, content, tokens, parent_id)'
+                    ' VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING id',
+                    thread_id, next_seq + i, m.role, m.timestamp, m.content, estimate_tokens(m.content),
+                    parent_id,
+                )
+                message_ids.append(parent_id)
+            if next_seq == 0:
+                await con.execute(
+                    'INSERT INTO thread_summaries'
+                    ' (thread_id, title, first_timestamp, last_activity, message_count, model, revision)'
+                    ' VALUES ($1, $2, $3, $4, $5, $6, $7)'
+                    ' ON CONFLICT (thread_id) DO UPDATE SET title = EXCLUDED.title,'
+                    ' first_timestamp = EXCLUDED.first_timestamp, last_activity = EXCLUDED.last_activity,'
+                    ' message_count = EXCLUDED.message_count, model = EXCLUDED.model, revision = EXCLUDED.revision',
+                    thread_id,
+                    thread_title(messages[0].content) if messages else '',
+                    messages[0].timestamp if messages else '',
+                    messages[-1].timestamp if messages else '',
+                    len(messages),
+                    model,
+                    revision,
+                )
+            else:
+                # The title comes from the first message of the active branch, which an edit can change
+                new_root = await con.fetchrow(
+                    'SELECT content, timestamp FROM messages WHERE thread_id = $1 AND active ORDER BY seq LIMIT 1',
+                    thread_id,
+                ) if edit_id is not None else None
+                await con.execute(
+                    'UPDATE thread_summaries SET title = COALESCE($1, title),'
+                    ' first_timestamp = COALESCE($2, first_timestamp), last_activity = $3,'
+                    ' message_count = message_count + $4, model = COALESCE($5, model), revision = $6'
+                    ' WHERE thread_id = $7',
+                    thread_title(new_root['content']) if new_root else None,
+                    new_root['timestamp'] if new_root else None,
+                    messages[-1].timestamp if messages else '',
+                    len(messages) + switched,
+                    model,
+                    revision,
+                    thread_id,
+                )
+        return thread_id, message_ids
+
+    async def get_chat_history(
+        self,
+        thread_id: int,
+        edit_id: Optional[int] = None,
+        limit: int = HISTORY_LIMIT,
+    ) -> List[Message]:
+        """Get a thread's most recent messages, oldest first, as history for the Together API.
+
+        The history is the active branch, or with `edit_id` the branch leading to the
+        edited message, without it, found by following parent ids up from it.
+        Each message carries its cached `tokens` estimate for context window budgeting.
+        """
+        if edit_id is not None:
+            rows = await self.pool.fetch(
+                'WITH RECURSIVE branch (id, parent_id, depth) AS ('
+                ' SELECT parent.id, parent.parent_id, 1 FROM messages edited'
+                ' JOIN messages parent ON parent.id = edited.parent_id'
+                ' WHERE edited.id = $1 AND edited.thread_id = $2'
+                ' UNION ALL'
+                ' SELECT messages.id, messages.parent_id, branch.depth + 1 FROM messages'
+                ' JOIN branch ON messages.id = branch.parent_id WHERE branch.depth < $3'
+                ')'
+                ' SELECT role, timestamp, content, tokens FROM branch JOIN messages USING (id)'
+                ' ORDER BY depth',
+                edit_id,
+                thread_id,
+                limit,
+            )
+        else:
+            rows = await self.pool.fetch(
+                'SELECT role, timestamp, content, tokens FROM messages'
+                ' WHERE thread_id = $1 AND active ORDER BY seq DESC LIMIT $2',
+                thread_id,
+                limit,
+            )
+        return [
+            Message(row['role'], row['content'], row['timestamp'], tokens=row['tokens'])
+            for row in reversed(rows)
+        ]
+
+    async def get_messages(
+        self,
+        thread_id: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: int = PAGE_SIZE,
+    ) -> AsyncIterator[Message]:
+        """Get a page of messages in a format suitable for the frontend, oldest first.
+
+        The page is the `limit` most recent messages of active branches with an id
+        below `before`. It's fetched whole, so the pooled connection is given back
+        before a slow client consumes the page.
+        """
+        conditions = ['active']
+        params: List[Any] = []
+        if thread_id is not None:
+            params.append(thread_id)
+            conditions.append(f'thread_id = ${len(params)}')
+        if before is not None:
+            params.append(before)
+            conditions.append(f'id < ${len(params)}')
+        params.append(limit)
+        where = ' WHERE ' + ' AND '.join(conditions)
+        rows = await self.pool.fetch(
+            'SELECT id, role, timestamp, content FROM ('
+            ' SELECT id, role, timestamp, content FROM messages'
+            f'{where} ORDER BY id DESC LIMIT ${len(params)}'
+            ') AS page ORDER BY id',
+            *params,
+        )
+        for row in rows:
+            yield Message(row['role'], row['content'], row['timestamp'], row['id'])
+
+    async def clear_messages(self):
+        """Clear all messages from the database."""
+        await self.pool.execute('DELETE FROM threads')
+
+    async def get_threads(
+        self, before: Optional[int] = None, limit: int = PAGE_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Get a page of conversation threads with ids below `before`, newest first.
+
+        Fetched whole before any thread is yielded, like the pages of `get_messages`.
+        """
+        rows = await self.pool.fetch(
+            'SELECT thread_id, title, first_timestamp, last_activity, message_count, model'
+            ' FROM thread_summaries WHERE thread_id < $1'
+            ' ORDER BY thread_id DESC LIMIT $2',
+            before if before is not None else sys.maxsize,
+            limit,
+        )
+        for row in rows:
+            yield {
+                "id": row['thread_id'],
+                "title": row['title'],
+                "timestamp": row['first_timestamp'],
+                "last_activity": row['last_activity'],
+                "message_count": row['message_count'],
+                "model": row['model'],
+            }
+
+    async def search_messages(
+        self, query: str, offset: int = 0, limit: int = SEARCH_PAGE_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Get a page of the messages on active branches matching the words of `query`, best first.
+
+        The SEARCH_CANDIDATES most recent matches of the GIN index are ranked with
+        ts_rank, and headlines are only made for the messages of the page.
+        """
+        rows = await self.pool.fetch(
+            "WITH query AS (SELECT plainto_tsquery('english', $1) AS q), candidates AS ("
+            ' SELECT id, thread_id, role, timestamp, content,'
+            "  ts_rank(to_tsvector('english', content), query.q) AS score"
+            " FROM messages, query WHERE to_tsvector('english', content) @@ query.q AND active"
+            ' ORDER BY id DESC LIMIT $2'
+            '), page AS ('
+            ' SELECT * FROM candidates ORDER BY score DESC, id DESC LIMIT $3 OFFSET $4'
+            ')'
+            ' SELECT page.id, page.thread_id, thread_summaries.title, page.role, page.timestamp,'
+            "  ts_headline('english', page.content, query.q,"
+            "   'StartSel=' || $5 || ', StopSel=' || $6 || ', MaxWords=24, MinWords=8') AS snippet"
+            ' FROM page CROSS JOIN query'
+            ' LEFT JOIN thread_summaries ON thread_summaries.thread_id = page.thread_id'
+            ' ORDER BY page.score DESC, page.id DESC',
+            query,
+            SEARCH_CANDIDATES,
+            limit,
+            offset,
+            SNIPPET_START,
+            SNIPPET_END,
+        )
+        for row in rows:
+            yield {
+                'id': row['id'],
+                'thread_id': row['thread_id'],
+                'title': row['title'],
+                'role': row['role'],
+                'timestamp': row['timestamp'],
+                'snippet': row['snippet'],
+            }
+
+    async def get_threads_version(self) -> str:
+        """Changes whenever a thread is added, updated or removed, for the GET /threads/ ETag.
+
+        Thread ids are never reused, so the latest one tells states before and after a reset apart.
+        """
+        row = await self.pool.fetchrow(
+            'SELECT (SELECT MAX(revision) FROM thread_summaries), (SELECT MAX(id) FROM threads)'
+        )
+        revision, last_thread_id = row[0], row[1]
+        return f'{revision or 0}-{last_thread_id or 0}'
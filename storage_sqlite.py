@@ -0,0 +1,1043 @@
+"""
+SQLite implementation of `storage.Database`, the default store.
+
+Everything lives in a single file next to the app. WAL mode lets requests read
+while another one writes, and several worker processes can share the file on
+one host, SQLite's file locks serializing their writes. Idle threads are moved
+to compressed segment files, see storage_archive.py, and the pages they free
+are given back to the file system by incremental vacuum.
+"""
+
+from __future__ import annotations as _annotations
+
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections.abc import AsyncIterator
+from concurrent.futures.thread import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from typing_extensions import Concatenate, LiteralString, ParamSpec
+
+import metrics
+from chat_message import Message, estimate_tokens
+from storage import (
+    HISTORY_LIMIT,
+    PAGE_SIZE,
+    SEARCH_PAGE_SIZE,
+    SNIPPET_END,
+    SNIPPET_START,
+    thread_title,
+)
+from storage_archive import RetentionPolicy, SegmentArchive, archive_directory
+
+# The file used when CHAT_DATABASE_URL isn't set
+DEFAULT_FILE = Path(__file__).parent / '.chat_app_messages.sqlite'
+
+P = ParamSpec('P')
+R = TypeVar('R')
+
+# A queued write: the function, its positional arguments after the connection, and the caller's future
+_Write = tuple[Callable[..., Any], tuple[Any, ...], 'asyncio.Future[Any]']
+
+
+# Read-only connections in the pool, each read holds one for its duration
+READ_CONNECTIONS = int(os.getenv('CHAT_DB_READERS', '4'))
+
+# Settings of every connection. In WAL mode readers don't block the writer nor the
+# other way around, and synchronous=NORMAL can only lose the last commits on power
+# loss, never corrupt the file.
+CONNECTION_PRAGMAS: tuple[LiteralString, ...] = (
+    'PRAGMA foreign_keys = ON;',
+    'PRAGMA busy_timeout = 5000;',
+    'PRAGMA synchronous = NORMAL;',
+    # 32 MiB page cache per connection
+    'PRAGMA cache_size = -32000;',
+    # Read pages through a 256 MiB memory map instead of copying them
+    'PRAGMA mmap_size = 268435456;',
+    'PRAGMA temp_store = MEMORY;',
+)
+
+# What the sidebar shows of each thread, kept up to date by `add_messages` so GET /threads/
+# doesn't touch the messages table. `revision` grows with every change, for the ETag.
+THREAD_SUMMARIES_TABLE: LiteralString = (
+    'CREATE TABLE IF NOT EXISTS thread_summaries ('
+    ' thread_id INTEGER PRIMARY KEY REFERENCES threads (id) ON DELETE CASCADE,'
+    ' title TEXT NOT NULL,'
+    ' first_timestamp TEXT NOT NULL,'
+    ' last_activity TEXT NOT NULL,'
+    ' message_count INTEGER NOT NULL,'
+    ' model TEXT,'
+    ' revision INTEGER NOT NULL'
+    ');'
+)
+
+# Full-text index of message contents for `search_messages`. It stores only the index,
+# the text is read from the messages table, and `add_messages` adds each new message.
+SEARCH_TABLE: LiteralString = (
+    'CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5('
+    " content, content = 'messages', content_rowid = 'id', tokenize = 'porter unicode61'"
+    ');'
+)
+
+# Tokens of context in a search result snippet
+SNIPPET_TOKENS = 16
+
+# Search results are the best of this many most recent matches. Ranking costs about
+# 5 microseconds per match, so ranking every match of a common word would grow with the store.
+SEARCH_CANDIDATES = 2000
+
+# One row per conversation, and one row per message keyed by its position in the thread.
+# `tokens` caches the message's estimated token count for context window budgeting.
+# Messages form a tree through `parent_id`: editing a message starts a new branch from
+# its parent, sharing the messages before it. `active` marks the branch that is shown
+# and continued, the one created by the latest edit.
+SCHEMA: tuple[LiteralString, ...] = (
+    'CREATE TABLE IF NOT EXISTS threads ('
+    ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+    ' created_at TEXT NOT NULL'
+    ');',
+    'CREATE TABLE IF NOT EXISTS messages ('
+    ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+    ' thread_id INTEGER NOT NULL REFERENCES threads (id) ON DELETE CASCADE,'
+    ' seq INTEGER NOT NULL,'
+    ' role TEXT NOT NULL,'
+    ' timestamp TEXT NOT NULL,'
+    ' content TEXT NOT NULL,'
+    ' tokens INTEGER,'
+    ' parent_id INTEGER REFERENCES messages (id) ON DELETE CASCADE,'
+    ' active INTEGER NOT NULL DEFAULT 1'
+    ');',
+    'CREATE UNIQUE INDEX IF NOT EXISTS messages_thread_seq ON messages (thread_id, seq);',
+    'CREATE INDEX IF NOT EXISTS messages_thread_id ON messages (thread_id, id);',
+    'CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);',
+    THREAD_SUMMARIES_TABLE,
+    'CREATE INDEX IF NOT EXISTS thread_summaries_revision ON thread_summaries (revision);',
+    SEARCH_TABLE,
+)
+
+# Index of the archive, see storage_archive.py. A thread's messages are in the frame at
+# `position` of a segment file while `segment` is set; restored threads keep their row,
+# with `restored_at`, so they aren't archived again before they've been idle for as long.
+# `live_bytes` of a segment counts the frames of threads still archived.
+# Archived messages keep their entries in messages_fts, and `archived_messages` keeps
+# what `search_messages` needs of them besides the text, which is read from the frame.
+ARCHIVE_SCHEMA: tuple[LiteralString, ...] = (
+    'CREATE TABLE IF NOT EXISTS archive_segments ('
+    ' id INTEGER PRIMARY KEY,'
+    ' bytes INTEGER NOT NULL,'
+    ' live_bytes INTEGER NOT NULL'
+    ');',
+    'CREATE TABLE IF NOT EXISTS thread_archive ('
+    ' thread_id INTEGER PRIMARY KEY REFERENCES threads (id) ON DELETE CASCADE,'
+    ' segment INTEGER REFERENCES archive_segments (id),'
+    ' position INTEGER,'
+    ' length INTEGER,'
+    ' archived_at TEXT NOT NULL,'
+    ' restored_at TEXT'
+    ');',
+    'CREATE INDEX IF NOT EXISTS thread_archive_segment ON thread_archive (segment);',
+    'CREATE TABLE IF NOT EXISTS archived_messages ('
+    ' id INTEGER PRIMARY KEY,'
+    ' thread_id INTEGER NOT NULL REFERENCES threads (id) ON DELETE CASCADE,'
+    ' role TEXT NOT NULL,'
+    ' timestamp TEXT NOT NULL,'
+    ' active INTEGER NOT NULL'
+    ');',
+    'CREATE INDEX IF NOT EXISTS archived_messages_thread_id ON archived_messages (thread_id);',
+    'CREATE INDEX IF NOT EXISTS thread_summaries_last_activity ON thread_summaries (last_activity);',
+)
+
+# Columns of the message rows in the archive frames
+ARCHIVED_COLUMNS: LiteralString = 'id, seq, role, timestamp, content, tokens, parent_id, active'
+
+# Scratch index of archived messages found by a search, to make their snippets like those
+# of the other messages. Created in a new in-memory database, as readers can't write.
+ARCHIVED_SNIPPETS_TABLE: LiteralString = (
+    "CREATE VIRTUAL TABLE snippets USING fts5(content, tokenize = 'porter unicode61');"
+)
+
+# `PRAGMA auto_vacuum` of a file where free pages are given back by `PRAGMA incremental_vacuum`
+INCREMENTAL_VACUUM = 2
+
+# Created once the branch columns exist, see `_connect`
+BRANCH_INDEX: LiteralString = 'CREATE INDEX IF NOT EXISTS messages_parent_id ON messages (parent_id);'
+
+# The message ids from `?` up to the root of its branch, at most O(depth) primary key lookups
+ANCESTORS: LiteralString = (
+    'WITH RECURSIVE ancestors (id, parent_id) AS ('
+    ' SELECT id, parent_id FROM messages WHERE id = ?'
+    ' UNION ALL'
+    ' SELECT messages.id, messages.parent_id FROM messages JOIN ancestors ON messages.id = ancestors.parent_id'
+    ') SELECT id FROM ancestors'
+)
+
+
+@dataclass
+class SQLiteDatabase:
+    """Rudimentary database to store chat messages in SQLite, see `storage.Database`.
+
+    The SQLite standard library package is synchronous, so we
+    use thread pool executors to run queries asynchronously.
+    The file is in WAL mode: reads run on a pool of read-only connections and
+    never wait for a write, while all writes go through a single connection
+    that commits the writes queued while it was busy in one transaction.
+    """
+
+    con: sqlite3.Connection
+    _loop: asyncio.AbstractEventLoop
+    _executor: ThreadPoolExecutor
+    _read_executor: ThreadPoolExecutor
+    _readers: asyncio.Queue[sqlite3.Connection]
+    _archive: SegmentArchive
+    _pending_writes: List[_Write] = field(default_factory=list)
+    _flush_task: Optional[asyncio.Task[None]] = None
+
+    @classmethod
+    @asynccontextmanager
+    async def connect(
+        cls,
+        file: Path = DEFAULT_FILE,
+        readers: int = READ_CONNECTIONS,
+        retention: Optional[RetentionPolicy] = None,
+    ) -> AsyncIterator[SQLiteDatabase]:
+        """Open the store in `file`, applying `retention` in the background if given.
+
+        Threads archived earlier are restored when they're opened either way.
+        """
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        con = await loop.run_in_executor(executor, cls._connect, file)
+        reader_pool: asyncio.Queue[sqlite3.Connection] = asyncio.Queue()
+        for _ in range(readers):
+            reader_pool.put_nowait(await loop.run_in_executor(read_executor, cls._connect_reader, file))
+        policy = retention or RetentionPolicy()
+        archive = SegmentArchive(policy.directory or archive_directory(file), policy.level)
+        slf = cls(con, loop, executor, read_executor, reader_pool, archive)
+        retention_task = asyncio.create_task(slf._keep_retention(retention)) if retention is not None else None
+        try:
+            yield slf
+        finally:
+            if retention_task is not None:
+                retention_task.cancel()
+                await asyncio.gather(retention_task, return_exceptions=True)
+            if slf._flush_task is not None:
+                await slf._flush_task
+            while not reader_pool.empty():
+                await slf._asyncify(reader_pool.get_nowait().close)
+            await loop.run_in_executor(executor, con.close)
+            executor.shutdown()
+            read_executor.shutdown()
+
+    @classmethod
+    def _connect(cls, file: Path) -> sqlite3.Connection:
+        # Transactions are managed explicitly, see `_commit_writes`
+        con = sqlite3.connect(str(file), isolation_level=None)
+        for pragma in CONNECTION_PRAGMAS:
+            con.execute(pragma)
+        cls._enable_incremental_vacuum(con)
+        # After busy_timeout, and taking the write lock right away, so worker
+        # processes starting together wait for each other instead of failing
+        con.execute('PRAGMA journal_mode = WAL;')
+        con.execute('BEGIN IMMEDIATE;')
+        backfill_summaries = not con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'thread_summaries';"
+        ).fetchone()
+        backfill_search = not con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts';"
+        ).fetchone()
+        cls._migrate_message_lists(con)
+        for statement in SCHEMA:
+            con.execute(statement)
+        columns = {row[1] for row in con.execute('PRAGMA table_info(messages);')}
+        if 'tokens' not in columns:
+            con.execute('ALTER TABLE messages ADD COLUMN tokens INTEGER;')
+        if 'parent_id' not in columns:
+            con.execute('ALTER TABLE messages ADD COLUMN parent_id INTEGER REFERENCES messages (id) ON DELETE CASCADE;')
+            con.execute('ALTER TABLE messages ADD COLUMN active INTEGER NOT NULL DEFAULT 1;')
+            cls._link_parents(con)
+        con.execute(BRANCH_INDEX)
+        for statement in ARCHIVE_SCHEMA:
+            con.execute(statement)
+        if backfill_summaries:
+            cls._backfill_thread_summaries(con)
+        if backfill_search:
+            cls._backfill_search(con)
+        con.execute('COMMIT;')
+        return con
+
+    @staticmethod
+    def _enable_incremental_vacuum(con: sqlite3.Connection):
+        """Let `_vacuum` give free pages back, which needs auto_vacuum set before the tables exist.
+
+        Files from older versions are rebuilt once with VACUUM to switch.
+        """
+        if con.execute('PRAGMA auto_vacuum;').fetchone()[0] == INCREMENTAL_VACUUM:
+            return
+        con.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+        if not con.execute('SELECT 1 FROM sqlite_master LIMIT 1;').fetchone():
+            return
+        print("Rebuilding the database for incremental vacuum...")
+        try:
+            con.execute('VACUUM;')
+        except sqlite3.OperationalError as e:
+            # Another worker process is using the file, one of the next starts will do it
+            print(f"Error rebuilding the database, free pages won't be given back yet: {e}")
+
+    @staticmethod
+    def _connect_reader(file: Path) -> sqlite3.Connection:
+        # Used from any thread of the read executor, but by one query at a time
+        con = sqlite3.connect(str(file), isolation_level=None, check_same_thread=False)
+        for pragma in CONNECTION_PRAGMAS:
+            con.execute(pragma)
+        con.execute('PRAGMA query_only = ON;')
+        return con
+
+    @staticmethod
+    def _backfill_thread_summaries(con: sqlite3.Connection):
+        """Summarize the threads stored before the thread_summaries table existed."""
+        rows = con.execute(
+            'SELECT threads.id, first.content, first.timestamp, MAX(messages.timestamp), COUNT(*)'
+            ' FROM threads'
+            ' JOIN messages first ON first.thread_id = threads.id AND first.seq = 0'
+            ' JOIN messages ON messages.thread_id = threads.id'
+            ' WHERE threads.id NOT IN (SELECT thread_id FROM thread_summaries)'
+            ' GROUP BY threads.id'
+        ).fetchall()
+        if rows:
+            print(f"Summarizing {len(rows)} threads for the sidebar...")
+        con.executemany(
+            'INSERT INTO thread_summaries'
+            ' (thread_id, title, first_timestamp, last_activity, message_count, revision)'
+            ' VALUES (?, ?, ?, ?, ?, 1);',
+            [
+                (thread_id, thread_title(content), first, last, count)
+                for thread_id, content, first, last, count in rows
+            ],
+        )
+
+    @staticmethod
+    def _backfill_search(con: sqlite3.Connection):
+        """Index the messages stored before the search index existed."""
+        count = con.execute('SELECT COUNT(*) FROM messages;').fetchone()[0]
+        if count:
+            print(f"Indexing {count} messages for search...")
+        con.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');")
+
+    @staticmethod
+    def _link_parents(con: sqlite3.Connection):
+        """Chain the messages stored before branches existed, each to the previous one of its thread."""
+        con.execute(
+            'UPDATE messages SET parent_id = ('
+            ' SELECT previous.id FROM messages previous'
+            ' WHERE previous.thread_id = messages.thread_id AND previous.seq = messages.seq - 1'
+            ') WHERE seq > 0;'
+        )
+
+    @staticmethod
+    def _migrate_message_lists(con: sqlite3.Connection):
+        """Move an old `messages (id, message_list)` table into the threads/messages schema.
+
+        Each old row was one conversation holding a JSON list of messages, it becomes
+        a thread with the same id so existing `thread_id` links keep working.
+        Runs inside the caller's transaction, so a failed migration leaves the file untouched.
+        """
+        columns = {row[1] for row in con.execute('PRAGMA table_info(messages);')}
+        if 'message_list' not in columns:
+            return
+        print("Migrating chat messages to the threads/messages schema...")
+        con.execute('ALTER TABLE messages RENAME TO message_lists;')
+        for statement in SCHEMA:
+            con.execute(statement)
+        rows = con.execute('SELECT id, message_list FROM message_lists ORDER BY id;')
+        for thread_id, message_list in rows.fetchall():
+            try:
+                msg_list = json.loads(message_list)
+            except json.JSONDecodeError as e:
+                print(f"Error parsing message: {e}")
+                continue
+            msgs = [
+                m for m in msg_list
+                if isinstance(m, dict) and 'role' in m and 'content' in m
+            ] if isinstance(msg_list, list) else []
+            if not msgs:
+                continue
+            con.execute(
+                'INSERT INTO threads (id, created_at) VALUES (?, ?);',
+                (thread_id, msgs[0].get('timestamp', '')),
+            )
+            con.executemany(
+                'INSERT INTO messages (thread_id, seq, role, timestamp, content, tokens)'
+                ' VALUES (?, ?, ?, ?, ?, ?);',
+                [
+                    (thread_id, seq, m['role'], m.get('timestamp', ''), m['content'], estimate_tokens(m['content']))
+                    for seq, m in enumerate(msgs)
+                ],
+            )
+        con.execute('DROP TABLE message_lists;')
+        SQLiteDatabase._link_parents(con)
+
+    async def thread_exists(self, thread_id: int) -> bool:
+        row = await self._read(_fetchone, 'SELECT 1 FROM threads WHERE id = ?', thread_id)
+        return row is not None
+
+    async def find_message(self, message_id: int) -> Optional[Tuple[int, str]]:
+        row = await self._read(_fetchone, 'SELECT thread_id, role FROM messages WHERE id = ?', message_id)
+        if row is None:
+            archived = await self._read(_fetchone, 'SELECT thread_id FROM archived_messages WHERE id = ?', message_id)
+            if archived is not None and await self._restore(archived[0]):
+                return await self.find_message(message_id)
+        return row and (row[0], row[1])
+
+    async def add_messages(
+        self,
+        messages: List[Message],
+        thread_id: Optional[int] = None,
+        model: Optional[str] = None,
+        edit_id: Optional[int] = None,
+    ) -> Tuple[int, List[int]]:
+        """Append messages to a thread, or to a new thread if `thread_id` is None.
+
+        With `edit_id` the messages replace that message of the thread instead, as a new
+        branch from its parent that becomes the active one.
+        The thread's summary is updated in the same transaction, recording `model`
+        as the last model used if given.
+        Returns the id of the thread the messages were stored in, and the ids of the messages.
+        """
+        return await self._write(self._restore_and_insert, messages, thread_id, model, edit_id)
+
+    def _restore_and_insert(
+        self,
+        con: sqlite3.Connection,
+        messages: List[Message],
+        thread_id: Optional[int],
+        model: Optional[str] = None,
+        edit_id: Optional[int] = None,
+    ) -> Tuple[int, List[int]]:
+        # A thread can be archived while its answer is generated
+        if thread_id is not None:
+            self._restore_thread(con, thread_id)
+        return self._insert_messages(con, messages, thread_id, model, edit_id)
+
+    @staticmethod
+    def _insert_messages(
+        con: sqlite3.Connection,
+        messages: List[Message],
+        thread_id: Optional[int],
+        model: Optional[str] = None,
+        edit_id: Optional[int] = None,
+    ) -> Tuple[int, List[int]]:
+        revision = con.execute(
+            'SELECT COALESCE(MAX(revision), 0) + 1 FROM thread_summaries;'
+        ).fetchone()[0]
+        parent_id = None
+        # Change in the length of the active branch, besides the new messages
+        switched = 0
+        if thread_id is None:
+            cur = con.execute(
+                'INSERT INTO threads (created_at) VALUES (?);',
+                (messages[0].timestamp if messages else '',),
+            )
+            thread_id = cur.lastrowid
+            next_seq = 0
+        else:
+            cur = con.execute(
+                'SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE thread_id = ?;',
+                (thread_id,),
+            )
+            next_seq = cur.fetchone()[0]
+            if edit_id is None:
+                row = con.execute(
+                    'SELECT id FROM messages WHERE thread_id = ? AND active ORDER BY seq DESC LIMIT 1;',
+                    (thread_id,),
+                ).fetchone()
+                parent_id = row[0] if row else None
+            else:
+                row = con.execute(
+                    'SELECT parent_id FROM messages WHERE id = ? AND thread_id = ?;', (edit_id, thread_id)
+                ).fetchone()
+                if row is None:
+                    raise ValueError(f'Message {edit_id} is not in thread {thread_id}')
+                parent_id = row[0]
+                # Only the messages that differ between the old and the new branch change
+                switched -= con.execute(
+                    f'UPDATE messages SET active = FALSE WHERE thread_id = ? AND active AND id NOT IN ({ANCESTORS});',
+                    (thread_id, parent_id),
+                ).rowcount
+                switched += con.execute(
+                    f'UPDATE messages SET active = TRUE WHERE id IN ({ANCESTORS}) AND NOT active;',
+                    (parent_id,),
+                ).rowcount
+        message_ids = []
+        for i, m in enumerate(messages):
+            cur = con.execute(
+                'INSERT INTO messages (thread_id, seq, role, timestamp, content, tokens, parent_id)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?);',
+                (thread_id, next_seq + i, m.role, m.timestamp, m.content, estimate_tokens(m.content), parent_id),
+            )
+            parent_id = cur.lastrowid
+            message_ids.append(parent_id)
+            con.execute('INSERT INTO messages_fts (rowid, content) VALUES (?, ?);', (parent_id, m.content))
+        if next_seq == 0:
+            con.execute(
+                'INSERT OR REPLACE INTO thread_summaries'
+                ' (thread_id, title, first_timestamp, last_activity, message_count, model, revision)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?);',
+                (
+                    thread_id,
+                    thread_title(messages[0].content) if messages else '',
+                    messages[0].timestamp if messages else '',
+                    messages[-1].timestamp if messages else '',
+                    len(messages),
+                    model,
+                    revision,
+                ),
+            )
+        else:
+            # The title comes from the first message of the active branch, which an edit can change
+            new_root = con.execute(
+                'SELECT content, timestamp FROM messages WHERE thread_id = ? AND active ORDER BY seq LIMIT 1;',
+                (thread_id,),
+            ).fetchone() if edit_id is not None else None
+            con.execute(
+                'UPDATE thread_summaries SET title = COALESCE(?, title),'
+                ' first_timestamp = COALESCE(?, first_timestamp), last_activity = ?,'
+                ' message_count = message_count + ?, model = COALESCE(?, model), revision = ? WHERE thread_id = ?;',
+                (
+                    thread_title(new_root[0]) if new_root else None,
+                    new_root[1] if new_root else None,
+                    messages[-1].timestamp if messages else '',
+                    len(messages) + switched,
+                    model,
+                    revision,
+                    thread_id,
+                ),
+            )
+        return thread_id, message_ids
+
+    async def get_chat_history(
+        self,
+        thread_id: int,
+        edit_id: Optional[int] = None,
+        limit: int = HISTORY_LIMIT,
+    ) -> List[Message]:
+        """Get a thread's most recent messages, oldest first, as history for the Together API.
+
+        The history is the active branch, or with `edit_id` the branch leading to the
+        edited message, without it, found by following parent ids up from it.
+        At most `limit` messages are read, so the cost doesn't grow with the thread.
+        Each message carries its cached `tokens` estimate for context window budgeting.
+        """
+        if edit_id is not None:
+            rows = await self._read(
+                _fetchall,
+                'WITH RECURSIVE branch (id, parent_id, depth) AS ('
+                ' SELECT parent.id, parent.parent_id, 1 FROM messages edited'
+                ' JOIN messages parent ON parent.id = edited.parent_id'
+                ' WHERE edited.id = ? AND edited.thread_id = ?'
+                ' UNION ALL'
+                ' SELECT messages.id, messages.parent_id, branch.depth + 1 FROM messages'
+                ' JOIN branch ON messages.id = branch.parent_id WHERE branch.depth < ?'
+                ')'
+                ' SELECT role, timestamp, content, tokens FROM branch JOIN messages USING (id)'
+                ' ORDER BY depth',
+                edit_id,
+                thread_id,
+                limit,
+            )
+        else:
+            rows = await self._read(
+                _fetchall,
+                'SELECT role, timestamp, content, tokens FROM messages'
+                ' WHERE thread_id = ? AND active ORDER BY seq DESC LIMIT ?',
+                thread_id,
+                limit,
+            )
+        if not rows and await self._restore(thread_id):
+            return await self.get_chat_history(thread_id, edit_id, limit)
+        return [
+            Message(role, content, timestamp, tokens=tokens)
+            for role, timestamp, content, tokens in reversed(rows)
+        ]
+
+    async def get_messages(
+        self,
+        thread_id: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: int = PAGE_SIZE,
+    ) -> AsyncIterator[Message]:
+        """Get a page of messages in a format suitable for the frontend, oldest first.
+
+        The page is the `limit` most recent messages of active branches with an id below
+        `before`. It's read whole before any message is yielded, so the reader connection
+        isn't held while a slow client consumes the page. An archived thread is restored when its page comes back empty,
+        archived messages aren't part of the pages of all threads.
+        """
+        empty = True
+        async for message in self._get_messages(thread_id, before, limit):
+            empty = False
+            yield message
+        if empty and thread_id is not None and await self._restore(thread_id):
+            async for message in self._get_messages(thread_id, before, limit):
+                yield message
+
+    async def _get_messages(
+        self, thread_id: Optional[int], before: Optional[int], limit: int
+    ) -> AsyncIterator[Message]:
+        conditions = ['active']
+        params: List[Any] = []
+        if thread_id is not None:
+            conditions.append('thread_id = ?')
+            params.append(thread_id)
+        if before is not None:
+            conditions.append('id < ?')
+            params.append(before)
+        where = ' WHERE ' + ' AND '.join(conditions)
+        rows = await self._read(
+            _fetchall,
+            'SELECT id, role, timestamp, content FROM ('
+            ' SELECT id, role, timestamp, content FROM messages'
+            f'{where} ORDER BY id DESC LIMIT ?'
+            ') ORDER BY id',
+            *params,
+            limit,
+        )
+        for message_id, role, timestamp, content in rows:
+            yield Message(role, content, timestamp, message_id)
+
+    async def clear_messages(self):
+        """Clear all messages from the database."""
+        await self._write(self._clear)
+        # Once the segments are forgotten, so a rollback doesn't lose archived threads
+        await self._write(self._remove_unused_segments)
+
+    @staticmethod
+    def _clear(con: sqlite3.Connection):
+        con.execute("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all');")
+        con.execute('DELETE FROM messages;')
+        con.execute('DELETE FROM threads;')
+        con.execute('DELETE FROM archive_segments;')
+
+    async def run_retention(self, policy: RetentionPolicy) -> Dict[str, int]:
+        """Archive the threads idle for longer than the policy allows, compact the archive and vacuum.
+
+        Each step is a transaction of its own, small enough that chats keep being saved
+        in between. Returns the number of threads archived, of segment files removed and
+        of database pages freed.
+        """
+        archived = 0
+        if policy.archive_after_days > 0:
+            cutoff = (datetime.now(tz=timezone.utc) - timedelta(days=policy.archive_after_days)).isoformat()
+            while True:
+                count = await self._write(self._archive_threads, cutoff, policy)
+                metrics.archived_threads.inc('archived', amount=count)
+                archived += count
+                if count < policy.batch_threads:
+                    break
+        while await self._write(self._compact_segment, policy):
+            pass
+        removed = await self._write(self._remove_unused_segments)
+        freed = 0
+        while True:
+            start = time.perf_counter()
+            pages = await self._loop.run_in_executor(self._executor, self._vacuum, policy.vacuum_pages)
+            metrics.db_query_seconds.observe(time.perf_counter() - start, 'vacuum')
+            freed += pages
+            if pages < policy.vacuum_pages:
+                break
+        return {'archived': archived, 'segments_removed': removed, 'pages_freed': freed}
+
+    async def _keep_retention(self, policy: RetentionPolicy):
+        while True:
+            try:
+                result = await self.run_retention(policy)
+                if any(result.values()):
+                    print(
+                        f"Archived {result['archived']} threads, removed {result['segments_removed']}"
+                        f" archive segments and freed {result['pages_freed']} database pages"
+                    )
+            except Exception as e:
+                print(f"Error applying the retention policy: {e!r}")
+            await asyncio.sleep(policy.interval)
+
+    async def _restore(self, thread_id: int) -> bool:
+        """Move an archived thread's messages back into the database, False if it isn't archived."""
+        row = await self._read(
+            _fetchone, 'SELECT 1 FROM thread_archive WHERE thread_id = ? AND segment IS NOT NULL', thread_id
+        )
+        if row is None or not await self._write(self._restore_thread, thread_id):
+            return False
+        metrics.archived_threads.inc('restored')
+        return True
+
+    def _restore_thread(self, con: sqlite3.Connection, thread_id: int) -> bool:
+        row = con.execute(
+            'SELECT segment, position, length FROM thread_archive WHERE thread_id = ? AND segment IS NOT NULL;',
+            (thread_id,),
+        ).fetchone()
+        if row is None:
+            return False
+        segment, position, length = row
+        rows = self._archive.unpack(self._archive.read(segment, position, length))
+        # In id order, parents come before the messages pointing to them
+        con.executemany(
+            f'INSERT INTO messages (thread_id, {ARCHIVED_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);',
+            [(thread_id, *message) for message in rows],
+        )
+        # Their messages_fts entries were kept while archived
+        con.execute('DELETE FROM archived_messages WHERE thread_id = ?;', (thread_id,))
+        con.execute('UPDATE archive_segments SET live_bytes = live_bytes - ? WHERE id = ?;', (length, segment))
+        con.execute(
+            'UPDATE thread_archive SET segment = NULL, position = NULL, length = NULL, restored_at = ?'
+            ' WHERE thread_id = ?;',
+            (datetime.now(tz=timezone.utc).isoformat(), thread_id),
+        )
+        return True
+
+    def _archive_threads(self, con: sqlite3.Connection, cutoff: str, policy: RetentionPolicy) -> int:
+        """Move up to `policy.batch_threads` threads idle since before `cutoff` to the archive."""
+        # Most recently active first, the threads archived long ago are only scanned by the last batch
+        thread_ids = [row[0] for row in con.execute(
+            'SELECT thread_id FROM thread_summaries WHERE last_activity < ?1 AND NOT EXISTS ('
+            ' SELECT 1 FROM thread_archive WHERE thread_archive.thread_id = thread_summaries.thread_id'
+            ' AND (segment IS NOT NULL OR restored_at >= ?1)'
+            ') ORDER BY last_activity DESC LIMIT ?2;',
+            (cutoff, policy.batch_threads),
+        )]
+        if not thread_ids:
+            return 0
+        frames = []
+        for thread_id in thread_ids:
+            rows = con.execute(
+                f'SELECT {ARCHIVED_COLUMNS} FROM messages WHERE thread_id = ? ORDER BY id;', (thread_id,)
+            ).fetchall()
+            frames.append(self._archive.pack(rows))
+            con.executemany(
+                'INSERT INTO archived_messages (id, thread_id, role, timestamp, active) VALUES (?, ?, ?, ?, ?);',
+                [(row[0], thread_id, row[2], row[3], row[7]) for row in rows],
+            )
+            con.execute('DELETE FROM messages WHERE thread_id = ?;', (thread_id,))
+        segment, positions = self._append_frames(con, frames, policy)
+        archived_at = datetime.now(tz=timezone.utc).isoformat()
+        con.executemany(
+            'INSERT OR REPLACE INTO thread_archive (thread_id, segment, position, length, archived_at)'
+            ' VALUES (?, ?, ?, ?, ?);',
+            [
+                (thread_id, segment, position, len(frame), archived_at)
+                for thread_id, position, frame in zip(thread_ids, positions, frames)
+            ],
+        )
+        return len(thread_ids)
+
+    def _append_frames(
+        self, con: sqlite3.Connection, frames: List[bytes], policy: RetentionPolicy
+    ) -> Tuple[int, List[int]]:
+        """Write frames to the latest segment, or a new one once it's full.
+
+        Returns the segment and the position of each frame. They're on disk before the
+        transaction recording them commits.
+        """
+        row = con.execute('SELECT id, bytes FROM archive_segments ORDER BY id DESC LIMIT 1;').fetchone()
+        if row is None or row[1] >= policy.segment_bytes:
+            segment = row[0] + 1 if row else 1
+            con.execute('INSERT INTO archive_segments (id, bytes, live_bytes) VALUES (?, 0, 0);', (segment,))
+        else:
+            segment = row[0]
+        positions = self._archive.append(segment, frames)
+        size = sum(map(len, frames))
+        con.execute(
+            'UPDATE archive_segments SET bytes = bytes + ?, live_bytes = live_bytes + ? WHERE id = ?;',
+            (size, size, segment),
+        )
+        return segment, positions
+
+    def _compact_segment(self, con: sqlite3.Connection, policy: RetentionPolicy) -> bool:
+        """Move the live frames of a mostly restored segment to the latest one, False if none is.
+
+        Its file is removed by `_remove_unused_segments` once that's committed.
+        """
+        row = con.execute(
+            'SELECT id FROM archive_segments WHERE id < (SELECT MAX(id) FROM archive_segments)'
+            ' AND live_bytes < bytes * ? LIMIT 1;',
+            (policy.compact_below,),
+        ).fetchone()
+        if row is None:
+            return False
+        segment = row[0]
+        archived = con.execute(
+            'SELECT thread_id, position, length FROM thread_archive WHERE segment = ?;', (segment,)
+        ).fetchall()
+        if archived:
+            # The frames are copied as they are, without decompressing them
+            frames = [self._archive.read(segment, position, length) for _, position, length in archived]
+            target, positions = self._append_frames(con, frames, policy)
+            con.executemany(
+                'UPDATE thread_archive SET segment = ?, position = ? WHERE thread_id = ?;',
+                [(target, position, thread_id) for (thread_id, _, _), position in zip(archived, positions)],
+            )
+        con.execute('DELETE FROM archive_segments WHERE id = ?;', (segment,))
+        return True
+
+    def _remove_unused_segments(self, con: sqlite3.Connection) -> int:
+        """Remove the segment files the database doesn't refer to, returns how many.
+
+        Runs holding the write lock, so no other process is writing frames meanwhile. Files
+        of frames written by a transaction that rolled back are removed too.
+        """
+        known = {row[0] for row in con.execute('SELECT id FROM archive_segments;')}
+        unused = [segment for segment in self._archive.segments() if segment not in known]
+        for segment in unused:
+            self._archive.remove(segment)
+        return len(unused)
+
+    def _vacuum(self, pages: int) -> int:
+        """Give up to `pages` free pages back to the file system, returns how many were.
+
+        Runs on the writer's executor between transactions: the pragma only runs to the
+        end when it's executed as a script, which commits the transaction in progress.
+        """
+        free = self.con.execute('PRAGMA freelist_count;').fetchone()[0]
+        if not free:
+            return 0
+        self.con.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+        return free - self.con.execute('PRAGMA freelist_count;').fetchone()[0]
+
+    @asynccontextmanager
+    async def _reader(self) -> AsyncIterator[sqlite3.Connection]:
+        """Borrow a read-only connection from the pool for the duration of the block."""
+        con = await self._readers.get()
+        try:
+            yield con
+        finally:
+            self._readers.put_nowait(con)
+
+    async def _read(
+        self, func: Callable[Concatenate[sqlite3.Connection, P], R], *args: P.args, **kwargs: P.kwargs
+    ) -> R:
+        """Run `func` with a read-only connection as first argument."""
+        async with self._reader() as con:
+            return await self._asyncify(func, con, *args, **kwargs)
+
+    async def _write(
+        self, func: Callable[Concatenate[sqlite3.Connection, P], R], *args: P.args, **kwargs: P.kwargs
+    ) -> R:
+        """Run `func` with the writer connection as first argument, and commit.
+
+        Writes queued while the writer is busy are committed together, so under
+        load many writes share one transaction and one fsync.
+        """
+        future: asyncio.Future[R] = self._loop.create_future()
+        self._pending_writes.append((partial(func, **kwargs), args, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_writes())
+        return await future
+
+    async def _flush_writes(self):
+        try:
+            while self._pending_writes:
+                batch, self._pending_writes = self._pending_writes, []
+                start = time.perf_counter()
+                try:
+                    results = await self._loop.run_in_executor(
+                        self._executor, self._commit_writes, [(func, args) for func, args, _ in batch]
+                    )
+                except Exception as e:
+                    results = [(False, e)] * len(batch)
+                metrics.db_query_seconds.observe(time.perf_counter() - start, 'write')
+                for (_, _, future), (ok, value) in zip(batch, results):
+                    if future.done():
+                        # The caller went away, the write was still made
+                        continue
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+        finally:
+            self._flush_task = None
+
+    def _commit_writes(self, writes: List[tuple[Callable[..., Any], tuple[Any, ...]]]) -> List[tuple[bool, Any]]:
+        """Run writes in a single transaction, a failed write is rolled back on its own."""
+        results: List[tuple[bool, Any]] = []
+        self.con.execute('BEGIN IMMEDIATE;')
+        try:
+            for func, args in writes:
+                self.con.execute('SAVEPOINT write;')
+                try:
+                    results.append((True, func(self.con, *args)))
+                except Exception as e:
+                    self.con.execute('ROLLBACK TO write;')
+                    results.append((False, e))
+                self.con.execute('RELEASE write;')
+            self.con.execute('COMMIT;')
+        except BaseException:
+            if self.con.in_transaction:
+                self.con.execute('ROLLBACK;')
+            raise
+        return results
+
+    async def _asyncify(
+        self, func: Callable[P, R], *args: P.args, **kwargs: P.kwargs
+    ) -> R:
+        """Run a blocking read on the read executor, timed in `metrics.db_query_seconds`."""
+        start = time.perf_counter()
+        try:
+            return await self._loop.run_in_executor(  # type: ignore
+                self._read_executor,
+                partial(func, **kwargs),
+                *args,  # type: ignore
+            )
+        finally:
+            metrics.db_query_seconds.observe(time.perf_counter() - start, 'read')
+
+    async def get_threads(
+        self, before: Optional[int] = None, limit: int = PAGE_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Get a page of conversation threads with ids below `before`, newest first.
+
+        Read whole before any thread is yielded, like the pages of `get_messages`.
+        """
+        rows = await self._read(
+            _fetchall,
+            'SELECT thread_id, title, first_timestamp, last_activity, message_count, model'
+            ' FROM thread_summaries WHERE thread_id < ?'
+            ' ORDER BY thread_id DESC LIMIT ?',
+            before if before is not None else sys.maxsize,
+            limit,
+        )
+        for thread_id, title, first_timestamp, last_activity, message_count, model in rows:
+            yield {
+                "id": thread_id,
+                "title": title,
+                "timestamp": first_timestamp,
+                "last_activity": last_activity,
+                "message_count": message_count,
+                "model": model,
+            }
+
+    async def search_messages(
+        self, query: str, offset: int = 0, limit: int = SEARCH_PAGE_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Get a page of the messages on active branches matching the words of `query`, best first.
+
+        The SEARCH_CANDIDATES most recent matches are ranked by bm25 in the FTS5 index, and
+        snippets are only made for the messages of the page, so the latency doesn't depend
+        on the size of the store. Words ending with * match as a prefix, which is slower.
+        Archived threads are searched too, without restoring them.
+        """
+        match = _match_expression(query)
+        if not match:
+            return
+        rows = await self._read(self._search, match, offset, limit)
+        for message_id, thread_id, title, role, timestamp, snippet in rows:
+            yield {
+                'id': message_id,
+                'thread_id': thread_id,
+                'title': title,
+                'role': role,
+                'timestamp': timestamp,
+                'snippet': snippet,
+            }
+
+    def _search(self, con: sqlite3.Connection, match: str, offset: int, limit: int) -> List[tuple[Any, ...]]:
+        rows = con.execute(
+            'WITH candidates AS ('
+            ' SELECT rowid AS id, rank FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT ?'
+            '), hits AS ('
+            ' SELECT id, thread_id, role, timestamp, active, 0 AS archived FROM messages'
+            ' WHERE id IN (SELECT id FROM candidates)'
+            ' UNION ALL'
+            ' SELECT id, thread_id, role, timestamp, active, 1 AS archived FROM archived_messages'
+            ' WHERE id IN (SELECT id FROM candidates)'
+            '), page AS ('
+            ' SELECT hits.*, candidates.rank FROM candidates JOIN hits ON hits.id = candidates.id'
+            ' WHERE hits.active ORDER BY candidates.rank LIMIT ? OFFSET ?'
+            ')'
+            ' SELECT page.id, page.thread_id, thread_summaries.title, page.role, page.timestamp, page.archived,'
+            # The text of archived messages isn't in the messages table the index refers to
+            " CASE WHEN NOT page.archived THEN snippet(messages_fts, 0, ?, ?, '…', ?) END"
+            ' FROM page'
+            ' JOIN messages_fts ON messages_fts.rowid = page.id AND messages_fts MATCH ?'
+            ' LEFT JOIN thread_summaries ON thread_summaries.thread_id = page.thread_id'
+            ' ORDER BY page.rank',
+            (match, SEARCH_CANDIDATES, limit, offset, SNIPPET_START, SNIPPET_END, SNIPPET_TOKENS, match),
+        ).fetchall()
+        archived = [(row[0], row[1]) for row in rows if row[5]]
+        snippets = self._archived_snippets(con, match, archived) if archived else {}
+        return [
+            (message_id, thread_id, title, role, timestamp, snippets.get(message_id, '') if is_archived else snippet)
+            for message_id, thread_id, title, role, timestamp, is_archived, snippet in rows
+        ]
+
+    def _archived_snippets(
+        self, con: sqlite3.Connection, match: str, messages: List[tuple[int, int]]
+    ) -> Dict[int, str]:
+        """Snippets of archived messages given as (id, thread id), read from their threads' frames."""
+        wanted = {message_id for message_id, _ in messages}
+        contents = []
+        for thread_id in {thread_id for _, thread_id in messages}:
+            row = con.execute(
+                'SELECT segment, position, length FROM thread_archive WHERE thread_id = ? AND segment IS NOT NULL;',
+                (thread_id,),
+            ).fetchone()
+            if row is None:
+                # Restored since the search query
+                continue
+            try:
+                rows = self._archive.unpack(self._archive.read(*row))
+            except (OSError, ValueError) as e:
+                # Its segment was compacted since, or is damaged; the result goes without a snippet
+                print(f"Error reading archived thread {thread_id} for a search: {e!r}")
+                continue
+            contents.extend((message[0], message[4]) for message in rows if message[0] in wanted)
+        scratch = sqlite3.connect(':memory:')
+        try:
+            scratch.execute(ARCHIVED_SNIPPETS_TABLE)
+            scratch.executemany('INSERT INTO snippets (rowid, content) VALUES (?, ?);', contents)
+            return dict(scratch.execute(
+                "SELECT rowid, snippet(snippets, 0, ?, ?, '…', ?) FROM snippets WHERE snippets MATCH ?;",
+                (SNIPPET_START, SNIPPET_END, SNIPPET_TOKENS, match),
+            ).fetchall())
+        finally:
+            scratch.close()
+
+    async def get_threads_version(self) -> str:
+        """Changes whenever a thread is added, updated or removed, for the GET /threads/ ETag.
+
+        Thread ids are never reused, so the latest one tells states before and after a reset apart.
+        """
+        revision, last_thread_id = await self._read(
+            _fetchone,
+            'SELECT (SELECT MAX(revision) FROM thread_summaries), (SELECT MAX(id) FROM threads)',
+        )
+        return f'{revision or 0}-{last_thread_id or 0}'
+
+
+def _match_expression(query: str) -> str:
+    """An FTS5 query matching all the words of `query`, those ending with * as a prefix.
+
+    Each word is quoted, so text typed by users can't be a syntax error.
+    """
+    terms = []
+    for word in query.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+
+def _fetchone(con: sqlite3.Connection, sql: LiteralString, *args: Any) -> Optional[tuple[Any, ...]]:
+    return con.execute(sql, args).fetchone()
+
+
+def _fetchall(con: sqlite3.Connection, sql: LiteralString, *args: Any) -> List[tuple[Any, ...]]:
+    return con.execute(sql, args).fetchall()
@@ -0,0 +1,147 @@
+"""
+Fixtures shared by the tests.
+
+Stores are tested on SQLite in a temporary file, and on Postgres too when
+CHAT_TEST_DATABASE_URL points to a database the tests may clear:
+
+    CHAT_TEST_DATABASE_URL=postgresql://localhost/chat_app_test python -m pytest tests
+
+Tests of the app run `main.py` and benchmarks/fake_together.py in their own
+processes, see the `fake_together` and `chat_app` fixtures.
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import httpx
+import pytest
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+from storage_sqlite import SQLiteDatabase  # noqa: E402
+
+TEST_DATABASE_URL = os.getenv('CHAT_TEST_DATABASE_URL', '')
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@asynccontextmanager
+async def connect(backend: str, tmp_path: Path, **options):
+    """An empty store of `backend`, skipping the test when it isn't available."""
+    if backend == 'sqlite':
+        async with SQLiteDatabase.connect(tmp_path / 'chats.sqlite', **options) as db:
+            yield db
+        return
+    if not TEST_DATABASE_URL:
+        pytest.skip('CHAT_TEST_DATABASE_URL is not set')
+    from storage_postgres import PostgresDatabase
+
+    async with PostgresDatabase.connect(TEST_DATABASE_URL, **options) as db:
+        await db.clear_messages()
+        yield db
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+async def database(request, tmp_path):
+    """An empty store of each backend."""
+    async with connect(request.param, tmp_path) as db:
+        yield db
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+async def database_with_one_reader(request, tmp_path):
+    """An empty store of each backend, reading through a single connection."""
+    options = {'readers': 1} if request.param == 'sqlite' else {'pool_size': 1}
+    async with connect(request.param, tmp_path, **options) as db:
+        yield db
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(proc: subprocess.Popen, url: str, timeout: float = 30):
+    """Poll `url` until it answers 200, failing if the process exits first."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'{proc.args} exited with {proc.returncode}')
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f'{url} did not come up')
+
+
+@pytest.fixture
+def processes():
+    started = []
+    yield started
+    for proc in started:
+        proc.terminate()
+    for proc in started:
+        try:
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+@pytest.fixture
+def fake_together(processes):
+    """Start the fake Together server with command line flags, returns its URL."""
+    def start(*flags: str) -> str:
+        port = free_port()
+        proc = subprocess.Popen(
+            [sys.executable, str(ROOT / 'benchmarks' / 'fake_together.py'), '--port', str(port), *flags],
+        )
+        processes.append(proc)
+        url = f'http://127.0.0.1:{port}'
+        wait_until_up(proc, f'{url}/stats')
+        return url
+
+    return start
+
+
+@pytest.fixture
+def chat_app(processes, tmp_path):
+    """Start the app against a fake Together server with extra environment variables, returns its URL.
+
+    The scheduler doesn't limit requests unless the variables say so, and the app
+    stores its threads in a new SQLite file.
+    """
+    def start(fake_url: str, **env: str) -> str:
+        port = free_port()
+        proc = subprocess.Popen(
+            [sys.executable, 'main.py', '--port', str(port)],
+            cwd=ROOT,
+            env={
+                **os.environ,
+                'TOGETHER_API_KEY': 'fake',
+                'TOGETHER_BASE_URL': f'{fake_url}/v1',
+                'CHAT_DATABASE_URL': f'sqlite:///{tmp_path / "app.sqlite"}',
+                'TOGETHER_MAX_IN_FLIGHT': '10000',
+                'TOGETHER_RATE_LIMIT_RPM': '0',
+                'TOGETHER_MAX_QUEUE': '10000',
+                **env,
+            },
+            stdout=subprocess.DEVNULL,
+        )
+        processes.append(proc)
+        url = f'http://127.0.0.1:{port}'
+        wait_until_up(proc, f'{url}/ready')
+        return url
+
+    return start
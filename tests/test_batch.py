@@ -0,0 +1,38 @@
+"""Tests of reading the input of batch.py."""
+
+import json
+
+import pytest
+
+from batch import batch_line, read_records
+
+
+def write_lines(path, *records):
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records), encoding='utf-8')
+    return path
+
+
+def test_system_messages_replace_the_system_prompt(tmp_path):
+    path = write_lines(tmp_path / 'in.jsonl', {'id': 'a', 'messages': [
+        {'role': 'system', 'content': 'Answer in French.'},
+        {'role': 'user', 'content': 'Hi'},
+        {'role': 'assistant', 'content': 'Salut'},
+        {'role': 'user', 'content': 'How are you?'},
+    ]}, {'prompt': 'No system prompt'})
+    first, second = read_records(path, 'id', 'prompt')
+    assert first['system'] == 'Answer in French.'
+    assert [(m.role, m.content) for m in first['history']] == [('user', 'Hi'), ('model', 'Salut')]
+    assert second['system'] is None
+
+    messages = batch_line(first, 'fake-model')['body']['messages']
+    assert messages[0] == {'role': 'system', 'content': 'Answer in French.'}
+    assert [m['role'] for m in messages] == ['system', 'user', 'assistant', 'user']
+
+
+def test_unknown_role_is_rejected_with_its_line(tmp_path):
+    path = write_lines(tmp_path / 'in.jsonl', {'prompt': 'Fine'}, {'messages': [
+        {'role': 'tool', 'content': '{}'},
+        {'role': 'user', 'content': 'Hi'},
+    ]})
+    with pytest.raises(ValueError, match=r'in\.jsonl:2 .*\'tool\''):
+        list(read_records(path, 'id', 'prompt'))
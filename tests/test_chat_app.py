@@ -0,0 +1,149 @@
+"""Tests of the app's endpoints, against the fake Together server, see conftest.py."""
+
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from together_model import load_models
+
+MODEL = 'fake-model'
+
+
+def chat(app_url: str, prompt: str, **fields) -> list:
+    """POST /chat/ and return the response's lines."""
+    response = httpx.post(f'{app_url}/chat/', data={'prompt': prompt, 'model': MODEL, **fields}, timeout=30)
+    response.raise_for_status()
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_edit_must_target_user_message(fake_together, chat_app):
+    app_url = chat_app(fake_together('--first-token-latency', '0', '--tokens', '3'))
+    *_, user_line, answer_line = chat(app_url, 'Hello')
+    thread_id = answer_line['thread_id']
+
+    edited = chat(app_url, 'Hello again', thread_id=thread_id, edit_id=user_line['id'])
+    assert edited[-1]['thread_id'] == thread_id
+    # Editing from the list of all threads' messages, the thread is the edited message's
+    *_, user_line, answer_line = chat(app_url, 'Hello once more', edit_id=edited[-2]['id'])
+    assert answer_line['thread_id'] == thread_id
+    *_, other_answer = chat(app_url, 'Another thread')
+
+    for edit_id, edit_thread_id, status in [
+        (answer_line['id'], thread_id, 422),
+        (answer_line['id'] + 100, thread_id, 404),
+        (user_line['id'], other_answer['thread_id'], 404),
+    ]:
+        response = httpx.post(f'{app_url}/chat/', data={
+            'prompt': 'Not a prompt', 'model': MODEL, 'thread_id': edit_thread_id, 'edit_id': edit_id,
+        })
+        assert response.status_code == status
+
+
+def test_models_are_those_of_models_txt(fake_together, chat_app):
+    app_url = chat_app(fake_together())
+    response = httpx.get(f'{app_url}/models/')
+    assert response.json() == {'models': load_models()}
+    etag = response.headers['ETag']
+    assert httpx.get(f'{app_url}/models/', headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_first_chunk_arrives_before_the_answer_is_complete(fake_together, chat_app):
+    # 0.2s to the first token, then 40 tokens taking 2s
+    app_url = chat_app(fake_together('--first-token-latency', '0.2', '--token-interval', '0.05', '--tokens', '40'))
+    start = time.perf_counter()
+    first_chunk = None
+    with httpx.stream('POST', f'{app_url}/chat/', data={'prompt': 'Stream this', 'model': MODEL}, timeout=30) as response:
+        lines = []
+        for line in response.iter_lines():
+            lines.append(json.loads(line))
+            if first_chunk is None and 'delta' in lines[-1]:
+                first_chunk = time.perf_counter() - start
+    total = time.perf_counter() - start
+    assert first_chunk is not None and first_chunk < 0.7, f'first chunk after {first_chunk:.3f}s'
+    assert total > 2
+    # The answer is still assembled and stored whole
+    deltas = ''.join(line['delta'] for line in lines if 'delta' in line)
+    assert lines[-1]['content'] == deltas and lines[-1]['id'] is not None
+
+
+@pytest.mark.anyio
+async def test_overload_is_a_503_rather_than_upstream_429s(fake_together, chat_app):
+    # The stub answers 429 beyond 2 requests per second, the app allows itself 1
+    fake_url = fake_together('--rate-limit', '2', '--first-token-latency', '0', '--tokens', '3')
+    app_url = chat_app(
+        fake_url,
+        TOGETHER_RATE_LIMIT_RPM='60',
+        TOGETHER_RATE_LIMIT_BURST='2',
+        TOGETHER_MAX_QUEUE='2',
+        TOGETHER_QUEUE_MAX_WAIT='1',
+    )
+    async with httpx.AsyncClient(base_url=app_url, timeout=30) as client:
+        responses = await asyncio.gather(*(
+            client.post('/chat/', data={'prompt': f'Burst {i}', 'model': MODEL}) for i in range(10)
+        ))
+    rejected = [r for r in responses if r.status_code == 503]
+    answered = [r for r in responses if r.status_code == 200]
+    assert rejected and answered and len(rejected) + len(answered) == len(responses)
+    assert all(int(r.headers['Retry-After']) >= 1 for r in rejected)
+    assert all('An error occurred' not in r.text for r in answered)
+    assert httpx.get(f'{fake_url}/stats').json()['rate_limited'] == 0
+
+
+def test_disconnect_closes_the_upstream_stream(fake_together, chat_app):
+    # 10s of answer, stopped as soon as nobody reads it
+    fake_url = fake_together('--first-token-latency', '0', '--token-interval', '0.05', '--tokens', '200')
+    app_url = chat_app(fake_url, CHAT_GENERATION_DETACHED_TIMEOUT='0')
+    with httpx.stream('POST', f'{app_url}/chat/', data={'prompt': 'Talk a lot', 'model': MODEL}, timeout=30) as response:
+        for line in response.iter_lines():
+            if 'delta' in json.loads(line):
+                break
+
+    deadline = time.monotonic() + 5
+    while httpx.get(f'{fake_url}/stats').json()['disconnects'] == 0:
+        assert time.monotonic() < deadline, 'the fake server never saw the stream closed'
+        time.sleep(0.05)
+    upstream = httpx.get(f'{app_url}/stats/').json()['upstream'][MODEL]
+    assert upstream['in_flight'] == 0 and upstream['cancelled'] == 1
+    # The partial answer is discarded by default
+    assert httpx.get(f'{app_url}/threads/').json()['threads'] == []
+
+
+def test_thread_history_reaches_together(fake_together, chat_app):
+    fake_url = fake_together('--first-token-latency', '0', '--tokens', '3')
+    app_url = chat_app(fake_url)
+    *_, first_answer = chat(app_url, 'My name is Ada')
+    chat(app_url, 'What is my name?', thread_id=first_answer['thread_id'])
+
+    sent = httpx.get(f'{fake_url}/stats').json()['last_messages']
+    assert sent[0]['role'] == 'system'
+    assert [(m['role'], m['content']) for m in sent[1:]] == [
+        ('user', 'My name is Ada'),
+        ('assistant', first_answer['content']),
+        ('user', 'What is my name?'),
+    ]
+
+
+def test_answer_is_stored_when_another_thread_is_shown(fake_together, chat_app):
+    # the requests of chat_app.ts when another thread is opened while an answer streams:
+    # the POST is read on in the background while the other thread is loaded
+    fake_url = fake_together('--first-token-latency', '0', '--token-interval', '0.05', '--tokens', '40')
+    app_url = chat_app(fake_url, CHAT_GENERATION_DETACHED_TIMEOUT='0')
+    *_, other_answer = chat(app_url, 'Another conversation')
+    with httpx.stream('POST', f'{app_url}/chat/', data={'prompt': 'Talk a while', 'model': MODEL}, timeout=30) as response:
+        lines = response.iter_lines()
+        for line in lines:
+            if 'delta' in json.loads(line):
+                break
+        shown = httpx.get(f'{app_url}/chat/', params={'thread_id': other_answer['thread_id']})
+        assert json.loads(shown.text.splitlines()[-1])['id'] == other_answer['id']
+        assert len(httpx.get(f'{app_url}/threads/').json()['threads']) == 1
+        *_, answer = [json.loads(line) for line in lines]
+
+    assert answer['id'] is not None and answer['thread_id'] != other_answer['thread_id']
+    threads = httpx.get(f'{app_url}/threads/').json()['threads']
+    assert answer['thread_id'] in [thread['id'] for thread in threads]
+    stored = httpx.get(f'{app_url}/chat/', params={'thread_id': answer['thread_id']}).text.splitlines()
+    assert json.loads(stored[-1])['content'] == answer['content']
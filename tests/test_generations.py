@@ -0,0 +1,42 @@
+"""Tests of the replay buffers of generations.py."""
+
+import asyncio
+
+import pytest
+
+import generations
+from generations import GenerationStore, ReplayLimits
+
+pytestmark = pytest.mark.anyio
+
+
+async def endless_lines():
+    while True:
+        yield b'line\n'
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def store(monkeypatch) -> GenerationStore:
+    monkeypatch.setattr(generations, 'FIRST_READER_GRACE', 0)
+    return GenerationStore(ReplayLimits(detached_timeout=0.1))
+
+
+async def test_stopped_when_never_read(store):
+    outcomes = []
+    generation = store.start(endless_lines(), None, outcomes.append)
+    await asyncio.sleep(0.3)
+    assert generation.done and outcomes == [True]
+
+
+async def test_runs_while_read_and_stops_once_left(store):
+    outcomes = []
+    generation = store.start(endless_lines(), None, outcomes.append)
+    reader = generation.read()
+    # Attaching cancels the timer armed at the start
+    await reader.__anext__()
+    await asyncio.sleep(0.3)
+    assert not generation.done
+    await reader.aclose()
+    await asyncio.sleep(0.3)
+    assert generation.done and outcomes == [True]
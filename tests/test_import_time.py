@@ -0,0 +1,26 @@
+"""Import time budget of main.py, measured with `python -X importtime` like benchmarks/bench_cold_start.py."""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'benchmarks'))
+
+from bench_cold_start import LAZY_MODULES, import_main  # noqa: E402
+
+# About 550 ms here, with room for slower machines
+IMPORT_BUDGET_MS = 800
+
+
+def test_import_main_within_budget(monkeypatch):
+    # Plugins of other installed packages would be imported along with fastapi
+    monkeypatch.setenv('PYDANTIC_DISABLE_PLUGINS', '__all__')
+    # Best of a few runs, the first one also pays for reading the files from disk
+    imports = min((import_main() for _ in range(3)), key=lambda imports: imports[-1][0])
+    total_ms = imports[-1][0] / 1000
+    assert total_ms < IMPORT_BUDGET_MS, f'importing main took {total_ms:.0f} ms'
+
+
+def test_import_main_leaves_out_lazy_modules(monkeypatch):
+    monkeypatch.setenv('PYDANTIC_DISABLE_PLUGINS', '__all__')
+    lazy = {module for _, _, module in import_main() if module.split('.')[0] in LAZY_MODULES}
+    assert not lazy
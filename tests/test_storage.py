@@ -0,0 +1,105 @@
+"""Tests of the chat stores, run on every backend, see conftest.py."""
+
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from chat_message import Message
+from storage import SNIPPET_START
+from storage_archive import RetentionPolicy, archive_directory
+from storage_sqlite import SQLiteDatabase
+
+pytestmark = pytest.mark.anyio
+
+
+async def collect(rows) -> list:
+    return [row async for row in rows]
+
+
+def turn(prompt: str, answer: str, timestamp: str = '2025-01-01T00:00:00+00:00'):
+    return [Message('user', prompt, timestamp), Message('model', answer, timestamp)]
+
+
+async def test_add_messages_to_new_and_existing_thread(database):
+    thread_id, first_ids = await database.add_messages(turn('hello', 'hi'), model='m')
+    assert len(first_ids) == 2
+    assert await database.thread_exists(thread_id)
+
+    same_thread_id, next_ids = await database.add_messages(turn('again', 'sure'), thread_id, 'm')
+    assert same_thread_id == thread_id
+    assert len(next_ids) == 2 and min(next_ids) > max(first_ids)
+
+    messages = await collect(database.get_messages(thread_id))
+    assert [(m.role, m.content) for m in messages] == [
+        ('user', 'hello'), ('model', 'hi'), ('user', 'again'), ('model', 'sure'),
+    ]
+    assert [m.id for m in messages] == first_ids + next_ids
+    [thread] = await collect(database.get_threads())
+    assert thread['id'] == thread_id and thread['message_count'] == 4
+
+
+async def test_find_message(database):
+    thread_id, (user_id, model_id) = await database.add_messages(turn('hello', 'hi'), model='m')
+    other_thread_id, (other_id, _) = await database.add_messages(turn('other', 'thread'), model='m')
+    assert await database.find_message(user_id) == (thread_id, 'user')
+    assert await database.find_message(model_id) == (thread_id, 'model')
+    assert await database.find_message(other_id) == (other_thread_id, 'user')
+    assert await database.find_message(other_id + 100) is None
+
+
+async def test_search_finds_archived_threads(tmp_path):
+    policy = RetentionPolicy(archive_after_days=1)
+    async with SQLiteDatabase.connect(tmp_path / 'chats.sqlite') as database:
+        old_thread_id, _ = await database.add_messages(
+            turn('Tell me about the fox', 'Foxes are quick and brown', '2020-01-01T00:00:00+00:00'), model='m'
+        )
+        new_thread_id, _ = await database.add_messages(turn('A fox in the snow', 'It hunts mice', datetime.now(tz=timezone.utc).isoformat()), model='m')
+        assert (await database.run_retention(policy))['archived'] == 1
+
+        archived_results = await collect(database.search_messages('fox'))
+        assert {(r['thread_id'], r['role']) for r in archived_results} == {
+            (old_thread_id, 'user'), (old_thread_id, 'model'), (new_thread_id, 'user'),
+        }
+        assert all(SNIPPET_START in r['snippet'] for r in archived_results)
+
+        # Once restored, the same results come from the messages table
+        assert len(await collect(database.get_messages(old_thread_id))) == 2
+        assert await collect(database.search_messages('fox')) == archived_results
+
+
+async def test_clear_messages_removes_archived_threads(tmp_path):
+    policy = RetentionPolicy(archive_after_days=1)
+    async with SQLiteDatabase.connect(tmp_path / 'chats.sqlite') as database:
+        await database.add_messages(turn('An old fox', 'Still quick', '2020-01-01T00:00:00+00:00'), model='m')
+        await database.add_messages(turn('A new fox', 'Quick too', datetime.now(tz=timezone.utc).isoformat()))
+        await database.run_retention(policy)
+        segments = archive_directory(tmp_path / 'chats.sqlite')
+        assert list(segments.iterdir())
+
+        await database.clear_messages()
+        assert await collect(database.get_threads()) == []
+        assert await collect(database.search_messages('fox')) == []
+        assert list(segments.iterdir()) == []
+
+
+async def test_find_message_restores_archived_threads(tmp_path):
+    async with SQLiteDatabase.connect(tmp_path / 'chats.sqlite') as database:
+        thread_id, (user_id, _) = await database.add_messages(
+            turn('An old fox', 'Still quick', '2020-01-01T00:00:00+00:00'), model='m'
+        )
+        assert (await database.run_retention(RetentionPolicy(archive_after_days=1)))['archived'] == 1
+        assert await database.find_message(user_id) == (thread_id, 'user')
+        assert len(await collect(database.get_messages(thread_id))) == 2
+
+
+async def test_pages_do_not_hold_the_reader(database_with_one_reader):
+    database = database_with_one_reader
+    thread_id, _ = await database.add_messages(turn('hello', 'hi'), model='m')
+    # A client reading a page slowly, while other requests need the only reader
+    for page in (database.get_messages(thread_id), database.get_threads()):
+        try:
+            await page.__anext__()
+            assert await asyncio.wait_for(database.thread_exists(thread_id), 2)
+        finally:
+            await page.aclose()
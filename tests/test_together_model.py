@@ -0,0 +1,81 @@
+"""Tests of the upstream calls in together_model.py, against the fake Together server."""
+
+import asyncio
+
+import httpx
+import pytest
+
+import together_model
+from resilience import LatencyTracker
+from scheduler import ModelLimits, Scheduler
+
+pytestmark = pytest.mark.anyio
+
+MODEL = 'fake-model'
+MESSAGES = [{'role': 'user', 'content': 'Hello'}]
+
+
+@pytest.fixture
+async def slow_client(fake_together, monkeypatch):
+    """A client of a fake server that takes 0.5s to the first token, where requests are hedged after 0.1s."""
+    url = fake_together('--first-token-latency', '0.5', '--tokens', '3')
+    monkeypatch.setenv('TOGETHER_BASE_URL', f'{url}/v1')
+    monkeypatch.setattr(together_model, 'api_key', 'fake')
+    monkeypatch.setattr(together_model, 'HEDGE_REQUESTS', True)
+    monkeypatch.setattr(together_model, 'HEDGE_MIN_DELAY', 0.1)
+    tracker = LatencyTracker()
+    for _ in range(tracker.min_samples):
+        tracker.record(MODEL, 0.01)
+    monkeypatch.setattr(together_model, 'latency_tracker', tracker)
+    async with together_model.create_async_client() as client:
+        client.fake_url = url
+        yield client
+
+
+async def first_token(client, scheduler: Scheduler) -> together_model.CompletionInfo:
+    info = together_model.CompletionInfo()
+    await scheduler.acquire(MODEL)
+    stream, _, first = await together_model._hedged_first_token(client, MODEL, MESSAGES, info, scheduler)
+    await stream.close()
+    scheduler.release(MODEL)
+    assert first
+    return info
+
+
+async def test_hedge_is_charged_to_the_scheduler(slow_client):
+    scheduler = Scheduler(ModelLimits(requests_per_minute=60, burst=5))
+    info = await first_token(slow_client, scheduler)
+    assert info.hedged and info.attempts == 2
+    assert scheduler.stats()[MODEL]['extra'] == 1
+    assert httpx.get(f'{slow_client.fake_url}/stats').json()['requests'] == 2
+
+
+async def test_no_hedge_when_rate_budget_is_spent(slow_client):
+    # The only token of the bucket goes to the first request
+    scheduler = Scheduler(ModelLimits(requests_per_minute=60, burst=1))
+    info = await first_token(slow_client, scheduler)
+    assert not info.hedged and info.attempts == 1
+    assert scheduler.stats()[MODEL]['hedges_skipped'] == 1
+    assert httpx.get(f'{slow_client.fake_url}/stats').json()['requests'] == 1
+
+
+async def test_cancelled_before_hedging_closes_request(slow_client):
+    info = together_model.CompletionInfo()
+    task = asyncio.create_task(together_model._hedged_first_token(slow_client, MODEL, MESSAGES, info))
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    for _ in range(50):
+        if httpx.get(f'{slow_client.fake_url}/stats').json()['disconnects']:
+            break
+        await asyncio.sleep(0.02)
+    assert httpx.get(f'{slow_client.fake_url}/stats').json()['disconnects'] == 1
+
+
+async def test_warm_connections_reports_any_error():
+    def fail(request: httpx.Request) -> httpx.Response:
+        raise RuntimeError('not an httpx.HTTPError')
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(fail)) as http_client:
+        assert await together_model.warm_connections(http_client, 'http://together.test/v1', 2) == 0
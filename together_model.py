@@ -1,30 +1,128 @@
+from __future__ import annotations as _annotations
+
+import asyncio
 import os
 import json
-from typing import Dict, List, Optional, Any, Union
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional, Any, Sequence, Union
 from pathlib import Path
 
-from together import Together
+import metrics
+from assets import WatchedFile
+from chat_message import Message, estimate_tokens
+from resilience import LatencyTracker, RetryPolicy, is_transient, should_fall_back
+from response_cache import ResponseCache, cache_key
+from scheduler import Overloaded, Scheduler
+
+if TYPE_CHECKING:
+    # Imported when the first client is made, they take longer to import than the rest of the app
+    import httpx
+    from together import AsyncTogether, Together
 
 # Get API key from environment variable
 api_key = os.getenv("TOGETHER_API_KEY")  # Together.ai is a good option for accessing various LLMs
 if not api_key:
     api_key = "your_key"  # Replace with your actual API key for production
 
-# Initialize the Together client
-client = Together(api_key=api_key)
+@lru_cache(maxsize=None)
+def get_client() -> Together:
+    """The synchronous Together client, made on first use rather than when this module is imported.
+
+    Retries are handled by `retry_policy` instead of the client.
+    """
+    from together import Together
+
+    return Together(api_key=api_key, max_retries=0)
+
+# Context length, in tokens, of the models in models.txt, others use DEFAULT_CONTEXT_LENGTH
+MODEL_CONTEXT_LENGTHS = {
+    "microsoft/WizardLM-2-8x22B": 65536,
+    "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free": 8193,
+    "deepseek-ai/DeepSeek-R1-Distill-Llama-70B-free": 8192,
+}
+DEFAULT_CONTEXT_LENGTH = 8192
+
+# Tokens reserved for the answer, matches `max_tokens` of the completion requests
+MAX_OUTPUT_TOKENS = 1000
+
+# Optional cap on prompt tokens per request, to bound input cost on long threads
+CONTEXT_BUDGET = int(os.getenv("TOGETHER_CONTEXT_BUDGET", "0"))
+
+# Sampling parameters of the chat completion requests
+SAMPLING_PARAMS = {
+    "max_tokens": MAX_OUTPUT_TOKENS,
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "top_k": 40,
+    "repetition_penalty": 1.0,
+}
+
+# Identical requests are answered from the cache when sampling is deterministic
+# (temperature 0), or for any settings when TOGETHER_RESPONSE_CACHE=1 opts in.
+# TOGETHER_RESPONSE_CACHE_FILE adds a SQLite tier that survives restarts.
+CACHE_RESPONSES = os.getenv("TOGETHER_RESPONSE_CACHE") == "1" or SAMPLING_PARAMS["temperature"] == 0
+_cache_file = os.getenv("TOGETHER_RESPONSE_CACHE_FILE")
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("TOGETHER_RESPONSE_CACHE_ENTRIES", "1000")),
+    ttl=float(os.getenv("TOGETHER_RESPONSE_CACHE_TTL", str(24 * 3600))),
+    file=Path(_cache_file) if _cache_file else None,
+    max_file_bytes=int(os.getenv("TOGETHER_RESPONSE_CACHE_BYTES", str(100 * 1024 * 1024))),
+)
+
+# Retries, backoff and model fallback, see resilience.RetryPolicy for the TOGETHER_* settings
+retry_policy = RetryPolicy.from_env()
+
+# Streamed requests still waiting for their first token after the model's recent
+# p95 get a second identical request, whichever answers first is used
+HEDGE_REQUESTS = os.getenv("TOGETHER_HEDGE", "1") == "1"
+HEDGE_PERCENTILE = float(os.getenv("TOGETHER_HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.getenv("TOGETHER_HEDGE_MIN_DELAY", "1.0"))
+latency_tracker = LatencyTracker()
+
+# Size of the keep-alive connection pool used by the async client, one
+# connection is held per in-flight streamed generation
+MAX_CONNECTIONS = int(os.getenv("TOGETHER_MAX_CONNECTIONS", "500"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("TOGETHER_MAX_KEEPALIVE_CONNECTIONS", "100"))
+# Seconds an idle pooled connection stays open
+KEEPALIVE_EXPIRY = 60
+
+# Connections the app opens to Together when it starts, so that the first chats
+# don't pay for the TCP and TLS handshakes, and keeps open while idle by reusing
+# them every TOGETHER_KEEP_WARM_INTERVAL seconds. 0 opens none.
+WARM_CONNECTIONS = int(os.getenv("TOGETHER_WARM_CONNECTIONS", "4"))
+KEEP_WARM_INTERVAL = float(os.getenv("TOGETHER_KEEP_WARM_INTERVAL", str(KEEPALIVE_EXPIRY / 2)))
 
 # Get the directory where the script is located
 THIS_DIR = Path(__file__).parent
 
+DEFAULT_SYSTEM_PROMPT = "You are a chatbot. You must strictly follow the game rules that are provided in the first user prompt. Always answer in the language of the prompt. If no specific game rules or language requirements are provided in the first prompt, maintain a helpful and respectful conversation in the language of the current prompt."
+
+def _parse_system_prompt(data: Optional[bytes]) -> str:
+    # Use a default system prompt if the file doesn't exist
+    if data is None:
+        return DEFAULT_SYSTEM_PROMPT
+    return data.decode('utf-8').strip()
+
+# Read once and reloaded when the file changes, rather than on every completion
+system_prompt_file = WatchedFile(THIS_DIR / 'system_prompt.txt', _parse_system_prompt)
+
 def load_system_prompt() -> str:
     """Load the system prompt from the system_prompt.txt file."""
-    try:
-        system_prompt_path = THIS_DIR / 'system_prompt.txt'
-        with open(system_prompt_path, 'r', encoding='utf-8') as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        # Return a default system prompt if the file doesn't exist
-        return "You are a chatbot. You must strictly follow the game rules that are provided in the first user prompt. Always answer in the language of the prompt. If no specific game rules or language requirements are provided in the first prompt, maintain a helpful and respectful conversation in the language of the current prompt."
+    return system_prompt_file.get()
+
+def parse_models(data: Optional[bytes]) -> List[str]:
+    """Parse models.txt, one model per line."""
+    if data is None:
+        return []
+    return [line.strip() for line in data.decode('utf-8').splitlines() if line.strip()]
+
+models_file = WatchedFile(THIS_DIR / 'models.txt', parse_models)
+
+def load_models() -> List[str]:
+    """Load the models listed in models.txt, the fallback candidates."""
+    return models_file.get()
 
 def extract_content_from_response(response):
     """
@@ -77,7 +175,7 @@ def generate_story():
     """Generate a short story about forbidden romance between two dogs."""
     try:
         # Create a chat completion request
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model="microsoft/WizardLM-2-8x22B",  # Specify the model
             messages=[
                 {"role": "user", "content": "Write a short two paragraph story about forbidden romance between two dogs"}
@@ -95,53 +193,462 @@ def generate_story():
         print(f"Error generating story: {e}")
         return f"Error generating story: {str(e)}"
 
-def chat_completion(prompt: str, message_history=None, model: str = "microsoft/WizardLM-2-8x22B") -> str:
+def extract_delta_from_chunk(chunk) -> str:
+    """
+    Safely extract the incremental text from a streamed Together API chunk.
+    
+    Args:
+        chunk: One chunk yielded by a `stream=True` completion
+        
+    Returns:
+        str: The new text carried by the chunk, or an empty string
+    """
+    if isinstance(chunk, dict):
+        choices = chunk.get('choices') or []
+        if choices:
+            delta = choices[0].get('delta') or {}
+            return delta.get('content') or ''
+        return ''
+    
+    choices = getattr(chunk, 'choices', None)
+    if choices:
+        delta = getattr(choices[0], 'delta', None)
+        if delta is not None:
+            return getattr(delta, 'content', None) or ''
+    return ''
+
+def context_budget(model: str) -> int:
+    """
+    Get the number of prompt tokens that can be sent to a model.
+    
+    Args:
+        model (str): The model the request is for
+        
+    Returns:
+        int: The model's context length minus room for the answer, capped by TOGETHER_CONTEXT_BUDGET
+    """
+    budget = MODEL_CONTEXT_LENGTHS.get(model, DEFAULT_CONTEXT_LENGTH) - MAX_OUTPUT_TOKENS
+    if CONTEXT_BUDGET:
+        budget = min(budget, CONTEXT_BUDGET)
+    return budget
+
+def build_messages(
+    prompt: str,
+    message_history: Optional[Sequence[Message]] = None,
+    model: Optional[str] = None,
+    system_prompt: Optional[str] = None,
+) -> List[Dict[str, str]]:
+    """
+    Build the message list sent to Together: system prompt, history and the current prompt.
+    
+    When `model` is given, the oldest history messages are dropped so the request
+    fits `context_budget(model)`. The system prompt and the current prompt are always kept.
+    History messages may carry a cached `tokens` count to avoid re-estimating them.
+    
+    Args:
+        prompt (str): The user's prompt
+        message_history (list, optional): Previous `Message`s, oldest first
+        model (str, optional): The model the messages are for
+        system_prompt (str, optional): Sent instead of the one in system_prompt.txt
+        
+    Returns:
+        list: Messages in the Together chat format
+    """
+    system_message = {
+        "role": "system",
+        "content": system_prompt if system_prompt is not None else load_system_prompt()
+    }
+    current_prompt = {"role": "user", "content": prompt}
+    
+    history = []
+    if message_history:
+        history = [
+            (m.to_together(), m.tokens if m.tokens is not None else estimate_tokens(m.content))
+            for m in message_history
+        ]
+    
+    if model is not None:
+        # Keep the newest messages that fit next to the system and current prompts
+        budget = context_budget(model) - estimate_tokens(system_message["content"]) - estimate_tokens(prompt)
+        kept = 0
+        for _, tokens in reversed(history):
+            budget -= tokens
+            if budget < 0:
+                break
+            kept += 1
+        history = history[len(history) - kept:]
+        # Don't start the conversation with an orphaned answer
+        while history and history[0][0]["role"] == "assistant":
+            history.pop(0)
+    
+    return [system_message, *(message for message, _ in history), current_prompt]
+
+@dataclass
+class CompletionInfo:
+    """How a completion was produced, filled in by the completion functions."""
+
+    # The model that produced the answer, differs from the requested one after a fallback
+    model: Optional[str] = None
+    # Upstream requests sent, including retries, fallbacks and hedged requests
+    attempts: int = 0
+    hedged: bool = False
+    cached: bool = False
+    # Token usage reported by Together for the answer, 0 when it wasn't reported
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+def _record_usage(usage, model: str, info: CompletionInfo):
+    """Keep the token counts of a response's or chunk's `usage`, if it has any."""
+    if usage is None:
+        return
+    info.prompt_tokens = getattr(usage, 'prompt_tokens', None) or 0
+    info.completion_tokens = getattr(usage, 'completion_tokens', None) or 0
+    label = metrics.model_label(model, load_models())
+    metrics.upstream_tokens.inc(label, 'prompt', amount=info.prompt_tokens)
+    metrics.upstream_tokens.inc(label, 'completion', amount=info.completion_tokens)
+
+def _record_error(model: str, error: Exception):
+    metrics.upstream_errors.inc(metrics.model_label(model, load_models()), type(error).__name__)
+
+def chat_completion(
+    prompt: str,
+    message_history: Optional[Sequence[Message]] = None,
+    model: str = "microsoft/WizardLM-2-8x22B",
+    info: Optional[CompletionInfo] = None,
+    system_prompt: Optional[str] = None,
+) -> str:
     """
     Generate a chat completion using Together AI.
     
+    Transient errors are retried with jittered exponential backoff, then the
+    fallback models of `retry_policy` are tried.
+    
     Args:
         prompt (str): The user's prompt
-        message_history (list, optional): List of previous messages
+        message_history (list, optional): Previous `Message`s, oldest first
         model (str, optional): The model to use for completion
+        info (CompletionInfo, optional): Filled in with how the answer was produced
+        system_prompt (str, optional): Sent instead of the one in system_prompt.txt
         
     Returns:
         str: The model's response
-    """
-    try:
-        messages = []
-        
-        # Add system prompt
-        system_prompt = {
-            "role": "system",
-            "content": load_system_prompt()
-        }
-        messages.append(system_prompt)
         
-        # Add message history if provided
-        if message_history:
-            for msg in message_history:
-                if hasattr(msg, 'parts') and msg.parts:
-                    part = msg.parts[0]
-                    if hasattr(part, 'content'):
-                        role = "user" if msg.__class__.__name__ == "ModelRequest" else "assistant"
-                        messages.append({"role": role, "content": part.content})
+    Raises:
+        Exception: The last error, when every attempt failed
+    """
+    info = info if info is not None else CompletionInfo()
+    messages = build_messages(prompt, message_history, model, system_prompt)
+    
+    key = cache_key(model, messages, SAMPLING_PARAMS) if CACHE_RESPONSES else None
+    if key is not None:
+        cached = response_cache.get(key)
+        if cached is not None:
+            info.model, info.cached = model, True
+            return cached
+    
+    last_error: Optional[Exception] = None
+    for candidate in retry_policy.models_to_try(model, load_models()):
+        if last_error is not None and not should_fall_back(last_error):
+            break
+        # A fallback model gets its own context window budget
+        candidate_messages = (
+            messages if candidate == model else build_messages(prompt, message_history, candidate, system_prompt)
+        )
+        for attempt in range(1, retry_policy.max_attempts + 1):
+            info.attempts += 1
+            try:
+                # Create a chat completion request
+                response = get_client().chat.completions.create(
+                    model=candidate,
+                    messages=candidate_messages,
+                    **SAMPLING_PARAMS,
+                    stream=False,  # Set stream to False to get a complete response
+                )
+            except Exception as e:
+                last_error = e
+                _record_error(candidate, e)
+                print(f"Error in chat_completion with {candidate} (attempt {attempt}): {e}")
+                if not is_transient(e) or attempt == retry_policy.max_attempts:
+                    break
+                time.sleep(retry_policy.backoff(attempt, e))
+                continue
+            
+            content = extract_content_from_response(response)
+            info.model = candidate
+            _record_usage(getattr(response, 'usage', None), candidate, info)
+            if key is not None and candidate == model:
+                response_cache.put(key, content)
+            return content
+    
+    assert last_error is not None
+    raise last_error
+
+def create_http_client() -> httpx.AsyncClient:
+    """The pooled keep-alive HTTP client for `create_async_client`."""
+    import httpx
+
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(120, connect=5),
+    )
+
+def create_async_client(http_client: Optional[httpx.AsyncClient] = None) -> AsyncTogether:
+    """
+    Create the async Together client used by the web app.
+    
+    The client is meant to live for the lifetime of the app (see `lifespan`
+    in main.py) so that all requests share one pooled keep-alive HTTP connection
+    pool instead of opening a connection, or a thread, per request.
+    
+    Args:
+        http_client (httpx.AsyncClient, optional): The client from `create_http_client`,
+            made here when omitted
         
-        # Add the current prompt
-        messages.append({"role": "user", "content": prompt})
+    Returns:
+        AsyncTogether: A client to be closed with `await client.close()` or `async with`,
+            which also closes `http_client`
+    """
+    from together import AsyncTogether
+
+    if http_client is None:
+        http_client = create_http_client()
+    return AsyncTogether(api_key=api_key, http_client=http_client, max_retries=0)
+
+async def warm_connections(http_client: httpx.AsyncClient, url: str, count: int = WARM_CONNECTIONS) -> int:
+    """
+    Open `count` pooled connections to Together, or reuse idle ones, with concurrent HEAD requests.
+    
+    Args:
+        http_client (httpx.AsyncClient): The client from `create_http_client`
+        url (str): The Together API base URL
+        count (int, optional): The number of connections
         
-        # Create a chat completion request
-        response = client.chat.completions.create(
-            model=model,  # Use the provided model
-            messages=messages,
-            max_tokens=1000,
-            temperature=0.7,
-            top_p=0.9,
-            top_k=40,
-            repetition_penalty=1.0,
-            stream=False,  # Set stream to False to get a complete response
-        )
+    Returns:
+        int: The number of requests answered, with any status: only the connection matters
+    """
+    import httpx
+
+    async def head() -> Optional[Exception]:
+        try:
+            await http_client.head(url)
+        except Exception as e:
+            return e
+        return None
+
+    errors = [e for e in await asyncio.gather(*(head() for _ in range(count))) if e is not None]
+    if errors:
+        print(f"Error opening {len(errors)} connections to {url}: {errors[0]!r}")
+    return count - len(errors)
+
+async def _first_token(async_client: AsyncTogether, model: str, messages: List[Dict[str, str]]):
+    """
+    Open a streamed completion and wait for its first piece of text.
+    
+    Returns:
+        tuple: The stream, its chunk iterator positioned after the first text, and that text
+    """
+    start = time.monotonic()
+    stream = await async_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        **SAMPLING_PARAMS,
+        stream=True,
+    )
+    chunks = stream.__aiter__()
+    try:
+        first = ''
+        while not first:
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                break
+            first = extract_delta_from_chunk(chunk)
+    except BaseException:
+        # Includes cancellation of a hedged request that lost the race
+        await stream.close()
+        raise
+    latency_tracker.record(model, time.monotonic() - start)
+    return stream, chunks, first
+
+async def _hedged_first_token(
+    async_client: AsyncTogether,
+    model: str,
+    messages: List[Dict[str, str]],
+    info: CompletionInfo,
+    scheduler: Optional[Scheduler] = None,
+):
+    """
+    Like `_first_token`, but sends a second identical request if the first one
+    hasn't produced any text by the model's p95 time to first token, and keeps
+    whichever answers first.
+    
+    The second request is charged to `scheduler`'s rate budget for the model,
+    and not sent when that budget is exhausted or other requests are queued.
+    """
+    info.attempts += 1
+    p95 = latency_tracker.percentile(model, HEDGE_PERCENTILE) if HEDGE_REQUESTS else None
+    if p95 is None:
+        return await _first_token(async_client, model, messages)
+    
+    tasks = [asyncio.create_task(_first_token(async_client, model, messages))]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=max(p95, HEDGE_MIN_DELAY))
+        if not done and (scheduler is None or scheduler.try_charge(model)):
+            info.attempts += 1
+            info.hedged = True
+            tasks.append(asyncio.create_task(_first_token(async_client, model, messages)))
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in done if task.exception() is None]
+            if winners:
+                for loser in winners[1:]:
+                    await loser.result()[0].close()
+                return winners[0].result()
+            error = next(iter(done)).exception()
+        assert error is not None
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                # The loser closes its own stream once cancelled
+                task.cancel()
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+async def _open_stream(
+    async_client: AsyncTogether,
+    prompt: str,
+    message_history: Optional[Sequence[Message]],
+    model: str,
+    messages: List[Dict[str, str]],
+    info: CompletionInfo,
+    scheduler: Optional[Scheduler] = None,
+):
+    """
+    Retry and fall back until one of the models starts answering, see `_first_token`.
+    
+    With a `scheduler`, whose slot for `model` the caller holds, retries wait for
+    the model's rate budget and a fallback model waits for a slot of its own,
+    which is still held on return when it answered and must then be released.
+    """
+    last_error: Optional[Exception] = None
+    for candidate in retry_policy.models_to_try(model, load_models()):
+        if last_error is not None and not should_fall_back(last_error):
+            break
+        # A fallback model gets its own context window budget
+        candidate_messages = messages if candidate == model else build_messages(prompt, message_history, candidate)
+        fallback_slot = scheduler is not None and candidate != model
+        if fallback_slot:
+            try:
+                await scheduler.acquire(candidate)
+            except Overloaded as e:
+                print(f"Not falling back to {candidate}: {e}")
+                continue
+        opened = None
+        try:
+            for attempt in range(1, retry_policy.max_attempts + 1):
+                if attempt > 1 and scheduler is not None:
+                    await scheduler.charge(candidate)
+                try:
+                    opened = await _hedged_first_token(async_client, candidate, candidate_messages, info, scheduler)
+                except Exception as e:
+                    last_error = e
+                    _record_error(candidate, e)
+                    print(f"Error in chat_completion_stream with {candidate} (attempt {attempt}): {e}")
+                    if not is_transient(e) or attempt == retry_policy.max_attempts:
+                        break
+                    await asyncio.sleep(retry_policy.backoff(attempt, e))
+                    continue
+                info.model = candidate
+                return opened
+        finally:
+            if fallback_slot and opened is None:
+                scheduler.release(candidate)
+    
+    assert last_error is not None
+    raise last_error
+
+async def chat_completion_stream(
+    async_client: AsyncTogether,
+    prompt: str,
+    message_history: Optional[Sequence[Message]] = None,
+    model: str = "microsoft/WizardLM-2-8x22B",
+    info: Optional[CompletionInfo] = None,
+    scheduler: Optional[Scheduler] = None,
+) -> AsyncIterator[str]:
+    """
+    Stream a chat completion from Together AI, yielding text as tokens arrive.
+    
+    Unlike `chat_completion`, errors are raised rather than returned as text,
+    so callers can tell a failed generation apart from a real answer.
+    Closing the generator early closes the upstream HTTP stream.
+    Cached responses are yielded whole, and only complete responses are cached.
+    
+    Until the first text arrives, transient errors are retried with backoff and
+    then the fallback models are tried, and a request slower than the model's
+    p95 time to first token is hedged with a second one. Once text has been
+    yielded, errors are raised as is.
+    
+    Every upstream request besides the first is charged to `scheduler`, see
+    `_open_stream`; the caller holds its slot for `model` while the generator runs.
+    
+    Args:
+        async_client (AsyncTogether): The client from `create_async_client`
+        prompt (str): The user's prompt
+        message_history (list, optional): Previous `Message`s, oldest first
+        model (str, optional): The model to use for completion
+        info (CompletionInfo, optional): Filled in with how the answer was produced
+        scheduler (Scheduler, optional): Limits the retries, hedges and fallbacks
         
-        return extract_content_from_response(response)
-    except Exception as e:
-        print(f"Error in chat_completion: {e}")
-        return f"An error occurred: {str(e)}" 
+    Yields:
+        str: Incremental pieces of the model's response
+    """
+    info = info if info is not None else CompletionInfo()
+    start = time.perf_counter()
+    messages = build_messages(prompt, message_history, model)
+    metrics.chat_stage_seconds.observe(
+        time.perf_counter() - start, 'prompt_assembly', metrics.model_label(model, load_models())
+    )
+    
+    key = cache_key(model, messages, SAMPLING_PARAMS) if CACHE_RESPONSES else None
+    if key is not None:
+        if response_cache.persistent:
+            cached = await asyncio.to_thread(response_cache.get, key)
+        else:
+            cached = response_cache.get(key)
+        if cached is not None:
+            info.model, info.cached = model, True
+            yield cached
+            return
+    
+    stream, chunks, first = await _open_stream(
+        async_client, prompt, message_history, model, messages, info, scheduler
+    )
+    
+    parts = []
+    try:
+        if first:
+            parts.append(first)
+            yield first
+        async for chunk in chunks:
+            delta = extract_delta_from_chunk(chunk)
+            if delta:
+                parts.append(delta)
+                yield delta
+            # Together reports the usage on the last chunk
+            _record_usage(getattr(chunk, 'usage', None), info.model, info)
+    finally:
+        await stream.close()
+        if scheduler is not None and info.model != model:
+            scheduler.release(info.model)
+    
+    if key is not None and parts and info.model == model:
+        if response_cache.persistent:
+            await asyncio.to_thread(response_cache.put, key, ''.join(parts))
+        else:
+            response_cache.put(key, ''.join(parts))